@@ -42,7 +42,7 @@ torch.set_default_dtype(torch.float)
 #A CONVOLUTIONAL DECODER (STACK OF CONVOLUTIONAL LAYERS AND ACTIVATION FUNCTIONS):
 #------------------------------------------------------
 class CNNDecoder(nn.Module):
-    def __init__(self,list_hid_channels,kernel_sizes,dim_cov_est,non_linearity=["ReLU"],dim_features_inp=2):
+    def __init__(self,list_hid_channels,kernel_sizes,dim_cov_est,non_linearity=["ReLU"],dim_features_inp=2,n_scales=1):
         '''
         Input: list_hid_channels - list of ints -  element i gives the number of channels of hidden layer i 
                kernel_sizes - list of odd ints - sizes of kernels for convolutional layers 
@@ -53,13 +53,14 @@ class CNNDecoder(nn.Module):
                                                  or length is the number of layers (giving a custom non-linearity for every
                                                  layer)                   
                 dim_features_in,dim_features_out - int - dimension of feature space for inputs and outputs (usually dim_features_in=dim_features_out)
+               n_scales - int - number of length scales of the encoder (the input has a (density,features)-block per length scale)
         -->Creates a stack of CNN layers with number of channels given by "list_n_channels" and 
         kernel sizes given by self.kernel_sizes - we perform padding such that the height and width do not change
         '''    
         #Initialize:
         super(CNNDecoder, self).__init__()
         #Save a list of the number of channels per layer (input and output are given):
-        self.list_n_channels=[1+dim_features_inp,*list_hid_channels,dim_cov_est+2]       
+        self.list_n_channels=[n_scales*(1+dim_features_inp),*list_hid_channels,dim_cov_est+2]       
         #Save the kernel sizes:
         self.kernel_sizes=kernel_sizes
         #Save the number of layers:
@@ -71,6 +72,7 @@ class CNNDecoder(nn.Module):
 
         #Save the dimension of the input and the output features:
         self.dim_features_inp=dim_features_inp
+        self.n_scales=n_scales
 
         #-----CREATE LIST OF NON-LINEARITIES----
         if len(non_linearity)==1:
@@ -122,6 +124,7 @@ class CNNDecoder(nn.Module):
             'dim_cov_est': self.dim_cov_est,
             'non_linearity': self.non_linearity,
             'dim_features_inp': self.dim_features_inp,
+            'n_scales': self.n_scales,
             'decoder_class': self.__class__.__name__,
             'decoder_info': self.decoder.__str__(),
             'decoder_par': self.decoder.state_dict()
@@ -142,6 +145,7 @@ class CNNDecoder(nn.Module):
                                     dim_cov_est=dictionary['dim_cov_est'],
                                     non_linearity=dictionary['non_linearity'],
                                     dim_features_inp=dictionary['dim_features_inp'],
+                                    n_scales=dictionary.get('n_scales',1)
                                 )
         if 'decoder_par' in dictionary:
             Decoder.decoder.load_state_dict(dictionary['decoder_par'])
@@ -156,7 +160,7 @@ class CNNDecoder(nn.Module):
 #AN EQUIVARIANT DECODER (STACK OF EQUIVARIANT CONVOLUTIONAL LAYERS AND ACTIVATION FUNCTIONS):
 #------------------------------------------------------
 class SteerDecoder(nn.Module):
-    def __init__(self,hidden_reps_ids,kernel_sizes,dim_cov_est,context_rep_ids=[1],N=4,flip=False,non_linearity=["NormReLU"],max_frequency=30):
+    def __init__(self,hidden_reps_ids,kernel_sizes,dim_cov_est,context_rep_ids=[1],N=4,flip=False,non_linearity=["NormReLU"],max_frequency=30,n_scales=1):
         '''
         Input:  hidden_reps_ids - list: encoding the hidden fiber representation (see give_fib_reps_from_ids)
                 kernel_sizes - list of ints - sizes of kernels for convolutional layers
@@ -169,6 +173,8 @@ class SteerDecoder(nn.Module):
                 N - int - gives the group order, -1 is infinite
                 flip - Bool - indicates whether we have a flip in the rotation group (i.e.O(2) vs SO(2), D_N vs C_N)
                 max_frequency - int - maximum irrep frequency to computed, only relevant if N=-1
+                n_scales - int - number of length scales of the encoder: the embedding has a block (trivial rep + context rep)
+                                 per length scale (see EquivEncoder.channel_layout)
         '''
 
         super(SteerDecoder, self).__init__()
@@ -191,6 +197,7 @@ class SteerDecoder(nn.Module):
         #Save the id's for the context representation and extract the context fiber representation:
         self.context_rep_ids=context_rep_ids
         self.context_rep=group.directsum(self.give_reps_from_ids(self.context_rep_ids))
+        self.n_scales=n_scales
         
         #Save the parameters:
         self.kernel_sizes=kernel_sizes
@@ -271,7 +278,8 @@ class SteerDecoder(nn.Module):
                              the sume of rep(k_1),...,rep(k_l) determines the ith element of "feat_types"
         '''
         #Feat type of embedding consist of sums of trivial and context fiber representation:
-        feat_types=[G_CNN.FieldType(self.G_act,[self.G_act.trivial_repr,self.context_rep])]
+        #(one block for every length scale of the encoder):
+        feat_types=[G_CNN.FieldType(self.G_act,self.n_scales*[self.G_act.trivial_repr,self.context_rep])]
         #Go over all hidden fiber reps:
         for ids in self.hidden_reps_ids:
             #New layer collects the sum of individual representations to one list:
@@ -312,6 +320,7 @@ class SteerDecoder(nn.Module):
             'flip': self.flip,
             'non_linearity': self.non_linearity,
             'max_frequency': self.max_frequency,
+            'n_scales': self.n_scales,
             'decoder_class': self.__class__.__name__,
             'decoder_info': self.decoder.__str__(),
             'decoder_par': self.decoder.state_dict()
@@ -338,7 +347,8 @@ class SteerDecoder(nn.Module):
                                 N=dictionary['N'],
                                 flip=dictionary['flip'],
                                 non_linearity=dictionary['non_linearity'],
-                                max_frequency=dictionary['max_frequency']
+                                max_frequency=dictionary['max_frequency'],
+                                n_scales=dictionary.get('n_scales',1)
                                 )
         if 'decoder_par' in dictionary:
             if dictionary['decoder_par'] is not None:
@@ -46,7 +46,7 @@ class ConditionalNeuralProcess(nn.Module):
         if state_dict is not None:
             self.load_state_dict(state_dict)
 
-    def forward(self,x_context,y_context,x_target):
+    def forward(self,x_context,y_context,x_target,context_mask=None):
         '''
         Input:
           x_context: torch.Tensor
@@ -55,28 +55,31 @@ class ConditionalNeuralProcess(nn.Module):
                       Shape (batch_size,n_context_points,self.dim_Y)
           x_target:  torch.Tensor
                       Shape (batch_size,n_target_points,self.dim_X)
+          context_mask: None or torch.Tensor
+                      Shape (batch_size,n_context_points) - 1 for context points, 0 for padding
         Output:
             mean_vec - torch.Tensor - shape (batch_size,n_target_points,self.dim_Y)
             Covs - torch.Tensor - shape (batch_size,n_target_points,self.dim_Y,self.dim_Y)
         '''
         batch_size,n_target_points,_=x_target.size()
 
-        r=self.encoder(x_context,y_context) #Shape of r: (batch_size,self.dim_R)
+        r=self.encoder(x_context,y_context,context_mask) #Shape of r: (batch_size,self.dim_R)
         
         mean_vec, scale_vec=self.decoder(x=x_target,r=r)
         
         Covs=scale_vec.diag_embed()
         return mean_vec,Covs
 
-    def loss(self,Y_Target,Predict,Covs,shape_reg=None):
+    def loss(self,Y_Target,Predict,Covs,shape_reg=None,target_mask=None):
         '''
             Inputs: Y_Target: torch.tensor - shape (batch_size,n,2) - Target set locations and vectors
                     Predict: torch.tensor - shape (batch_size,n,2) - Predictions of Y_Target at X_Target
                     Covs: torch.tensor - shape (batch_size,n,2,2) - covariance matrices of Y_Target at X_Target
+                    target_mask: None or torch.tensor - shape (batch_size,n) - 1 for target points, 0 for padding
             Output: -log_ll,log_ll
         '''
         log_ll_vec=my_utils.batch_multivar_log_ll(Means=Predict,Covs=Covs,data=Y_Target)
-        log_ll=log_ll_vec.mean()
+        log_ll=my_utils.masked_mean(log_ll_vec,target_mask)
         if shape_reg is None:
             loss=-log_ll
         else:
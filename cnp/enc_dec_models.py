@@ -8,6 +8,9 @@ import math
 import sys
 import time
 
+#Own files:
+import my_utils
+
 class CNPEncoder(nn.Module):
     def __init__(self, dim_X, dim_Y, hidden_layers, dim_R):
         super(CNPEncoder, self).__init__()
@@ -39,13 +42,15 @@ class CNPEncoder(nn.Module):
 
         self.encoder=nn.Sequential(*layers_list)
 
-    def forward(self,x,y):
+    def forward(self,x,y,mask=None):
         '''
         Input:
         x: torch.Tensor
            Shape (batch_size,n_context_points,self.dim_X)
         y: torch.Tensor
            Shape (batch_size,n_context_points,self.dim_Y)
+        mask: None or torch.Tensor
+           Shape (batch_size,n_context_points) - 1 for context points, 0 for padding (the mean is taken over the context points only)
         Output:
         encoder_mean: torch.Tensor
                       Shape (batch_size,self.dim_R)
@@ -62,7 +67,7 @@ class CNPEncoder(nn.Module):
         encoder_input_pairs=torch.cat((x,y),dim=2)
         encoder_output=self.encoder(encoder_input_pairs)
         #Take the mean of the vectors:
-        encoder_mean=encoder_output.mean(dim=1)
+        encoder_mean=my_utils.masked_mean(encoder_output,mask,dim=1)
         return(encoder_mean)
         
 class CNPDecoder(nn.Module):
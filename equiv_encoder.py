@@ -38,7 +38,8 @@ torch.set_default_dtype(torch.float)
 
 class EquivEncoder(nn.Module):
     def __init__(self, x_range,n_x_axis,y_range=None,n_y_axis=None,
-                 l_scale=1.,normalize=True,train_l_scale=False):
+                 l_scale=1.,normalize=True,train_l_scale=False,memory_budget=None,method="dense",recompute_kernel=False,n_features=256,
+                 l_scales=None):
         super(EquivEncoder, self).__init__()
         '''
         Inputs:
@@ -47,15 +48,44 @@ class EquivEncoder(nn.Module):
             n_y_axis: int - number of grid points along the y-axis
             l_scale: float - initialisation of length scale
             normalize: boolean - indicates whether feature channels is divided by density channel
+            memory_budget: int or None - maximum number of kernel elements computed at once (see GP.batch_kernel_smoother_2d)
+            method: string - "dense" - kernel between all grid points and context points
+                             "separable" - exact, uses that the rbf kernel factorizes along the axes of the grid,
+                                           i.e. only (n_x_axis,n) and (n_y_axis,n) kernel values are computed
+                             "rff" - approximation with random (quasi-Monte Carlo) Fourier features, 
+                                     O((n+n_x_axis*n_y_axis)*n_features) (see GP.batch_rff_smoother_2d)
+                             "splat" - approximation: the points are spread onto the grid by bilinear interpolation weights,
+                                       followed by a separable convolution with the discretized rbf kernel 
+            recompute_kernel: boolean - if True, the kernel weights of the "dense" method are recomputed in the backward pass
+                                        instead of being saved (see GP.RBFSmoothing)
+            n_features: int - number of Fourier frequencies for the "rff" method
+            l_scales: list of floats or None - if given, initialisation of K length scales (replaces l_scale): the squared distances
+                                               are computed once and the feature map has a (density,features)-block for every
+                                               length scale (see channel_layout), only for the "dense" and "separable" method
         '''
         #-------------------------SET PARAMETERS-----------------
         #Save whether to normalize and train l scale:
         self.normalize=normalize
         self.train_l_scale=train_l_scale
+        #Save the memory budget for the kernel computation:
+        self.memory_budget=memory_budget
+        #Save the method to compute the kernel sums:
+        self.method=method
+        self.recompute_kernel=recompute_kernel
+        self.n_features=n_features
         
         #Kernel parameters:
         self.kernel_type="rbf"
-        self.log_l_scale=nn.Parameter(torch.log(torch.tensor(l_scale,dtype=torch.get_default_dtype())),requires_grad=train_l_scale)
+        self.l_scales=l_scales
+        self.n_scales=len(l_scales) if l_scales is not None else 1
+        if l_scales is not None:
+            self.log_l_scale=nn.Parameter(torch.log(torch.tensor(l_scales,dtype=torch.get_default_dtype())),requires_grad=train_l_scale)
+        else:
+            self.log_l_scale=nn.Parameter(torch.log(torch.tensor(l_scale,dtype=torch.get_default_dtype())),requires_grad=train_l_scale)
+        #Accumulator of the unnormalized feature map for streaming context points (see add_context):
+        self.context_accumulator=None
+        #Kernel table for inputs on a fixed lattice (see set_lattice):
+        self.lattice_table=None
 
         #Grid parameters:
         #x-axis:
@@ -78,14 +108,23 @@ class EquivEncoder(nn.Module):
         self.grid=nn.Parameter(my_utils.give_2d_grid(min_x=self.x_range[0],max_x=self.x_range[1],
                                min_y=self.y_range[1],max_y=self.y_range[0],
                                n_x_axis=self.n_x_axis,n_y_axis=self.n_y_axis,flatten=True),requires_grad=False)
+        #Fourier frequencies for the "rff" method (fixed seed, so that they are the same when the model is reloaded):
+        if self.method=="rff":
+            self.frequencies=nn.Parameter(GP.rbf_fourier_frequencies(self.n_features,d=2,qmc=True,seed=0),requires_grad=False)
             
         #-------------------------SET PARAMETERS FINISHED-----------------
         
         #-------------------------CONTROL PARAMETERS-----------------
         if not isinstance(l_scale,float) or l_scale<=0:
             sys.exit("Encoder error: l_scale not correct.")
+        if l_scales is not None and (len(l_scales)==0 or any(not isinstance(l,float) or l<=0 for l in l_scales)):
+            sys.exit("Encoder error: l_scales not correct.")
+        if l_scales is not None and self.method not in ["dense","separable"]:
+            sys.exit("Encoder error: multiple length scales only for the dense and separable method.")
         if self.x_range[0]>=self.x_range[1] or self.y_range[0]>=self.y_range[1]:
             sys.exit("x and y range are not valid.")
+        if self.method not in ["dense","separable","rff","splat"]:
+            sys.exit("Encoder error: unknown method.")
         #-------------------------CONTROL PARAMETERS FINISHED-----------------
 
     #Function to add a one to every vector: y->(1,y):
@@ -96,13 +135,27 @@ class EquivEncoder(nn.Module):
         '''
         return(torch.cat([torch.ones([Y.size(0),Y.size(1),1],device=Y.device),Y],dim=2))
 
-    def forward(self,X,Y):
+    def forward(self,X,Y,context_mask=None):
         '''
         Inputs:
             X: torch.Tensor - shape (batch_size,n,2)
             Y: torch.Tensor - shape (batch_size,n,dim_Y)
+            context_mask: None or torch.Tensor - shape (batch_size,n) - 1 for context points, 0 for padding (see unnormalized_feature_map)
         Outputs:
-            torch.Tensor - shape (batch_size,dim_Y+1,self.n_y_axis,self.n_x_axis)
+            torch.Tensor - shape (batch_size,self.n_scales*(dim_Y+1),self.n_y_axis,self.n_x_axis) - see channel_layout
+        '''
+        return(self.normalize_feature_map(self.unnormalized_feature_map(X,Y,context_mask)))
+
+    #The feature map before normalization is a sum over the context points (density channel and weighted features):
+    def unnormalized_feature_map(self,X,Y,context_mask=None):
+        '''
+        Inputs:
+            X: torch.Tensor - shape (batch_size,n,2)
+            Y: torch.Tensor - shape (batch_size,n,dim_Y)
+            context_mask: None or torch.Tensor - shape (batch_size,n) - 1 for context points, 0 for padding (padded entries 
+                          of X and Y must be finite), allows a different number of context points per batch element
+        Outputs:
+            torch.Tensor - shape (batch_size,self.n_scales*(dim_Y+1),self.n_y_axis,self.n_x_axis) - see channel_layout
         '''
         #DEBUG: Control whether X and the grid are on the same device:
         if self.grid.device!=X.device:
@@ -113,21 +166,226 @@ class EquivEncoder(nn.Module):
         #Compute the length scale out of the log-scale (clamp for numerical stability):
         l_scale=torch.exp(self.log_l_scale)#torch.clamp(self.log_l_scale,max=5.,min=-5.))
         
-        #Compute for every grid-point x' the value k(x',x_i) for all x_i in the data-->shape (batch_size,self.n_y_axis*self.n_x_axis,n)
-        Gram=GP.batch_gram_matrix(self.grid.unsqueeze(0).expand(batch_size,self.n_y_axis*self.n_x_axis,2),
-                                  X,l_scale=l_scale,kernel_type=self.kernel_type,B=torch.ones((1),device=X.device))
-        
         #Compute feature expansion --> shape (batch_size,n,self.dim_Y+1)
         Expand_Y=self.expand_with_ones(Y)
-        #Compute feature map -->shape (self.n_y_axis*self.n_x_axis,self.dim_Y+1)
-        Feature_Map=torch.matmul(Gram,Expand_Y)
+        #The feature map is linear in Expand_Y, so padded points are removed by zeroing their row (density and features):
+        if context_mask is not None:
+            Expand_Y=Expand_Y*context_mask.unsqueeze(2).to(Expand_Y.dtype)
+        #Inputs given as indices of lattice points (see set_lattice) - gather from the kernel table if no gradients
+        #with respect to the length scale are required, otherwise take the coordinates of the lattice points:
+        if not torch.is_floating_point(X):
+            if self.lattice_table is None:
+                sys.exit("Encoder error: inputs are indices but no lattice is set.")
+            if self.lattice_table.usable(l_scale):
+                return(self.lattice_feature_map(X,Expand_Y,l_scale))
+            X=self.lattice_table.Lattice.to(self.grid.device)[X]
+        #Compute feature map, i.e. for every grid-point x' the sum of k(x',x_i)*(1,y_i) over all x_i in the data 
+        #-->shape (batch_size,dim_Y+1,self.n_y_axis,self.n_x_axis) (because this is the form required for a an EquivCNN):
+        if self.n_scales>1:
+            Feature_Map=self.multi_scale_feature_map(X,Expand_Y,l_scale)
+        elif self.method=="separable":
+            Feature_Map=self.separable_feature_map(X,Expand_Y,l_scale)
+        elif self.method=="splat":
+            Feature_Map=self.splat_feature_map(X,Expand_Y,l_scale)
+        elif self.method=="rff":
+            Feature_Map=GP.batch_rff_smoother_2d(X_Context=X,Y_Context=Expand_Y,
+                                                 X_Target=self.grid.unsqueeze(0).expand(batch_size,self.n_y_axis*self.n_x_axis,2),
+                                                 Frequencies=self.frequencies,normalize=False,l_scale=l_scale)
+            Feature_Map=Feature_Map.reshape(batch_size,self.n_y_axis,self.n_x_axis,Expand_Y.size(2)).permute(dims=(0,3,1,2))
+        else:
+            Feature_Map=GP.batch_kernel_smoother_2d(X_Context=X,Y_Context=Expand_Y,
+                                                    X_Target=self.grid.unsqueeze(0).expand(batch_size,self.n_y_axis*self.n_x_axis,2),
+                                                    normalize=False,l_scale=l_scale,kernel_type=self.kernel_type,memory_budget=self.memory_budget,
+                                                    recompute=self.recompute_kernel)
+            Feature_Map=Feature_Map.reshape(batch_size,self.n_y_axis,self.n_x_axis,Expand_Y.size(2)).permute(dims=(0,3,1,2))
 
-        #If wanted, normalize the weights for the channel which is not the density channel:
-        if self.normalize:
-            Feature_Map[:,:,1:]=Feature_Map[:,:,1:]/Feature_Map[:,:,0].unsqueeze(2)
-        
-        #Reshape the Feature Map to the form (batch_size,dim_Y+1,self.n_y_axis,self.n_x_axis) (because this is the form required for a an EquivCNN):
-        return(Feature_Map.reshape(batch_size,self.n_y_axis,self.n_x_axis,Expand_Y.size(2)).permute(dims=(0,3,1,2)))     
+        return(Feature_Map)
+
+    def normalize_feature_map(self,Feature_Map):
+        '''
+        Input: Feature_Map - torch.Tensor - shape (batch_size,self.n_scales*(dim_Y+1),self.n_y_axis,self.n_x_axis) - unnormalized feature map
+        Output: torch.Tensor - same shape - if self.normalize, the features are divided by the density channel (for every length scale)
+        '''
+        if not self.normalize:
+            return(Feature_Map)
+        batch_size=Feature_Map.size(0)
+        Feature_Map=Feature_Map.view(batch_size,self.n_scales,-1,self.n_y_axis,self.n_x_axis)
+        Feature_Map=torch.cat([Feature_Map[:,:,:1],Feature_Map[:,:,1:]/Feature_Map[:,:,:1]],dim=2)
+        return(Feature_Map.view(batch_size,-1,self.n_y_axis,self.n_x_axis))
+
+    #Functions for streaming context points: the unnormalized feature map is additive in the context points, 
+    #so it is kept as an accumulator which is updated with every new (or removed) observation:
+    def reset_context(self):
+        self.context_accumulator=None
+
+    def add_context(self,X,Y):
+        '''
+        Inputs:
+            X: torch.Tensor - shape (batch_size,n,2) - new context points
+            Y: torch.Tensor - shape (batch_size,n,dim_Y) - features of the new context points
+        '''
+        Feature_Map=self.unnormalized_feature_map(X,Y)
+        if self.context_accumulator is None:
+            self.context_accumulator=Feature_Map
+        else:
+            self.context_accumulator=self.context_accumulator+Feature_Map
+
+    def remove_context(self,X,Y):
+        '''
+        Inputs:
+            X: torch.Tensor - shape (batch_size,n,2) - context points to remove (previously added)
+            Y: torch.Tensor - shape (batch_size,n,dim_Y) - features of these context points
+        '''
+        if self.context_accumulator is None:
+            sys.exit("Encoder error: no context points to remove.")
+        self.context_accumulator=self.context_accumulator-self.unnormalized_feature_map(X,Y)
+
+    def give_context_embedding(self):
+        '''
+        Output: torch.Tensor - shape (batch_size,self.n_scales*(dim_Y+1),self.n_y_axis,self.n_x_axis) - embedding of all context
+                points added so far (same as forward applied to them)
+        '''
+        if self.context_accumulator is None:
+            sys.exit("Encoder error: no context points added.")
+        return(self.normalize_feature_map(self.context_accumulator))
+
+    #The layout of the channels of the feature map:
+    def channel_layout(self,dim_Y):
+        '''
+        Input: dim_Y - int - dimension of the features of the context set
+        Output: list of tuples (name,n_channels) - blocks of channels of the feature map in this order:
+                for every length scale k a density channel ("density_k",1) and the features ("features_k",dim_Y)
+                (e.g. consumed by architectures.SteerDecoder with n_scales=self.n_scales)
+        '''
+        return([block for k in range(self.n_scales) for block in [("density_"+str(k),1),("features_"+str(k),dim_Y)]])
+
+    #Feature map for several length scales at once (the squared distances are only computed once):
+    def multi_scale_feature_map(self,X,Expand_Y,l_scales):
+        '''
+        Inputs:
+            X: torch.Tensor - shape (batch_size,n,2)
+            Expand_Y: torch.Tensor - shape (batch_size,n,C)
+            l_scales: torch.Tensor - shape (self.n_scales) - length scales
+        Outputs:
+            torch.Tensor - shape (batch_size,self.n_scales*C,self.n_y_axis,self.n_x_axis) - unnormalized feature map
+        '''
+        batch_size,n,C=Expand_Y.size()
+        l_scales=l_scales.view(1,self.n_scales,1,1)
+        if self.method=="separable":
+            #Squared distances along the axes --> shape (batch_size,1,self.n_x_axis,n) and (batch_size,1,self.n_y_axis,n):
+            Dist_x=((self.grid[:self.n_x_axis,0].view(1,-1,1)-X[:,:,0].unsqueeze(1))**2).unsqueeze(1)
+            Dist_y=((self.grid[::self.n_x_axis,1].view(1,-1,1)-X[:,:,1].unsqueeze(1))**2).unsqueeze(1)
+            #Kernel factors for all length scales --> shape (batch_size,self.n_scales,self.n_x_axis,n) and (batch_size,self.n_scales,self.n_y_axis,n):
+            K_x=torch.exp(-0.5*Dist_x/l_scales)
+            K_y=torch.exp(-0.5*Dist_y/l_scales)
+            #Contract over the context points --> shape (batch_size,self.n_scales,C,self.n_y_axis,self.n_x_axis):
+            K_y_Y=K_y.unsqueeze(2)*Expand_Y.permute(0,2,1).view(batch_size,1,C,1,n)
+            Feature_Map=torch.matmul(K_y_Y,K_x.transpose(2,3).unsqueeze(2))
+        else:
+            #Squared distances between grid and context points --> shape (batch_size,1,self.n_y_axis*self.n_x_axis,n):
+            Dist_mat=GP.batch_sq_dist(self.grid.unsqueeze(0).expand(batch_size,self.n_y_axis*self.n_x_axis,2),X).unsqueeze(1)
+            #Kernel sums for all length scales --> shape (batch_size,self.n_scales,self.n_y_axis*self.n_x_axis,C):
+            Feature_Map=torch.matmul(torch.exp(-0.5*Dist_mat/l_scales),Expand_Y.unsqueeze(1))
+            Feature_Map=Feature_Map.view(batch_size,self.n_scales,self.n_y_axis,self.n_x_axis,C).permute(0,1,4,2,3)
+        return(Feature_Map.reshape(batch_size,self.n_scales*C,self.n_y_axis,self.n_x_axis))
+
+    #Approximation of the feature map by spreading the points onto the grid (bilinear weights) and a convolution of the grid
+    #with the discretized rbf kernel (separable, truncated where the kernel is below tol) - O(n+n_y_axis*n_x_axis*kernel size).
+    #Context points outside of the grid are dropped, i.e. like all mass outside of the grid they do not contribute 
+    #(unlike the "dense" method, which takes them into account exactly):
+    def splat_feature_map(self,X,Expand_Y,l_scale,tol=1e-4):
+        '''
+        Inputs:
+            X: torch.Tensor - shape (batch_size,n,2)
+            Expand_Y: torch.Tensor - shape (batch_size,n,C)
+            l_scale: torch.Tensor - length scale
+            tol: float - truncation of the convolution kernel
+        Outputs:
+            torch.Tensor - shape (batch_size,C,self.n_y_axis,self.n_x_axis) - unnormalized feature map
+        '''
+        batch_size,n,C=Expand_Y.size()
+        #Get the axes of the grid (the y-axis of the grid is decreasing, so it is flipped for the interpolation):
+        x_axis=self.grid[:self.n_x_axis,0]
+        y_axis=self.grid[::self.n_x_axis,1].flip(0)
+        #Spread the points onto the grid --> shape (batch_size,C,self.n_y_axis,self.n_x_axis) (y-axis decreasing again):
+        Ind,Weights=GP.grid_interpolation_weights(X,x_axis,y_axis,outside="drop")
+        Splat=GP.ski_scatter(Expand_Y,Ind,Weights,self.n_y_axis*self.n_x_axis)
+        Splat=Splat.view(batch_size,self.n_y_axis,self.n_x_axis,C).flip(1).permute(0,3,1,2)
+        #Discretized kernels along the axes truncated at the radius where the weights are below tol:
+        radius=math.sqrt(2*l_scale.item()*math.log(1/tol))
+        k_x=min(int(math.ceil(radius/abs((x_axis[1]-x_axis[0]).item()))),self.n_x_axis-1)
+        k_y=min(int(math.ceil(radius/abs((y_axis[1]-y_axis[0]).item()))),self.n_y_axis-1)
+        Offsets_x=(x_axis[1]-x_axis[0])*torch.arange(-k_x,k_x+1,device=X.device,dtype=X.dtype)
+        Offsets_y=(y_axis[1]-y_axis[0])*torch.arange(-k_y,k_y+1,device=X.device,dtype=X.dtype)
+        Kernel_x=torch.exp(-0.5*Offsets_x**2/l_scale).view(1,1,1,-1)
+        Kernel_y=torch.exp(-0.5*Offsets_y**2/l_scale).view(1,1,-1,1)
+        #Separable convolution of every channel (zero padding, there is no mass outside of the grid):
+        Splat=Splat.reshape(batch_size*C,1,self.n_y_axis,self.n_x_axis)
+        Splat=F.conv2d(F.conv2d(Splat,Kernel_x,padding=(0,k_x)),Kernel_y,padding=(k_y,0))
+        return(Splat.view(batch_size,C,self.n_y_axis,self.n_x_axis))
+
+    #Error of the Fourier feature approximation ("rff" method) of the (unnormalized) feature map against the exact one:
+    def approximation_error(self,X,Y):
+        '''
+        Inputs:
+            X: torch.Tensor - shape (batch_size,n,2)
+            Y: torch.Tensor - shape (batch_size,n,dim_Y)
+        Outputs:
+            see GP.rff_approximation_error
+        '''
+        if self.method!="rff":
+            sys.exit("Encoder error: approximation error only for the rff method.")
+        batch_size=X.size(0)
+        return(GP.rff_approximation_error(X,self.expand_with_ones(Y),self.grid.unsqueeze(0).expand(batch_size,self.n_y_axis*self.n_x_axis,2),
+                                          self.frequencies,normalize=False,l_scale=torch.exp(self.log_l_scale)))
+
+    #If all context points lie on a fixed lattice, the rbf kernel between lattice and grid is precomputed:
+    def set_lattice(self,Lattice):
+        '''
+        Input: Lattice - torch.Tensor or None - shape (n_lattice,2) - coordinates of the lattice points 
+                         (then forward also accepts X as indices of the lattice points, shape (batch_size,n)), None - no lattice
+        '''
+        self.lattice_table=GP.LatticeKernelTable(Lattice,self.grid) if Lattice is not None else None
+
+    def lattice_feature_map(self,Ind,Expand_Y,l_scale):
+        '''
+        Inputs:
+            Ind: torch.Tensor of ints - shape (batch_size,n) - indices of the context points in the lattice
+            Expand_Y: torch.Tensor - shape (batch_size,n,C)
+            l_scale: torch.Tensor - shape () or (self.n_scales) - length scale(s)
+        Outputs:
+            torch.Tensor - shape (batch_size,self.n_scales*C,self.n_y_axis,self.n_x_axis) - unnormalized feature map (exact rbf kernel)
+        '''
+        batch_size,n,C=Expand_Y.size()
+        Table,_=self.lattice_table.give_table(l_scale)
+        #Kernel weights between context and grid points --> shape (batch_size,self.n_scales,n,self.n_y_axis*self.n_x_axis):
+        Weights=Table[:,Ind].transpose(0,1)
+        #Kernel sums for all length scales --> shape (batch_size,self.n_scales,self.n_y_axis*self.n_x_axis,C):
+        Feature_Map=torch.matmul(Weights.transpose(2,3),Expand_Y.unsqueeze(1))
+        Feature_Map=Feature_Map.view(batch_size,self.n_scales,self.n_y_axis,self.n_x_axis,C).permute(0,1,4,2,3)
+        return(Feature_Map.reshape(batch_size,self.n_scales*C,self.n_y_axis,self.n_x_axis))
+
+    #Exact computation of the feature map for the rbf kernel using that it factorizes along the axes of the grid:
+    #k(x',x)=exp(-0.5*(x'_1-x_1)^2/l_scale)*exp(-0.5*(x'_2-x_2)^2/l_scale)
+    def separable_feature_map(self,X,Expand_Y,l_scale):
+        '''
+        Inputs:
+            X: torch.Tensor - shape (batch_size,n,2)
+            Expand_Y: torch.Tensor - shape (batch_size,n,C)
+            l_scale: torch.Tensor - length scale
+        Outputs:
+            torch.Tensor - shape (batch_size,C,self.n_y_axis,self.n_x_axis) - unnormalized feature map
+        '''
+        #Get the axes of the grid:
+        x_axis=self.grid[:self.n_x_axis,0]
+        y_axis=self.grid[::self.n_x_axis,1]
+        #Kernel factors along the axes --> shape (batch_size,self.n_x_axis,n) and (batch_size,self.n_y_axis,n):
+        K_x=torch.exp(-0.5*(x_axis.view(1,-1,1)-X[:,:,0].unsqueeze(1))**2/l_scale)
+        K_y=torch.exp(-0.5*(y_axis.view(1,-1,1)-X[:,:,1].unsqueeze(1))**2/l_scale)
+        #Multiply the y-factors with the features --> shape (batch_size,C,self.n_y_axis,n):
+        K_y_Y=K_y.unsqueeze(1)*Expand_Y.permute(0,2,1).unsqueeze(2)
+        #Contract with the x-factors over the context points --> shape (batch_size,C,self.n_y_axis,self.n_x_axis):
+        return(torch.matmul(K_y_Y,K_x.transpose(1,2).unsqueeze(1)))
     
     def plot_embedding(self,Embedding,X_context=None,Y_context=None,title="",quiver_scale=1.,size_scale=2):
         '''
@@ -193,9 +451,14 @@ class EquivEncoder(nn.Module):
             'n_x_axis':self.n_x_axis,
             'y_range':self.y_range,
             'n_y_axis':self.n_y_axis,
-            'l_scale': torch.exp(self.log_l_scale).item(),
+            'l_scale': torch.exp(self.log_l_scale).flatten()[0].item(),
+            'l_scales': torch.exp(self.log_l_scale).tolist() if self.l_scales is not None else None,
             'normalize': self.normalize,
-            'train_l_scale': self.train_l_scale
+            'train_l_scale': self.train_l_scale,
+            'memory_budget': self.memory_budget,
+            'method': self.method,
+            'recompute_kernel': self.recompute_kernel,
+            'n_features': self.n_features
         }
         return(dictionary)
 
@@ -0,0 +1,129 @@
+import torch
+import torch.utils.data as utils
+import torch.nn.functional as F
+import numpy as np
+
+import sys
+import argparse
+import datetime
+sys.path.append('../..')
+
+#Own files:
+import kernel_and_gp_tools as GP
+import my_utils
+import tasks.ERA5.era5_dataset as dataset
+
+#Set device:
+if torch.cuda.is_available():
+    DEVICE = torch.device("cuda:0")
+    print("Running on the GPU")
+else:
+    DEVICE = torch.device("cpu")
+    print("Running on the CPU")
+
+# Construct the argument parser
+ap = argparse.ArgumentParser()
+ap.set_defaults(
+    N_MAPS=100,
+    N_POINTS=200,
+    N_STARTS=8,
+    N_ITERAT=300,
+    LR=0.05,
+    data_SET='train',
+    FILENAME="GP_hyperparameters.pt")
+
+#Arguments for task:
+ap.add_argument("-data", "--data_SIZE", type=str, required=True,help="Size of data set. 'big' or 'small'.")
+ap.add_argument("-mode","--data_SET",type=str,required=False,help="Type of data set: 'train', 'val', or 'test'")
+ap.add_argument("-n_maps", "--N_MAPS", type=int, required=False,help="Number of maps used for fitting.")
+ap.add_argument("-n_points", "--N_POINTS", type=int, required=False,help="Number of points per map used for fitting.")
+ap.add_argument("-n_starts", "--N_STARTS", type=int, required=False,help="Number of random initializations (optimized jointly).")
+ap.add_argument("-n_iterat", "--N_ITERAT", type=int, required=False,help="Number of optimization steps.")
+ap.add_argument("-lr", "--LR", type=float, required=False,help="Learning rate.")
+ap.add_argument("-file", "--FILENAME", type=str, required=False,help="File to save the fitted hyperparameters (read by run_gp.py -hyper).")
+
+#Pass the arguments:
+ARGS = vars(ap.parse_args())
+
+
+#Maximize the mean log marginal likelihood over the maps for several initializations at once:
+def fit_gp_hyperparameters(X,Y,device,n_starts=8,n_iterat=300,lr=0.05):
+    '''
+    Input: X - torch.tensor - shape (n_maps,n_points,2) - locations
+           Y - torch.tensor - shape (n_maps,n_points,D) - values (the same components as evaluated by run_gp.py)
+           n_starts - int - number of random initializations
+           n_iterat - int - number of optimization steps
+           lr - float - learning rate
+    Output: dict - fitted hyperparameters of the best initialization (keys 'l_scale','sigma_var','obs_noise')
+            float - mean log marginal likelihood per map of the best initialization
+    '''
+    n_maps=X.size(0)
+    X=X.to(device).repeat(n_starts,1,1)
+    Y=Y.to(device).repeat(n_starts,1,1)
+    #Random initializations (log-uniform) of the hyperparameters --> shape (n_starts):
+    log_l_scale=torch.empty(n_starts,device=device).uniform_(np.log(1.),np.log(100.)).requires_grad_()
+    log_sigma_var=torch.empty(n_starts,device=device).uniform_(np.log(0.1),np.log(10.)).requires_grad_()
+    log_obs_noise=torch.empty(n_starts,device=device).uniform_(np.log(1e-3),np.log(1.)).requires_grad_()
+    optimizer=torch.optim.Adam([log_l_scale,log_sigma_var,log_obs_noise],lr=lr)
+
+    #Expand the hyperparameters of every initialization to all maps --> shape (n_starts*n_maps,1,1):
+    def expand(log_param):
+        return(torch.exp(log_param).repeat_interleave(n_maps).view(-1,1,1))
+
+    #Mean log marginal likelihood over the maps for every initialization --> shape (n_starts):
+    def mean_log_ml():
+        log_ml=GP.batch_gp_log_marginal_likelihood(X,Y,l_scale=expand(log_l_scale),sigma_var=expand(log_sigma_var),
+                                                   kernel_type="rbf",obs_noise=expand(log_obs_noise))
+        return(log_ml.view(n_starts,n_maps).mean(dim=1))
+
+    for it in range(n_iterat):
+        optimizer.zero_grad()
+        log_ml=mean_log_ml()
+        #The initializations are independent, so the sum can be optimized:
+        loss=-log_ml.sum()
+        loss.backward()
+        optimizer.step()
+        if it%50==0:
+            print("Iteration: ", it, " | Best log marginal likelihood: ", log_ml.max().item())
+
+    #Evaluate the parameters after the last step (which are the ones returned):
+    with torch.no_grad():
+        log_ml=mean_log_ml()
+    best=log_ml.argmax()
+    GP_parameters={'l_scale':torch.exp(log_l_scale[best]).item(),
+                   'sigma_var':torch.exp(log_sigma_var[best]).item(),
+                   'obs_noise':torch.exp(log_obs_noise[best]).item()}
+    return(GP_parameters,log_ml[best].item())
+
+
+#Fixed hyperparameters:
+MIN_N_CONT=5
+MAX_N_CONT=50
+
+if ARGS['data_SIZE']=='small':
+        PATH_TO_TRAIN_FILE="../../tasks/ERA5/ERA5_US/data/Train_Small_ERA5_US.nc"
+        PATH_TO_VAL_FILE="../../tasks/ERA5/ERA5_US/data/Valid_Small_ERA5_US.nc"
+elif ARGS['data_SIZE']=='big':
+        PATH_TO_TRAIN_FILE="../../tasks/ERA5/ERA5_US/data/Train_Big_ERA5_US.nc"
+        PATH_TO_VAL_FILE="../../tasks/ERA5/ERA5_US/data/Valid_Big_ERA5_US.nc"
+else:
+    sys.exit("Unknown data set.")
+
+if ARGS['data_SET']=='train':
+    dataset=dataset.ERA5Dataset(PATH_TO_TRAIN_FILE,MIN_N_CONT,MAX_N_CONT,place='US',normalize=True,circular=True)
+elif ARGS['data_SET']=='val':
+    dataset=dataset.ERA5Dataset(PATH_TO_VAL_FILE,MIN_N_CONT,MAX_N_CONT,place='US',normalize=True,circular=True)
+else:
+    sys.exit("Unknown train mode.")
+
+#Get random maps with N_POINTS random points each (only the wind components which are evaluated by run_gp.py):
+inds=torch.randperm(dataset.n_obs)[:ARGS['N_MAPS']]
+X,Y,_,_=dataset.get_batch(inds=inds,n_context_points=ARGS['N_POINTS'],cont_in_target=False)
+Y=Y[:,:,2:]
+
+print("Start time:", datetime.datetime.today())
+GP_parameters,log_ml=fit_gp_hyperparameters(X,Y,DEVICE,ARGS['N_STARTS'],ARGS['N_ITERAT'],ARGS['LR'])
+print("End time: ", datetime.datetime.today())
+print("Fitted GP parameters: ", GP_parameters)
+print("Mean log marginal likelihood per map: ", log_ml)
+torch.save(GP_parameters,f=ARGS['FILENAME'])
@@ -27,6 +27,11 @@ ap = argparse.ArgumentParser()
 ap.set_defaults(
     N_SAMPLES=None,
     BATCH_SIZE=30,
+    N_INDUCING=None,
+    N_SKI=None,
+    HYPER_FILE=None,
+    MIN_N_CONT=5,
+    MAX_N_CONT=50,
     N_data_PASSES=1,
     data_SET='train')
 
@@ -34,18 +39,23 @@ ap.set_defaults(
 ap.add_argument("-n_passes", "--N_data_PASSES", type=int, required=False,help="Number of data passes.")
 ap.add_argument("-n_samples", "--N_SAMPLES", type=int, required=False,help="Number of data samples (only not None for debugging).")
 ap.add_argument("-batch", "--BATCH_SIZE", type=int, required=False,help="Batch size.")
+ap.add_argument("-n_inducing", "--N_INDUCING", type=int, required=False,help="Number of inducing points per axis on a grid (sparse GP, exact GP if not given).")
+ap.add_argument("-n_ski", "--N_SKI", type=int, required=False,help="Number of grid points per axis for structured kernel interpolation (SKI GP, only rbf).")
+ap.add_argument("-min_cont", "--MIN_N_CONT", type=int, required=False,help="Minimum number of context points.")
+ap.add_argument("-max_cont", "--MAX_N_CONT", type=int, required=False,help="Maximum number of context points.")
 ap.add_argument("-data", "--data_SIZE", type=str, required=True,help="Size of data set. 'big' or 'small'.")
 ap.add_argument("-mode","--data_SET",type=str,required=False,help="Type of data set: 'train', 'val', or 'test'")
-ap.add_argument("-lscale", "--LSCALE", type=float, required=True,help="L scale of kernel.")
-ap.add_argument("-sigma", "--SIGMA", type=float, required=True,help="Sigma scale of kernel.")
-ap.add_argument("-noise", "--NOISE", type=float, required=True,help="Noise scale of kernel.")
+ap.add_argument("-lscale", "--LSCALE", type=float, required=False,help="L scale of kernel.")
+ap.add_argument("-sigma", "--SIGMA", type=float, required=False,help="Sigma scale of kernel.")
+ap.add_argument("-noise", "--NOISE", type=float, required=False,help="Noise scale of kernel.")
+ap.add_argument("-hyper", "--HYPER_FILE", type=str, required=False,help="File with fitted hyperparameters (see fit_gp_hyperparameters.py), replaces -lscale, -sigma and -noise.")
 
 #Pass the arguments:
 ARGS = vars(ap.parse_args())
 
 
 #Compute the log-ll of the GP posterior on the data by sampling:
-def compute_gp_log_ll(GP_parameters,dataset,device,n_samples=None,batch_size=1,n_data_passes=1):
+def compute_gp_log_ll(GP_parameters,dataset,device,n_samples=None,batch_size=1,n_data_passes=1,X_Inducing=None,SKI_Axis=None):
         with torch.no_grad():
             n_obs=dataset.n_obs
             if n_samples is None: 
@@ -69,18 +79,18 @@ def compute_gp_log_ll(GP_parameters,dataset,device,n_samples=None,batch_size=1,n
                     y_target=y_target.to(device)
 
                     #The target set includes the context set here:
-                    Means_list=[]
-                    Sigmas_list=[]
                     B=torch.eye(4).to(device)
-                    for b in range(batch_size):
-                        Means,Sigmas,_=GP.gp_inference(x_context[b],y_context[b],x_target[b],**GP_parameters,B=B)
-                        Means=Means[:,2:]
-                        Means_list.append(Means)
-                        Sigmas=my_utils.get_block_diagonal(Sigmas,size=4)
-                        Sigmas=Sigmas[:,2:,2:]
-                        Sigmas_list.append(Sigmas)
-                    Means=torch.stack(Means_list,dim=0)
-                    Sigmas=torch.stack(Sigmas_list,dim=0)
+                    if SKI_Axis is not None:
+                        Means,Sigmas,_=GP.batch_ski_gp_inference(x_context,y_context,x_target,SKI_Axis.to(device),SKI_Axis.to(device),
+                                                                 l_scale=GP_parameters['l_scale'],sigma_var=GP_parameters['sigma_var'],
+                                                                 obs_noise=GP_parameters['obs_noise'],B=B)
+                    elif X_Inducing is None:
+                        Means,Sigmas,_=GP.batch_gp_inference(x_context,y_context,x_target,**GP_parameters,B=B,full_cov=False)
+                    else:
+                        X_Inducing_Batch=X_Inducing.to(device).unsqueeze(0).expand(x_context.size(0),X_Inducing.size(0),2)
+                        Means,Sigmas,_=GP.batch_sparse_gp_inference(x_context,y_context,x_target,X_Inducing_Batch,**GP_parameters,B=B)
+                    Means=Means[:,:,2:]
+                    Sigmas=Sigmas[:,:,2:,2:]
 
                     log_ll_it=my_utils.batch_multivar_log_ll(Means,Sigmas,y_target)
                     log_ll+=log_ll_it.mean()/n_iterat
@@ -89,8 +99,8 @@ def compute_gp_log_ll(GP_parameters,dataset,device,n_samples=None,batch_size=1,n
 
 
 #Fixed hyperparameters:
-MIN_N_CONT=5
-MAX_N_CONT=50
+MIN_N_CONT=ARGS['MIN_N_CONT']
+MAX_N_CONT=ARGS['MAX_N_CONT']
 
 if ARGS['data_SIZE']=='small':
         PATH_TO_TRAIN_FILE="../../tasks/ERA5/ERA5_US/data/Train_Small_ERA5_US.nc"
@@ -114,14 +124,36 @@ elif ARGS['data_SET']=='testChina':
     dataset=dataset.ERA5Dataset(PATH_TO_TEST_CHINA_FILE,MIN_N_CONT,MAX_N_CONT,place='China',normalize=True,circular=True)
 else:                                                                                                                                                                                                                  sys.exit("Unknown train mode.")
 
+if ARGS['HYPER_FILE'] is not None:
+    Fitted_parameters=torch.load(f=ARGS['HYPER_FILE'])
+    ARGS['LSCALE']=Fitted_parameters['l_scale']
+    ARGS['SIGMA']=Fitted_parameters['sigma_var']
+    ARGS['NOISE']=Fitted_parameters['obs_noise']
+if ARGS['LSCALE'] is None or ARGS['SIGMA'] is None or ARGS['NOISE'] is None:
+    sys.exit("Either -hyper or -lscale, -sigma and -noise have to be given.")
+
 GP_parameters={'l_scale':ARGS['LSCALE'],
 'sigma_var': ARGS['SIGMA'], 
 'kernel_type':"rbf",
 'obs_noise':ARGS['NOISE']}
 
 print("GP parameters: ", GP_parameters)
+#Inducing points on a grid over the (normalized) domain [-10,10]^2 for the sparse GP:
+if ARGS['N_INDUCING'] is not None:
+    X_INDUCING=my_utils.give_2d_grid(min_x=-10,max_x=10,n_x_axis=ARGS['N_INDUCING'],flatten=True)
+else:
+    X_INDUCING=None
+#Axis of the interpolation grid over the (normalized) domain [-10,10]^2 for the SKI GP 
+#(padded by one grid spacing, all points have to lie in the interpolation grid):
+if ARGS['N_SKI'] is not None:
+    if GP_parameters['kernel_type']!="rbf":
+        sys.exit("SKI GP only for the rbf kernel.")
+    SKI_AXIS=my_utils.padded_axis(-10,10,ARGS['N_SKI'],n_pad=1)
+else:
+    SKI_AXIS=None
+
 print("Start time:", datetime.datetime.today())   
-log_ll=compute_gp_log_ll(GP_parameters,dataset,DEVICE,ARGS['N_SAMPLES'],ARGS['BATCH_SIZE'],ARGS['N_data_PASSES'])
+log_ll=compute_gp_log_ll(GP_parameters,dataset,DEVICE,ARGS['N_SAMPLES'],ARGS['BATCH_SIZE'],ARGS['N_data_PASSES'],X_INDUCING,SKI_AXIS)
 print("Mean log-likelihood on data set:")
 print(log_ll)
 
@@ -0,0 +1,46 @@
+import torch
+import numpy as np
+
+import sys
+import argparse
+sys.path.append('../..')
+
+#Own files:
+import kernel_and_gp_tools as GP
+import my_utils
+
+'''
+Compares the empirical covariance of samples of GP.potential_circulant_sampler_2d with the div-free/curl-free kernel
+(GP.gram_matrix) on a regular grid. The error of the empirical covariance decays like 1/sqrt(n_samples).
+'''
+
+# Construct the argument parser
+ap = argparse.ArgumentParser()
+ap.set_defaults(
+    KERNEL_TYPE="div_free",
+    N_GRID_POINTS=15,
+    L_SCALE=5.,
+    N_SAMPLES=100000)
+
+ap.add_argument("-kernel", "--KERNEL_TYPE", type=str, required=False,help="Kernel type: 'div_free' or 'curl_free'.")
+ap.add_argument("-n_grid", "--N_GRID_POINTS", type=int, required=False,help="Number of grid points per axis on [-10,10].")
+ap.add_argument("-lscale", "--L_SCALE", type=float, required=False,help="Length scale of the kernel.")
+ap.add_argument("-n_samples", "--N_SAMPLES", type=int, required=False,help="Number of samples for the empirical covariance.")
+
+#Pass the arguments:
+ARGS = vars(ap.parse_args())
+
+#Samples without observation noise --> shape (N_SAMPLES,N_GRID_POINTS**2*2):
+Y=GP.potential_circulant_sampler_2d(ARGS['N_SAMPLES'],min_x=-10,max_x=10,n_x_axis=ARGS['N_GRID_POINTS'],l_scale=ARGS['L_SCALE'],
+                                    kernel_type=ARGS['KERNEL_TYPE'],obs_noise=0.)
+Y=Y.view(ARGS['N_SAMPLES'],-1).double()
+Cov_emp=torch.matmul(Y.t(),Y)/ARGS['N_SAMPLES']
+
+#Kernel matrix on the grid (same ordering of the points):
+X_Grid=my_utils.give_2d_grid(min_x=-10,max_x=10,n_x_axis=ARGS['N_GRID_POINTS'],flatten=True).double()
+Gram_Mat=GP.gram_matrix(X_Grid,l_scale=ARGS['L_SCALE'],kernel_type=ARGS['KERNEL_TYPE'])
+
+Error=Cov_emp-Gram_Mat
+print("Relative error (Frobenius norm): ", (Error.norm()/Gram_Mat.norm()).item())
+print("Maximum absolute error: ", Error.abs().max().item())
+print("Maximum kernel value: ", Gram_Mat.abs().max().item())
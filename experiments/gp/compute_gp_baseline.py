@@ -27,6 +27,11 @@ ap.set_defaults(
     data=None,
     N_SAMPLES=None,
     BATCH_SIZE=30,
+    N_INDUCING=None,
+    N_SKI=None,
+    MIN_N_CONT=5,
+    MAX_N_CONT=50,
+    CURVE=False,
     N_data_PASSES=30)
 
 #Arguments for task:
@@ -34,56 +39,95 @@ ap.add_argument("-data", "--data", type=str, required=True,help="data to use.")
 ap.add_argument("-n_passes", "--N_data_PASSES", type=int, required=False,help="Number of data passes.")
 ap.add_argument("-n_samples", "--N_SAMPLES", type=int, required=False,help="Number of data samples (only not None for debugging).")
 ap.add_argument("-batch", "--BATCH_SIZE", type=int, required=False,help="Batch size.")
+ap.add_argument("-n_inducing", "--N_INDUCING", type=int, required=False,help="Number of inducing points per axis on a grid (sparse GP, exact GP if not given).")
+ap.add_argument("-n_ski", "--N_SKI", type=int, required=False,help="Number of grid points per axis for structured kernel interpolation (SKI GP, only rbf).")
+ap.add_argument("-min_cont", "--MIN_N_CONT", type=int, required=False,help="Minimum number of context points.")
+ap.add_argument("-max_cont", "--MAX_N_CONT", type=int, required=False,help="Maximum number of context points.")
+ap.add_argument("-curve", "--CURVE", type=bool, required=False,help="Compute the log-likelihood for every number of context points (exact GP).")
 
 
 #Pass the arguments:
 ARGS = vars(ap.parse_args())
 
 
+#Average a per-batch log-ll over random minibatches of the data set (the loop shared by compute_gp_log_ll and compute_gp_log_ll_curve):
+def average_over_batches(batch_log_ll,dataset,device,n_samples=None,batch_size=1,n_data_passes=1,n_context_points=None):
+    '''
+    Input: batch_log_ll - function - maps x_context,y_context,x_target,y_target (on device) to a torch.tensor 
+                          (mean log-ll of the minibatch, e.g. shape () or one value per number of context points)
+           dataset - GP data set
+           n_samples - int or None - number of observations per data pass (all if None)
+           n_context_points - int or None - number of context points of the minibatches (random if None)
+    Output: torch.tensor - mean of batch_log_ll over all minibatches and data passes
+    '''
+    with torch.no_grad():
+        n_obs=dataset.n_obs
+        if n_samples is None: 
+            n_samples=n_obs
+        n_samples_max=min(n_samples,n_obs)
+        n_iterat=max(n_samples_max//batch_size,1)
+        log_ll=0.
+
+        for j in range(n_data_passes):
+            ind_list=torch.randperm(n_obs)[:n_samples_max]
+            batch_ind_list=[ind_list[j*batch_size:(j+1)*batch_size] for j in range(n_iterat)]
+
+            for it in range(n_iterat):
+                #Get random minibatch:
+                x_context,y_context,x_target,y_target=dataset.get_batch(inds=batch_ind_list[it],n_context_points=n_context_points,cont_in_target=False)
+                
+                #Load data to device:
+                x_context=x_context.to(device)
+                y_context=y_context.to(device)
+                x_target=x_target.to(device)
+                y_target=y_target.to(device)
+
+                log_ll=log_ll+batch_log_ll(x_context,y_context,x_target,y_target)/n_iterat
+                                    
+    return(log_ll/n_data_passes)
+
 #Compute the log-ll of the GP posterior on the data by sampling:
-def compute_gp_log_ll(GP_parameters,dataset,device,n_samples=None,batch_size=1,n_data_passes=1):
-        with torch.no_grad():
-            n_obs=dataset.n_obs
-            if n_samples is None: 
-                n_samples=n_obs
-            n_samples_max=min(n_samples,n_obs)
-            n_iterat=max(n_samples_max//batch_size,1)
-            log_ll=torch.tensor(0.0, device=device)
-
-            for j in range(n_data_passes):
-                ind_list=torch.randperm(n_obs)[:n_samples_max]
-                batch_ind_list=[ind_list[j*batch_size:(j+1)*batch_size] for j in range(n_iterat)]
-
-                for it in range(n_iterat):
-                    #Get random minibatch:
-                    x_context,y_context,x_target,y_target=dataset.get_batch(inds=batch_ind_list[it],cont_in_target=False)
-                    
-                    #Load data to device:
-                    x_context=x_context.to(device)
-                    y_context=y_context.to(device)
-                    x_target=x_target.to(device)
-                    y_target=y_target.to(device)
-
-                    #The target set includes the context set here:
-                    Means_list=[]
-                    Sigmas_list=[]
-                    for b in range(batch_size):
-                        Means,Sigmas,_=GP.gp_inference(x_context[b],y_context[b],x_target[b],**GP_parameters)
-                        Means_list.append(Means)
-                        Sigmas=my_utils.get_block_diagonal(Sigmas,size=2)
-                        Sigmas_list.append(Sigmas)
-                    Means=torch.stack(Means_list,dim=0)
-                    Sigmas=torch.stack(Sigmas_list,dim=0)
-                    log_ll_it=my_utils.batch_multivar_log_ll(Means,Sigmas,y_target)
-                    log_ll+=log_ll_it.mean()/n_iterat
-                                        
-        return(log_ll.item()/n_data_passes)
+def compute_gp_log_ll(GP_parameters,dataset,device,n_samples=None,batch_size=1,n_data_passes=1,X_Inducing=None,SKI_Axis=None):
+    def batch_log_ll(x_context,y_context,x_target,y_target):
+        #The target set includes the context set here:
+        if SKI_Axis is not None:
+            Means,Sigmas,_=GP.batch_ski_gp_inference(x_context,y_context,x_target,SKI_Axis.to(device),SKI_Axis.to(device),
+                                                     l_scale=GP_parameters['l_scale'],sigma_var=GP_parameters['sigma_var'],
+                                                     obs_noise=GP_parameters['obs_noise'])
+        elif X_Inducing is None:
+            Means,Sigmas,_=GP.batch_gp_inference(x_context,y_context,x_target,**GP_parameters,full_cov=False)
+        else:
+            X_Inducing_Batch=X_Inducing.to(device).unsqueeze(0).expand(x_context.size(0),X_Inducing.size(0),2)
+            Means,Sigmas,_=GP.batch_sparse_gp_inference(x_context,y_context,x_target,X_Inducing_Batch,**GP_parameters)
+        return(my_utils.batch_multivar_log_ll(Means,Sigmas,y_target).mean())
+
+    log_ll=average_over_batches(batch_log_ll,dataset,device,n_samples,batch_size,n_data_passes)
+    return(log_ll.item())
+
+#Compute the log-ll of the GP posterior for every number of context points from min_n_cont to max_n_cont 
+#(the context points are added incrementally to the same posterior, the target set is the same for all sizes):
+def compute_gp_log_ll_curve(GP_parameters,dataset,device,min_n_cont,max_n_cont,n_samples=None,batch_size=1,n_data_passes=1):
+    def batch_log_ll(x_context,y_context,x_target,y_target):
+        log_ll=torch.zeros(max_n_cont-min_n_cont+1,device=device)
+        #Add the first min_n_cont context points at once and the others one by one:
+        Posterior=GP.IncrementalGP(x_target,max_n_cont,D=y_context.size(2),**GP_parameters)
+        Posterior.add_context(x_context[:,:min_n_cont],y_context[:,:min_n_cont])
+        for n in range(min_n_cont,max_n_cont+1):
+            if n>min_n_cont:
+                Posterior.add_context(x_context[:,n-1:n],y_context[:,n-1:n])
+            Means,Sigmas,_=Posterior.predict()
+            log_ll[n-min_n_cont]=my_utils.batch_multivar_log_ll(Means,Sigmas,y_target).mean()
+        return(log_ll)
+
+    #The minibatches have the maximal number of context points:
+    log_ll=average_over_batches(batch_log_ll,dataset,device,n_samples,batch_size,n_data_passes,n_context_points=max_n_cont)
+    return(log_ll.cpu())
 
 
 #Fixed hyperparameters:
 FILEPATH="../../tasks/gp/"
-MIN_N_CONT=5
-MAX_N_CONT=50
+MIN_N_CONT=ARGS['MIN_N_CONT']
+MAX_N_CONT=ARGS['MAX_N_CONT']
 
 dataSET=dataLoader.give_gp_data_set(MIN_N_CONT,MAX_N_CONT,ARGS['data'],'test',file_path=FILEPATH)                 
 
@@ -107,13 +151,34 @@ elif ARGS['data']=='curl_free':
 else: 
     sys.exit("Unknown data type.")
 
+#Inducing points on a grid over the (normalized) domain [-10,10]^2 for the sparse GP:
+if ARGS['N_INDUCING'] is not None:
+    X_INDUCING=my_utils.give_2d_grid(min_x=-10,max_x=10,n_x_axis=ARGS['N_INDUCING'],flatten=True)
+else:
+    X_INDUCING=None
+#Axis of the interpolation grid over the (normalized) domain [-10,10]^2 for the SKI GP 
+#(padded by one grid spacing, all points have to lie in the interpolation grid):
+if ARGS['N_SKI'] is not None:
+    if GP_parameters['kernel_type']!="rbf":
+        sys.exit("SKI GP only for the rbf kernel.")
+    SKI_AXIS=my_utils.padded_axis(-10,10,ARGS['N_SKI'],n_pad=1)
+else:
+    SKI_AXIS=None
+
 print("Start time:", datetime.datetime.today())
 #Run:
-log_ll=compute_gp_log_ll(GP_parameters,dataSET,DEVICE,ARGS['N_SAMPLES'],ARGS['BATCH_SIZE'],ARGS['N_data_PASSES'])
+if ARGS['CURVE']:
+    log_ll_curve=compute_gp_log_ll_curve(GP_parameters,dataSET,DEVICE,MIN_N_CONT,MAX_N_CONT,ARGS['N_SAMPLES'],ARGS['BATCH_SIZE'],ARGS['N_data_PASSES'])
+    #Print:
+    print("Mean log-likelihood on validation data set per number of context points:")
+    for n in range(MIN_N_CONT,MAX_N_CONT+1):
+        print(n, log_ll_curve[n-MIN_N_CONT].item())
+else:
+    log_ll=compute_gp_log_ll(GP_parameters,dataSET,DEVICE,ARGS['N_SAMPLES'],ARGS['BATCH_SIZE'],ARGS['N_data_PASSES'],X_INDUCING,SKI_AXIS)
 
-#Print:
-print("Mean log-likelihood on validation data set:")
-print(log_ll)
+    #Print:
+    print("Mean log-likelihood on validation data set:")
+    print(log_ll)
 print("End time: ", datetime.datetime.today())
 print("GP data set with kernel: ", ARGS['data'])
 print("Number of data passes: ", ARGS['N_data_PASSES'])
@@ -7,6 +7,7 @@ sys.path.append(os.getcwd())
 import torch
 import torch.utils.data as utils
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 
 #Plotting in 2d/3d:
@@ -18,6 +19,7 @@ import matplotlib.cm as cm
 
 #Tools:
 from itertools import product, combinations
+from abc import ABC, abstractmethod
 import math
 from numpy import savetxt
 import csv
@@ -37,6 +39,121 @@ ________________________________________________________________________________
 ----------------------------KERNEL TOOLS -------------------------------------------------------------------------
 ____________________________________________________________________________________________________________________
 '''
+#This function gives the squared Euclidean distances between the points of two data sets X and Y 
+#(computed via the expansion |x-y|^2=|x|^2+|y|^2-2<x,y>, i.e. without a (batch_size,n,m,d) intermediate):
+def batch_sq_dist(X,Y=None):
+    '''
+    Input:
+    X: torch.tensor - Shape: (batch_size,n,d)
+    Y: torch.tensor or None - Shape: (batch_size,m,d) (if None, set to X)
+    Output:
+    torch.tensor - Shape (batch_size,n,m) - entry (b,i,j) is |X[b,i]-Y[b,j]|^2
+    '''
+    if Y is None:
+        Y=X
+    #Squared norms --> shape (batch_size,n,1) and (batch_size,1,m):
+    X_norm=torch.sum(X*X,dim=2,keepdim=True)
+    Y_norm=torch.sum(Y*Y,dim=2).unsqueeze(1)
+    #Fused |x|^2+|y|^2-2<x,y> --> shape (batch_size,n,m):
+    Dist_mat=torch.baddbmm(X_norm+Y_norm,X,Y.transpose(1,2),alpha=-2)
+    #Rounding errors might give small negative values:
+    return(Dist_mat.clamp(min=0))
+
+#Cache of identity matrices used as constant buffers by the kernels (one per size, device and dtype):
+IDENTITY_CACHE={}
+def cached_eye(d,device=None,dtype=None):
+    '''
+    Input: d - int - size of the identity matrix
+           device, dtype - device and dtype of the identity matrix
+    Output: torch.tensor - shape (d,d) - identity matrix (shared, must not be modified in-place)
+    '''
+    dtype=torch.get_default_dtype() if dtype is None else dtype
+    key=(d,torch.device(device) if device is not None else torch.device("cpu"),dtype)
+    if key not in IDENTITY_CACHE:
+        IDENTITY_CACHE[key]=torch.eye(d,device=device,dtype=dtype)
+    return(IDENTITY_CACHE[key])
+
+'''
+Kernel objects: every kernel has one batched implementation "gram" giving the kernel matrix in the interleaved 
+layout (batch_size,n,D,m,D) and an attribute "separable" which is True if the kernel is of the form k(x,y)*B
+for a scalar kernel k - then "scalar_gram" gives the scalar Gram matrix (batch_size,n,m) which allows fast paths 
+(e.g. in the kernel smoothers and the GP inference) if B is a multiple of the identity.
+Parameters of all kernels:
+    l_scale - float or torch.tensor broadcastable to shape (batch_size,1,1) - squared length scale
+    sigma_var - float - variance (not used by dot_product, div_free and curl_free)
+    B - torch.tensor - shape (D,D) - matrix of separable kernels (not used by div_free and curl_free)
+'''
+class ScalarKernel(ABC):
+    separable=True
+    @abstractmethod
+    def scalar_gram(self,X,Y,l_scale=1,sigma_var=1):
+        pass
+
+    def gram(self,X,Y,l_scale=1,sigma_var=1,B=None):
+        batch_size,n,d=X.size()
+        m=Y.size(1)
+        if B is None:
+            B=cached_eye(d,X.device,X.dtype)
+        D=B.size(0)
+        #Multiply scalar Gram matrix with the matrix B (in the interleaved layout) --> shape (batch_size,n,D,m,D):
+        return(self.scalar_gram(X,Y,l_scale,sigma_var).view(batch_size,n,1,m,1)*B.view(1,1,D,1,D))
+
+class RBFKernel(ScalarKernel):
+    def scalar_gram(self,X,Y,l_scale=1,sigma_var=1):
+        return(sigma_var*torch.exp(-0.5*batch_sq_dist(X,Y)/l_scale))
+
+class DotProductKernel(ScalarKernel):
+    def scalar_gram(self,X,Y,l_scale=1,sigma_var=1):
+        return(torch.matmul(X,Y.transpose(1,2)))
+
+class DivFreeKernel(object):
+    '''
+    The following computations are based on equation (24) in
+    "Kernels for Vector-Valued Functions: a Review" by Alvarez et al:
+    K(x,y)=G/l*((x-y)(x-y)^T/l+(d-1-|x-y|^2/l)*I) where G=exp(-0.5*|x-y|^2/l)
+    '''
+    separable=False
+    #Scalar factors in front of the outer product and of the identity --> shape (batch_size,n,m):
+    def factors(self,Gram_RBF,Dist_mat,l_scale,d):
+        return(Gram_RBF/l_scale,Gram_RBF*(d-1-Dist_mat/l_scale))
+
+    def gram(self,X,Y,l_scale=1,sigma_var=1,B=None):
+        #Get the squared distances and the RBF matrix from that --> shape (batch_size,n,m)
+        Dist_mat=batch_sq_dist(X,Y)
+        Gram_RBF=torch.exp(-0.5*Dist_mat/l_scale)/l_scale
+        #Get the differences -->shape (batch_size,n,m,d):
+        Diff=X.unsqueeze(2)-Y.unsqueeze(1)
+        Outer_factor,Id_factor=self.factors(Gram_RBF,Dist_mat,l_scale,X.size(2))
+        #Scaled outer product in the interleaved layout (the only tensor of full size) --> shape (batch_size,n,d,m,d):
+        K=(Diff*Outer_factor.unsqueeze(3)).permute(0,1,3,2).unsqueeze(4)*Diff.unsqueeze(2)
+        #Add the identity part on the diagonal (in-place on a view of shape (batch_size,n,m,d)):
+        torch.diagonal(K,dim1=2,dim2=4).add_(Id_factor.unsqueeze(3))
+        return(K)
+
+class CurlFreeKernel(DivFreeKernel):
+    '''
+    The following computations are based on equation (25) in
+    "Kernels for Vector-Valued Functions: a Review" by Alvarez et al:
+    K(x,y)=G/l*(I-(x-y)(x-y)^T/l) where G=exp(-0.5*|x-y|^2/l)
+    '''
+    def factors(self,Gram_RBF,Dist_mat,l_scale,d):
+        return(-Gram_RBF/l_scale,Gram_RBF)
+
+#Registry of kernels:
+KERNELS={"rbf":RBFKernel(),
+         "dot_product":DotProductKernel(),
+         "div_free":DivFreeKernel(),
+         "curl_free":CurlFreeKernel()}
+
+def get_kernel(kernel_type):
+    '''
+    Input: kernel_type - string - name of the kernel (key of KERNELS)
+    Output: kernel object
+    '''
+    if kernel_type not in KERNELS:
+        sys.exit("Unknown kernel type")
+    return(KERNELS[kernel_type])
+
 # This function gives the Gram/Kernel -matrix K(X,Y) of two data sets X and Y"
 def gram_matrix(X,Y=None,l_scale=1,sigma_var=1, kernel_type="rbf",B=None,Ker_project=False,flatten=True):
     '''
@@ -45,120 +162,19 @@ def gram_matrix(X,Y=None,l_scale=1,sigma_var=1, kernel_type="rbf",B=None,Ker_pro
           Shape: (n,d)...n number of obs, d...dimension of state space
     Y: torch.tensor or None
           Shape: (m,d)...m number of obs, d...dimension of state space 
-    l_scale,sigma_var,kernel_type,B,Ker_project: see function "mat_kernel"
+    l_scale,sigma_var,kernel_type,B,Ker_project: see the kernel objects (KERNELS)
 
     Output:
     gram_matrix: torch.tensor
-                 Shape (n,m,D) (if Y is not given (n,n,D))
+                 Shape (n,m,D,D) (if Y is not given (n,n,D,D))
                  Block i,j of size DxD gives Kernel value of i-th X-data point and
                  j-th Y data point
+                 If flatten is True: shape (n*D,m*D) where block (i,j) is the above block
+    This is the batch_gram_matrix with batch size 1.
     '''
-    #Get dimension of data space and number of observations from X:
-    d=X.size(1)
-    n=X.size(0)
-    #If B is not given, set to identity:
-    if B is None:
-        B=torch.eye(d).to(X.device)
-    #If Y is not given, set to X:
-    if Y is None:
-        Y=X
-    #Get number of observations from Y and dimension of B:
-    m=Y.size(0)
-    D=B.size(0)
-    #RBF kernel:
-    if kernel_type=="rbf":
-        #Expand X,Y along different dimension to get a grid shape:
-        X=X.unsqueeze(1).expand(n,m,d)
-        Y=Y.unsqueeze(0).expand(n,m,d)
-        #Compute the squared distance matrix:
-        Dist_mat=torch.sum((X-Y)**2,dim=2)
-        #Compute the RBF kernel from that:
-        Gram_RBF=sigma_var*torch.exp(-0.5*Dist_mat/l_scale)
-        #Expand B such that it has the right shape:
-        B=B.view(1,1,D,D)
-        B=B.expand(n,m,D,D)
-        #Reshape RBF Gram matrix:
-        Gram_RBF=Gram_RBF.view(n,m,1,1)
-        #Multiply scalar Gram matrix with the matrix B:
-        K=Gram_RBF*B
-
-    elif kernel_type=="dot_product":
-        #Get dot product Gram matrix:
-        Gram_one_d=torch.matmul(X,Y.t())
-        #Expand B:
-        B=B.view(1,1,D,D)
-        B=B.expand(n,m,D,D)
-        #Expand one-dimensional Gram:
-        Gram_one_d=Gram_one_d.view(n,m,1,1)
-        #Multiply with B:
-        K=Gram_one_d*B
-
-    elif kernel_type=="div_free":
-        '''
-        The following computations are based on equation (24) in
-        "Kernels for Vector-Valued Functions: a Review" by Alvarez et al
-        '''
-        #Create a distance matrix:
-        X=X.unsqueeze(1).expand(n,m,d)
-        Y=Y.unsqueeze(0).expand(n,m,d)
-        #Create distance matrix from that --> shape (n,m)
-        Dist_mat=torch.sum((X-Y)**2,dim=2)
-        #Create the RBF matrix from that --> shape (n,m)
-        Gram_RBF=torch.exp(-0.5*Dist_mat/l_scale)/l_scale
-        #Reshape for later use:
-        Gram_RBF=Gram_RBF.view(n,m,1,1)
-        #Get the differences:
-        Diff=X-Y
-        #Get matrix of outer product --> shape (n,m,d,d)
-        Outer_Prod_Mat=torch.matmul(Diff.unsqueeze(3),Diff.unsqueeze(2))
-        #Get n*m copies of identity matrices in Rd--> shape (n,m,d,d)
-        Ids=torch.eye(d).to(X.device)
-        Ids=Ids.view(1,1,d,d)
-        Ids=Ids.expand(n,m,d,d)
-        #First matrix component for divergence-free kernel-->shape (n,m,d,d)
-        Mat_1=Outer_Prod_Mat/l_scale
-        #Second matrix component for divergence-free kernel --> shape (n,m,d,d)
-        Mat_2=(d-1-Dist_mat.view(n,m,1,1)/l_scale)*Ids
-        #Matrix sum of the two matrices:
-        A=Mat_1+Mat_2
-        #Multiply scalar and matrix part:
-        K=Gram_RBF*A
-    
-    elif kernel_type=="curl_free":
-        '''
-        The following computations are based on equation (25) in
-        "Kernels for Vector-Valued Functions: a Review" by Alvarez et al
-        '''
-        #Create a distance matrix:
-        X=X.unsqueeze(1).expand(n,m,d)
-        Y=Y.unsqueeze(0).expand(n,m,d)
-        #Create distance matrix from that --> shape (n,m)
-        Dist_mat=torch.sum((X-Y)**2,dim=2)
-        #Create the RBF matrix from that --> shape (n,m)
-        Gram_RBF=torch.exp(-0.5*Dist_mat/l_scale)/l_scale
-        #Reshape for later use:
-        Gram_RBF=Gram_RBF.view(n,m,1,1)
-        #Get the differences:
-        Diff=X-Y
-        #Get matrix of outer product --> shape (n,m,d,d)
-        Outer_Prod_Mat=torch.matmul(Diff.unsqueeze(3),Diff.unsqueeze(2))
-        #Get n*m copies of identity matrices in Rd--> shape (n,m,d,d)
-        Ids=torch.eye(d).to(X.device)
-        Ids=Ids.view(1,1,d,d)
-        Ids=Ids.expand(n,m,d,d)
-        #First matrix component for divergence-free kernel-->shape (n,m,d,d)
-        Mat_1=Outer_Prod_Mat/l_scale
-        #Matrix sum of the two matrices:
-        A=Ids-Mat_1
-        #Multiply scalar and matrix part:
-        K=Gram_RBF*A
-
-    else:
-        sys.exit("Unknown kernel type")
-    if flatten:
-        return(my_utils.create_matrix_from_blocks(K))
-    else:
-        return(K)
+    Y=Y.unsqueeze(0) if Y is not None else None
+    return(batch_gram_matrix(X.unsqueeze(0),Y,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,
+                             Ker_project=Ker_project,flatten=flatten)[0])
 
 
 # This function gives the Gram/Kernel -matrix K(X,Y) of two data sets X and Y"
@@ -169,92 +185,97 @@ def batch_gram_matrix(X,Y=None,l_scale=1,sigma_var=1, kernel_type="rbf",B=None,K
           Shape: (batch_size,n,d)...n number of obs, d...dimension of state space
     Y: torch.tensor or None
           Shape: (batch_size,m,d)...m number of obs, d...dimension of state space 
-    l_scale,sigma_var,kernel_type,B,Ker_project: see function "mat_kernel"
+    l_scale,sigma_var,kernel_type,B,Ker_project: see the kernel objects (KERNELS)
 
     Output:
     gram_matrix: torch.tensor
-                 Shape (batch_size,n,m,D) (if Y is not given (batch_size,n,n,D))
+                 Shape (batch_size,n,m,D,D) (if Y is not given (batch_size,n,n,D,D))
                  Block i,j of size DxD gives Kernel value of i-th X-data point and
                  j-th Y data point
+                 If flatten is True: shape (batch_size,n*D,m*D) where block (i,j) is the above block
+    The kernel is computed in the interleaved layout (batch_size,n,D,m,D), so the flattened matrix is a view 
+    and the blocks are a permuted view of it (no copies). The matrix-valued kernels are built in a single 
+    tensor of that size (no expanded identities or intermediate matrices). See the kernel objects above.
     '''
-    #Get dimension of data space and number of observations from X:
-    d=X.size(2)
-    n=X.size(1)
-    batch_size=X.size(0)
-    #If B is not given, set to identity:
-    if B is None:
-        B=torch.eye(d).to(X.device)
+    batch_size,n,_=X.size()
     #If Y is not given, set to X:
     if Y is None:
         Y=X
-    #Get number of observations from Y and dimension of B:
     m=Y.size(1)
-    D=B.size(0)
-    #RBF kernel:
-    if kernel_type=="rbf":
-        #Expand X,Y along different dimension to get a grid shape:
-        X=X.unsqueeze(2).expand(batch_size,n,m,d)
-        Y=Y.unsqueeze(1).expand(batch_size,n,m,d)
-        #Compute the squared distance matrix:
-        Dist_mat=torch.sum((X-Y)**2,dim=3)
-        #Compute the RBF kernel from that:
-        Gram_RBF=sigma_var*torch.exp(-0.5*Dist_mat/l_scale)
-        #Expand B such that it has the right shape:
-        B=B.view(1,1,1,D,D)
-        B=B.expand(batch_size,n,m,D,D)
-        #Reshape RBF Gram matrix:
-        Gram_RBF=Gram_RBF.view(batch_size,n,m,1,1)
-        #Multiply scalar Gram matrix with the matrix B:
-        K=Gram_RBF*B
-
-    elif kernel_type=="dot_product":
-        #Get dot product Gram matrix --> shape (batch_size,n,m)
-        Gram_one_d=torch.matmul(X,Y.transpose(-1,1))
-        #Expand B:
-        B=B.view(1,1,1,D,D)
-        B=B.expand(batch_size,n,m,D,D)
-        #Expand one-dimensional Gram:
-        Gram_one_d=Gram_one_d.view(batch_size,n,m,1,1)
-        #Multiply with B:
-        K=Gram_one_d*B
-
-    elif kernel_type=="div_free":
+    #Get the kernel matrix in the interleaved layout --> shape (batch_size,n,D,m,D):
+    K=get_kernel(kernel_type).gram(X,Y,l_scale=l_scale,sigma_var=sigma_var,B=B)
+    D=K.size(2)
+    if flatten:
+        return(K.reshape(batch_size,n*D,m*D))
+    else:
+        return(K.permute(0,1,3,2,4))
+
+#Autograd function for the unnormalized RBF kernel smoother W*Y with W_ij=exp(-0.5*|x_i-x'_j|^2/l_scale).
+#Only the inputs are saved for the backward pass, the kernel weights W are recomputed there, i.e. no
+#(batch_size,n_target_points,n_context_points) tensor is kept alive between forward and backward pass:
+class RBFSmoothing(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx,X_Context,Y_Context,X_Target,l_scale):
         '''
-        The following computations are based on equation (24) in
-        "Kernels for Vector-Valued Functions: a Review" by Alvarez et al
+        Input: X_Context - torch.tensor - shape (batch_size,n_context_points,d)
+               Y_Context - torch.tensor - shape (batch_size,n_context_points,D)
+               X_Target - torch.tensor - shape (batch_size,n_target_points,d)
+               l_scale - torch.tensor - shape () or broadcastable to (batch_size,1,1)
+        Output: torch.tensor - shape (batch_size,n_target_points,D)
         '''
-        #Create a distance matrix:
-        X=X.unsqueeze(2).expand(batch_size,n,m,d)
-        Y=Y.unsqueeze(1).expand(batch_size,n,m,d)
-        #Create distance matrix from that --> shape (batch_size,n,m)
-        Dist_mat=torch.sum((X-Y)**2,dim=3)
-        #Create the RBF matrix from that --> shape (batch_size,n,m)
-        Gram_RBF=torch.exp(-0.5*Dist_mat/l_scale)/l_scale
-        #Reshape for later use:
-        Gram_RBF=Gram_RBF.view(batch_size,n,m,1,1)
-        #Get the differences -->shape (batch_size,n,m,d):
-        Diff=X-Y
-        #Get matrix of outer product --> shape (batch_size,n,m,d,d)
-        Outer_Prod_Mat=torch.matmul(Diff.unsqueeze(4),Diff.unsqueeze(3))
-        #Get n*m copies of identity matrices in Rd--> shape (batch_size,n,m,d,d)
-        Ids=torch.eye(d).to(X.device)
-        Ids=Ids.view(1,1,1,d,d)
-        Ids=Ids.expand(batch_size,n,m,d,d)
-        #First matrix component for divergence-free kernel-->shape (batch_size,n,m,d,d)
-        Mat_1=Outer_Prod_Mat/l_scale
-        #Second matrix component for divergence-free kernel --> shape (batch_size,n,m,d,d)
-        Mat_2=(d-1-Dist_mat.view(batch_size,n,m,1,1)/l_scale)*Ids
-        #Matrix sum of the two matrices:
-        A=Mat_1+Mat_2
-        #Multiply scalar and matrix part:
-        K=Gram_RBF*A
-       
-    else:
-        sys.exit("Unknown kernel type")
-    if flatten:
-        return(my_utils.batch_create_matrix_from_blocks(K))
+        ctx.save_for_backward(X_Context,Y_Context,X_Target,l_scale)
+        W=torch.exp(-0.5*batch_sq_dist(X_Target,X_Context)/l_scale)
+        return(torch.matmul(W,Y_Context))
+
+    @staticmethod
+    def backward(ctx,Grad):
+        X_Context,Y_Context,X_Target,l_scale=ctx.saved_tensors
+        #Recompute the distances and kernel weights --> shape (batch_size,n_target_points,n_context_points):
+        Dist_mat=batch_sq_dist(X_Target,X_Context)
+        W=torch.exp(-0.5*Dist_mat/l_scale)
+        Grad_X_Context=Grad_Y_Context=Grad_X_Target=Grad_l_scale=None
+        if ctx.needs_input_grad[1]:
+            Grad_Y_Context=torch.matmul(W.transpose(1,2),Grad)
+        if ctx.needs_input_grad[0] or ctx.needs_input_grad[2] or ctx.needs_input_grad[3]:
+            #Gradient w.r.t. the kernel weights times the weights:
+            Grad_W_W=torch.matmul(Grad,Y_Context.transpose(1,2))*W
+            if ctx.needs_input_grad[3]:
+                Grad_l_scale=(Grad_W_W*Dist_mat).sum_to_size(l_scale.size()) if l_scale.dim()>0 else (Grad_W_W*Dist_mat).sum()
+                Grad_l_scale=Grad_l_scale/(2*l_scale**2)
+            #Gradient w.r.t. the squared distances:
+            Grad_Dist=-Grad_W_W/(2*l_scale)
+            #d|x-x'|^2/dx=2(x-x'):
+            if ctx.needs_input_grad[2]:
+                Grad_X_Target=2*(Grad_Dist.sum(dim=2,keepdim=True)*X_Target-torch.matmul(Grad_Dist,X_Context))
+            if ctx.needs_input_grad[0]:
+                Grad_X_Context=2*(Grad_Dist.sum(dim=1).unsqueeze(2)*X_Context-torch.matmul(Grad_Dist.transpose(1,2),X_Target))
+        return(Grad_X_Context,Grad_Y_Context,Grad_X_Target,Grad_l_scale)
+
+#This function checks the hand-written backward pass of RBFSmoothing: numerically with torch.autograd.gradcheck
+#and against autograd through the dense path (RBF Gram matrix times Y_Context) on random inputs in double precision:
+def rbf_smoothing_gradcheck(batch_size=2,n_context_points=5,n_target_points=4,D=3,batch_l_scale=False):
+    '''
+    Input: batch_size,n_context_points,n_target_points,D - int - sizes of the random inputs (see RBFSmoothing.forward)
+           batch_l_scale - Boolean - if True, the length scale has shape (batch_size,1,1), otherwise shape ()
+    Output: passed - Boolean - result of torch.autograd.gradcheck
+            Max_Error - float - maximum absolute difference between the gradients of RBFSmoothing and of the dense path
+    '''
+    X_Context=torch.randn(batch_size,n_context_points,2,dtype=torch.double,requires_grad=True)
+    Y_Context=torch.randn(batch_size,n_context_points,D,dtype=torch.double,requires_grad=True)
+    X_Target=torch.randn(batch_size,n_target_points,2,dtype=torch.double,requires_grad=True)
+    if batch_l_scale:
+        l_scale=(torch.rand(batch_size,1,1,dtype=torch.double)+0.5).requires_grad_()
     else:
-        return(K)
+        l_scale=torch.tensor(1.5,dtype=torch.double,requires_grad=True)
+    Inputs=(X_Context,Y_Context,X_Target,l_scale)
+    passed=torch.autograd.gradcheck(RBFSmoothing.apply,Inputs,eps=1e-6,atol=1e-5)
+    #Compare with autograd through the dense path for a random output gradient:
+    Grad=torch.randn(batch_size,n_target_points,D,dtype=torch.double)
+    Grads=torch.autograd.grad(RBFSmoothing.apply(*Inputs),Inputs,Grad)
+    Dense=torch.matmul(get_kernel("rbf").scalar_gram(X_Target,X_Context,l_scale=l_scale),Y_Context)
+    Grads_Dense=torch.autograd.grad(Dense,Inputs,Grad)
+    Max_Error=max((G-G_Dense).abs().max().item() for G,G_Dense in zip(Grads,Grads_Dense))
+    return(passed,Max_Error)
 
 #A function which performs kernel smoothing for 2d matrix-valued kernels:
 #The normalizer for the kernel smoother is a matrix in this case (assuming that it is invertible)
@@ -268,44 +289,23 @@ def kernel_smoother_2d(X_Context,Y_Context,X_Target,normalize=True,l_scale=1,sig
             Kernel smooth estimates at X_Target 
             torch.tensor - shape - (n_target_points,D)
     '''
-    #Get the number of context and target points and the dimension of the output space:
-    n_context_points=X_Context.size(0)
-    n_target_points=X_Target.size(0)
-    D=Y_Context.size(1)
-    if B is None:
-        B=torch.eye(D,device=X_Target.device)
-    
-    point=datetime.datetime.today()
-    #Get the Gram-matrix between the target and the context set --> shape (n_target_points,n_context_points,2,2):
-    Gram_Blocks=gram_matrix(X=X_Target,Y=X_Context,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,Ker_project=Ker_project,flatten=False)
-    #print("After Gram matrix: ",datetime.datetime.today()-point)
-    point=datetime.datetime.today()
-    Gram_Mat=my_utils.create_matrix_from_blocks(Gram_Blocks)
-    #Get a kernel interpolation for the Target set and reshape it --> shape (2*n_target_points):
-    Interpolate=torch.mv(Gram_Mat,Y_Context.flatten())
-    #If wanted, normalize the output:
-    if normalize: 
-        #Get the column sum of the matrices
-        Col_Sum_Mats=Gram_Blocks.sum(dim=1)
-        
-        #Get the inverses:
-        Inverses=Col_Sum_Mats.inverse()
-        
-        #Perform batch-wise multiplication with inverses 
-        #(need to reshape vectors to a one-column matrix first and after the multiplication back):
-        Interpolate=torch.matmul(Inverses,Interpolate.view(n_target_points,D,1))
-    #print("After normalization: ",datetime.datetime.today()-point)
-    point=datetime.datetime.today()
-    #Return the vector:
-    return(Interpolate.view(n_target_points,D))  
+    return(batch_kernel_smoother_2d(X_Context.unsqueeze(0),Y_Context.unsqueeze(0),X_Target.unsqueeze(0),normalize=normalize,
+                                    l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,Ker_project=Ker_project)[0])
 
 #A batch version of the above function:
-def batch_kernel_smoother_2d(X_Context,Y_Context,X_Target,normalize=True,l_scale=1,sigma_var=1,kernel_type="rbf",B=None,Ker_project=False):
+def batch_kernel_smoother_2d(X_Context,Y_Context,X_Target,normalize=True,l_scale=1,sigma_var=1,kernel_type="rbf",B=None,Ker_project=False,memory_budget=None,
+                             recompute=False):
     '''
     Inputs: X_Context - torch.tensor -shape (batch_size,n_context_points,2)
             Y_Context - torch.tensor - shape (batch_size,n_context_points,D)
             X_Target - torch.tensor - shape (batch_size,n_target_points,2)
             l_scale,sigma_var,kernel_type,B,Ker_project: Kernel parameters - see gram_matrix
+            memory_budget - int or None - if given, maximum number of elements of the kernel tensor which is computed at once:
+                                          the target points are processed in tiles (the results are the same). If gradients
+                                          are required, the kernel of every tile is recomputed in the backward pass, so peak 
+                                          memory does not grow with the number of target points.
+            recompute - Boolean - if True and the kernel is rbf with B a multiple of the identity, the kernel weights are not 
+                                  saved for the backward pass but recomputed (see RBFSmoothing)
     Output:
             Kernel smooth estimates at X_Target 
             torch.tensor - shape - (batch_size,n_target_points,D)
@@ -316,28 +316,266 @@ def batch_kernel_smoother_2d(X_Context,Y_Context,X_Target,normalize=True,l_scale
     batch_size=X_Context.size(0)
     D=Y_Context.size(2)
     if B is None:
-        B=torch.eye(D,device=X_Target.device)
+        B=cached_eye(D,X_Target.device,X_Target.dtype)
+    #Check whether the kernel is separable (scalar kernel times a multiple of the identity):
+    kernel=get_kernel(kernel_type)
+    separable=kernel.separable and my_utils.is_scalar_matrix(B)
+
+    #If a memory budget is given, split the target set into tiles:
+    if memory_budget is not None:
+        #Number of elements of the kernel tensor per target point:
+        n_per_target=batch_size*n_context_points if separable else batch_size*n_context_points*D*D
+        tile_size=max(memory_budget//n_per_target,1)
+        if tile_size<n_target_points:
+            #Function computing the smoother on one tile:
+            def smoother_tile(X_Context,Y_Context,X_Target_Tile,l_scale):
+                return(batch_kernel_smoother_2d(X_Context,Y_Context,X_Target_Tile,normalize=normalize,l_scale=l_scale,sigma_var=sigma_var,
+                                                kernel_type=kernel_type,B=B,Ker_project=Ker_project,recompute=recompute))
+            l_scale=torch.as_tensor(l_scale,dtype=X_Target.dtype,device=X_Target.device)
+            #Only keep the inputs of every tile for the backward pass if gradients are required
+            #(if the kernel weights are recomputed anyway, this is already the case):
+            requires_grad=torch.is_grad_enabled() and any(T.requires_grad for T in [X_Context,Y_Context,X_Target,l_scale])
+            requires_grad=requires_grad and not (recompute and separable and kernel_type=="rbf")
+            Tiles=[]
+            for X_Target_Tile in torch.split(X_Target,tile_size,dim=1):
+                if requires_grad:
+                    Tiles.append(checkpoint(smoother_tile,X_Context,Y_Context,X_Target_Tile,l_scale))
+                else:
+                    Tiles.append(smoother_tile(X_Context,Y_Context,X_Target_Tile,l_scale))
+            return(torch.cat(Tiles,dim=1))
+
+    #Fast path for separable kernels: only a scalar Gram matrix is needed and the normalizer is a scalar.
+    if separable and recompute and kernel_type=="rbf":
+        l_scale=torch.as_tensor(l_scale,dtype=X_Target.dtype,device=X_Target.device)
+        #Append a column of ones to get the row sums of the weights for the normalizer:
+        if normalize:
+            Y_Context=torch.cat([Y_Context,torch.ones_like(Y_Context[:,:,:1])],dim=2)
+        Interpolate=RBFSmoothing.apply(X_Context,Y_Context,X_Target,l_scale)
+        #If wanted, normalize the output by the row sums (the constant factors cancel):
+        if normalize:
+            return(Interpolate[:,:,:D]/Interpolate[:,:,D:])
+        return(sigma_var*B[0,0]*Interpolate)
+
+    if separable:
+        #Get the scalar Gram-matrix (including the factor of B) --> shape (batch_size,n_target_points,n_context_points):
+        Gram=B[0,0]*kernel.scalar_gram(X_Target,X_Context,l_scale=l_scale,sigma_var=sigma_var)
+        #Get a kernel interpolation for the Target set --> shape (batch_size,n_target_points,D):
+        Interpolate=torch.matmul(Gram,Y_Context)
+        #If wanted, normalize the output by the row sums:
+        if normalize:
+            Interpolate=Interpolate/Gram.sum(dim=2,keepdim=True)
+        return(Interpolate)
 
     #Get the Gram-matrix between the target and the context set --> shape (batch_size,n_target_points,n_context_points,D,D):
     Gram_Blocks=batch_gram_matrix(X=X_Target,Y=X_Context,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,Ker_project=Ker_project,flatten=False)
     #Reshape --> (batch_size,n_target_points*D,n_context_points*D):
     Gram_Mat=my_utils.batch_create_matrix_from_blocks(Gram_Blocks)
-    #Get a kernel interpolation for the Target set and reshape it --> shape (batch_size,n_target_points*D):
-    Interpolate=torch.matmul(Gram_Mat,Y_Context.reshape(batch_size,-1,1)).squeeze()
+    #Get a kernel interpolation for the Target set and reshape it --> shape (batch_size,n_target_points,D):
+    Interpolate=torch.matmul(Gram_Mat,Y_Context.reshape(batch_size,-1,1)).view(batch_size,n_target_points,D)
     #If wanted, normalize the output:
     if normalize: 
         #Get the column sum of the matrices
         Col_Sum_Mats=Gram_Blocks.sum(dim=2)
         
-        #Get the inverses:
-        Inverses=Col_Sum_Mats.inverse()
-        
-        #Perform batch-wise multiplication with inverses 
-        #(need to reshape vectors to a one-column matrix first and after the multiplication back):
-        Interpolate=torch.matmul(Inverses,Interpolate.view(batch_size,n_target_points,D,1))
+        #Multiply with the inverses (for 2x2 matrices we use the explicit formula):
+        if D==2:
+            Interpolate=my_utils.batch_solve_2d(Col_Sum_Mats,Interpolate)
+        else:
+            Interpolate=torch.matmul(Col_Sum_Mats.inverse(),Interpolate.unsqueeze(3)).squeeze(3)
 
     #Return the vector:
-    return(Interpolate.view(batch_size,n_target_points,D))
+    return(Interpolate)
+
+
+#A function which performs RBF kernel smoothing from values on a regular 2d grid to target points.
+#Since the RBF weights are negligible far away from a target point and the grid is regular, only the grid points in a window
+#around every target (found arithmetically) are used. This costs O(n_target_points*k^2) for a (k,k)-window:
+def batch_grid_window_smoother_2d(Y_Grid,X_Target,x_axis,y_axis,normalize=True,l_scale=1,sigma_var=1,tol=1e-4):
+    '''
+    Inputs: Y_Grid - torch.tensor - shape (batch_size,n_y_axis,n_x_axis,D) - Y_Grid[:,i,j] gives values at (x_axis[j],y_axis[i])
+            X_Target - torch.tensor - shape (batch_size,n_target_points,2)
+            x_axis,y_axis - torch.tensor - shape (n_x_axis),(n_y_axis) - evenly spaced axes of the grid (may be decreasing)
+            l_scale,sigma_var: Kernel parameters of the rbf kernel - see gram_matrix
+            tol - float - window size: all grid points with a kernel weight exp(-0.5*dist^2/l_scale)>=tol are used,
+                          i.e. every neglected weight is below tol (relative to the weight at distance zero)
+    Output:
+            Kernel smooth estimates at X_Target 
+            torch.tensor - shape - (batch_size,n_target_points,D)
+    '''
+    batch_size,n_y_axis,n_x_axis,D=Y_Grid.size()
+    n_target_points=X_Target.size(1)
+    #Grid spacings (negative for decreasing axes):
+    dx=((x_axis[-1]-x_axis[0])/(n_x_axis-1)).item()
+    dy=((y_axis[-1]-y_axis[0])/(n_y_axis-1)).item()
+    #Radius (in grid points) of the window such that all neglected weights are below tol:
+    radius=math.sqrt(2*float(l_scale)*math.log(1/tol))
+    k_x=int(math.ceil(radius/abs(dx)))
+    k_y=int(math.ceil(radius/abs(dy)))
+    
+    #Get the indices of the nearest grid point of every target --> shape (batch_size,n_target_points,1):
+    Ind_x=torch.round((X_Target[:,:,0:1]-x_axis[0])/dx).long()
+    Ind_y=torch.round((X_Target[:,:,1:2]-y_axis[0])/dy).long()
+    #Get indices of the windows --> shape (batch_size,n_target_points,2*k_x+1) and (batch_size,n_target_points,2*k_y+1):
+    Ind_x=Ind_x+torch.arange(-k_x,k_x+1,device=X_Target.device).view(1,1,-1)
+    Ind_y=Ind_y+torch.arange(-k_y,k_y+1,device=X_Target.device).view(1,1,-1)
+    #Mask grid points outside of the grid and clamp indices:
+    Inside_x=((Ind_x>=0)&(Ind_x<n_x_axis)).to(X_Target.dtype)
+    Inside_y=((Ind_y>=0)&(Ind_y<n_y_axis)).to(X_Target.dtype)
+    Ind_x=Ind_x.clamp(0,n_x_axis-1)
+    Ind_y=Ind_y.clamp(0,n_y_axis-1)
+    
+    #The rbf kernel is separable on the grid --> shapes (batch_size,n_target_points,2*k_x+1),(batch_size,n_target_points,2*k_y+1):
+    W_x=Inside_x*torch.exp(-0.5*(X_Target[:,:,0:1]-x_axis[Ind_x])**2/l_scale)
+    W_y=Inside_y*torch.exp(-0.5*(X_Target[:,:,1:2]-y_axis[Ind_y])**2/l_scale)
+    #Weights of the window --> shape (batch_size,n_target_points,(2*k_y+1)*(2*k_x+1)):
+    W=(W_y.unsqueeze(3)*W_x.unsqueeze(2)).view(batch_size,n_target_points,-1)
+    
+    #Gather the values of the window --> shape (batch_size,n_target_points,(2*k_y+1)*(2*k_x+1),D):
+    Ind=(Ind_y.unsqueeze(3)*n_x_axis+Ind_x.unsqueeze(2)).view(batch_size,-1,1)
+    Values=torch.gather(Y_Grid.reshape(batch_size,n_y_axis*n_x_axis,D),1,Ind.expand(batch_size,Ind.size(1),D))
+    Values=Values.view(batch_size,n_target_points,-1,D)
+    
+    #Get the kernel interpolation --> shape (batch_size,n_target_points,D):
+    Interpolate=torch.matmul(W.unsqueeze(2),Values).squeeze(2)
+    #If wanted, normalize the output (sigma_var cancels out). Targets whose window contains no grid point (far outside of the grid)
+    #have a zero normalizer, they get the value of the nearest grid point (the center of the clamped window):
+    if normalize:
+        Normalizer=W.sum(dim=2,keepdim=True)
+        Nearest=Values[:,:,k_y*(2*k_x+1)+k_x]
+        return(torch.where(Normalizer>0,Interpolate/Normalizer.clamp(min=torch.finfo(W.dtype).tiny),Nearest))
+    else:
+        return(sigma_var*Interpolate)
+
+#Random Fourier features for the rbf kernel: exp(-0.5*|x-y|^2/l_scale)=E[cos(w^T(x-y))] for w~N(0,Id/l_scale).
+#This function gives frequencies w for l_scale=1 (for other length scales they are divided by sqrt(l_scale)):
+def rbf_fourier_frequencies(n_features,d=2,qmc=True,seed=None):
+    '''
+    Input: n_features - int - number of frequencies (every frequency gives a cosine and a sine feature)
+           d - int - dimension of the input space
+           qmc - Boolean - if True, quasi-Monte Carlo frequencies (scrambled Sobol points mapped by the inverse normal cdf)
+                           are used, otherwise i.i.d. normal samples
+           seed - int or None - seed for the random numbers
+    Output: torch.tensor - shape (n_features,d) - frequencies
+    '''
+    if qmc:
+        U=torch.quasirandom.SobolEngine(dimension=d,scramble=True,seed=seed).draw(n_features)
+        #Avoid the boundaries of (0,1) for the inverse cdf:
+        U=U.clamp(min=1e-6,max=1-1e-6).to(torch.get_default_dtype())
+        return(math.sqrt(2)*torch.erfinv(2*U-1))
+    else:
+        Generator=torch.Generator()
+        if seed is not None:
+            Generator.manual_seed(seed)
+        return(torch.randn(n_features,d,generator=Generator))
+
+#This function gives the Fourier features phi such that phi(x)^Tphi(y) approximates exp(-0.5*|x-y|^2/l_scale):
+def batch_rbf_fourier_features(X,Frequencies,l_scale=1):
+    '''
+    Input: X - torch.tensor - shape (batch_size,n,d)
+           Frequencies - torch.tensor - shape (n_features,d) - see rbf_fourier_frequencies
+           l_scale - float or torch.tensor - length scale
+    Output: torch.tensor - shape (batch_size,n,2*n_features)
+    '''
+    Proj=torch.matmul(X,Frequencies.t())/torch.sqrt(torch.as_tensor(l_scale,dtype=X.dtype,device=X.device))
+    return(torch.cat([torch.cos(Proj),torch.sin(Proj)],dim=2)/math.sqrt(Frequencies.size(0)))
+
+#Approximation of the rbf kernel smoother (see batch_kernel_smoother_2d) with random Fourier features.
+#The cost is O((n_context_points+n_target_points)*n_features) instead of O(n_context_points*n_target_points):
+def batch_rff_smoother_2d(X_Context,Y_Context,X_Target,Frequencies,normalize=True,l_scale=1,sigma_var=1):
+    '''
+    Inputs: X_Context - torch.tensor -shape (batch_size,n_context_points,2)
+            Y_Context - torch.tensor - shape (batch_size,n_context_points,D)
+            X_Target - torch.tensor - shape (batch_size,n_target_points,2)
+            Frequencies - torch.tensor - shape (n_features,2) - see rbf_fourier_frequencies
+            l_scale,sigma_var: Kernel parameters of the rbf kernel - see gram_matrix
+    Output:
+            Approximate kernel smooth estimates at X_Target 
+            torch.tensor - shape - (batch_size,n_target_points,D)
+    Remark: the approximate normalizer is not guaranteed to be positive, so normalize should only be used 
+            where the density of the context points is large compared to the approximation error.
+    '''
+    D=Y_Context.size(2)
+    #Append a column of ones to get the normalizer:
+    if normalize:
+        Y_Context=torch.cat([Y_Context,torch.ones_like(Y_Context[:,:,:1])],dim=2)
+    #Features of context and target points --> shape (batch_size,n_context_points,2*n_features),(batch_size,n_target_points,2*n_features):
+    Phi_Context=batch_rbf_fourier_features(X_Context,Frequencies,l_scale)
+    Phi_Target=batch_rbf_fourier_features(X_Target,Frequencies,l_scale)
+    #Sum over the context points in feature space --> shape (batch_size,2*n_features,D(+1)):
+    Sum_Context=torch.matmul(Phi_Context.transpose(1,2),Y_Context)
+    #Evaluate at the target points --> shape (batch_size,n_target_points,D(+1)):
+    Interpolate=torch.matmul(Phi_Target,Sum_Context)
+    if normalize:
+        return(Interpolate[:,:,:D]/Interpolate[:,:,D:])
+    else:
+        return(sigma_var*Interpolate)
+
+#This function reports the error of the Fourier feature approximation against the exact rbf kernel smoother:
+def rff_approximation_error(X_Context,Y_Context,X_Target,Frequencies,normalize=True,l_scale=1,sigma_var=1):
+    '''
+    Inputs: see batch_rff_smoother_2d
+    Output: Rel_Error - torch.tensor - shape (batch_size) - relative error |approx-exact|/|exact| (Frobenius norms) per batch element
+            Max_Error - torch.tensor - shape (batch_size) - maximum absolute error per batch element
+    '''
+    with torch.no_grad():
+        Exact=batch_kernel_smoother_2d(X_Context,Y_Context,X_Target,normalize=normalize,l_scale=l_scale,sigma_var=sigma_var)
+        Approx=batch_rff_smoother_2d(X_Context,Y_Context,X_Target,Frequencies,normalize=normalize,l_scale=l_scale,sigma_var=sigma_var)
+        Error=(Approx-Exact).flatten(start_dim=1)
+        Rel_Error=Error.norm(dim=1)/Exact.flatten(start_dim=1).norm(dim=1)
+        Max_Error=Error.abs().max(dim=1)[0]
+    return(Rel_Error,Max_Error)
+
+#If all inputs lie on a fixed lattice (e.g. the ERA5 grid), the rbf kernel between the lattice and the grid of the 
+#encoder can be precomputed and the kernel smoothing reduces to gathering rows of this table (inputs are given as indices).
+#The table is only rebuilt if the length scale changes:
+class LatticeKernelTable(object):
+    def __init__(self,Lattice,Grid):
+        '''
+        Lattice - torch.tensor - shape (n_lattice,2) - coordinates of the lattice points
+        Grid - torch.tensor - shape (n_grid,2) - coordinates of the grid points
+        '''
+        self.Lattice=Lattice
+        self.Grid=Grid
+        self.l_scale=None
+        self.Table=None
+        self.Row_Sums=None
+
+    def give_table(self,l_scale):
+        '''
+        Input: l_scale - torch.tensor - shape () or (K) - length scale(s) of the rbf kernel (sigma_var=1)
+        Output: Table - torch.tensor - shape (K,n_lattice,n_grid) - rbf kernel between lattice and grid points (without gradients)
+                Row_Sums - torch.tensor - shape (K,n_lattice) - sums of the rows of Table (normalizers for smoothing to the lattice)
+        '''
+        l_scale=l_scale.detach().view(-1)
+        if self.l_scale is None or self.l_scale.device!=l_scale.device or not torch.equal(self.l_scale,l_scale):
+            self.Lattice=self.Lattice.to(l_scale.device,l_scale.dtype)
+            self.Grid=self.Grid.to(l_scale.device,l_scale.dtype)
+            Dist_mat=batch_sq_dist(self.Lattice.unsqueeze(0),self.Grid.unsqueeze(0))
+            self.Table=torch.exp(-0.5*Dist_mat/l_scale.view(-1,1,1))
+            self.Row_Sums=self.Table.sum(dim=2)
+            self.l_scale=l_scale.clone()
+        return(self.Table,self.Row_Sums)
+
+    def usable(self,l_scale):
+        '''
+        Output: Boolean - the table has no gradients with respect to the length scale, so it is only used if none are required
+        '''
+        return(not (torch.is_grad_enabled() and torch.is_tensor(l_scale) and l_scale.requires_grad))
+
+#Kernel smoothing from values on the grid to lattice points given by indices (rbf kernel, see LatticeKernelTable):
+def batch_lattice_smoother(Ind_Target,Y_Grid,Lattice_Table,normalize=True,l_scale=1,sigma_var=1):
+    '''
+    Inputs: Ind_Target - torch.tensor of ints - shape (batch_size,n_target_points) - indices of the target points in the lattice
+            Y_Grid - torch.tensor - shape (batch_size,n_grid,D) - values on the grid
+            Lattice_Table - instance of LatticeKernelTable
+            normalize,l_scale,sigma_var - see batch_kernel_smoother_2d
+    Output: torch.tensor - shape (batch_size,n_target_points,D) - same as batch_kernel_smoother_2d with the lattice points as targets
+    '''
+    Table,Row_Sums=Lattice_Table.give_table(torch.as_tensor(l_scale,dtype=Y_Grid.dtype,device=Y_Grid.device))
+    Interpolate=torch.matmul(Table[0][Ind_Target],Y_Grid)
+    if normalize:
+        return(Interpolate/Row_Sums[0][Ind_Target].unsqueeze(2))
+    return(sigma_var*Interpolate)
 
 
 '''
@@ -347,25 +585,24 @@ ________________________________________________________________________________
 ____________________________________________________________________________________________________________________
 '''
 
-#This function samples a multi-dimensional GP with kernel of a type give by the function gram_matrix
-#Observations are assumed to be noisy versions of the real underlying function:
-def multidim_gp_sampler(X,l_scale=1,sigma_var=1, kernel_type="rbf",B=None,Ker_project=False,chol_noise=1e-4,obs_noise=1e-4):
+#This function computes the Cholesky factor of the Gram matrix of a multi-dimensional GP at X.
+#It only depends on the points and the kernel, so it can be computed once and reused for many samples:
+def gp_cholesky_factor(X,l_scale=1,sigma_var=1, kernel_type="rbf",B=None,Ker_project=False,chol_noise=1e-4):
     '''
     Input:
     X: torch.tensor
        Shape (n,d) n...number of observations, d...dimension of state space
     l_scale,sigma_var,kernel_type,B,Ker_project: Kernel parameters (see mat_kernel)
     chol_noise: scalar - noise added to make cholesky decomposition numerically stable
-    obs_noise: variance of observation noise
     
     Output:
-    Y: torch.tensor
-       Shape (n,D) D...dimension of label space 
-       Sample of GP
+    L: torch.tensor
+       Shape (n*D,n*D) D...dimension of label space
+       Lower triangular Cholesky factor of K(X,X)+chol_noise*Id
     '''
     if (B is None):
         d=X.size(1)
-        B=torch.eye(d)
+        B=torch.eye(d,device=X.device)
     
     #Save dimensions:
     n=X.size(0)
@@ -375,67 +612,859 @@ def multidim_gp_sampler(X,l_scale=1,sigma_var=1, kernel_type="rbf",B=None,Ker_pr
     Gram_Mat=gram_matrix(X,Y=None,l_scale=l_scale,sigma_var=sigma_var, kernel_type=kernel_type,B=B,Ker_project=Ker_project)
     
     #Get cholesky decomposition of Gram-Mat (adding some noise to make it numerically stable):
-    L=(Gram_Mat+chol_noise*torch.eye(D*n)).cholesky()
+    L=(Gram_Mat+chol_noise*torch.eye(D*n,device=X.device)).cholesky()
+    return(L)
+
+#This function samples a multi-dimensional GP with kernel of a type give by the function gram_matrix
+#Observations are assumed to be noisy versions of the real underlying function:
+def multidim_gp_sampler(X,l_scale=1,sigma_var=1, kernel_type="rbf",B=None,Ker_project=False,chol_noise=1e-4,obs_noise=1e-4):
+    '''
+    Input:
+    X: torch.tensor
+       Shape (n,d) n...number of observations, d...dimension of state space
+    l_scale,sigma_var,kernel_type,B,Ker_project: Kernel parameters (see mat_kernel)
+    chol_noise: scalar - noise added to make cholesky decomposition numerically stable
+    obs_noise: variance of observation noise
     
-    #Get multi-dimensional std normal sample:
-    Z=torch.randn(n*D)
+    Output:
+    Y: torch.tensor
+       Shape (n,D) D...dimension of label space 
+       Sample of GP
+    '''
+    return(batch_multidim_gp_sampler(X,n_samples=1,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,
+                                     Ker_project=Ker_project,chol_noise=chol_noise,obs_noise=obs_noise)[0])
+
+#This function samples n_samples independent GP samples at the same points X.
+#The Gram matrix is only factorized once (or not at all if the factor L is given),
+#all samples are then obtained by one matrix multiplication:
+def batch_multidim_gp_sampler(X,n_samples,l_scale=1,sigma_var=1, kernel_type="rbf",B=None,Ker_project=False,chol_noise=1e-4,obs_noise=1e-4,L=None):
+    '''
+    Input:
+    X: torch.tensor
+       Shape (n,d) n...number of observations, d...dimension of state space
+    n_samples: int - number of samples
+    l_scale,sigma_var,kernel_type,B,Ker_project: Kernel parameters (see mat_kernel)
+    chol_noise: scalar - noise added to make cholesky decomposition numerically stable
+    obs_noise: variance of observation noise
+    L: torch.tensor or None - shape (n*D,n*D) - Cholesky factor as returned by gp_cholesky_factor,
+                              if None, it is computed here
     
-    #Function values + noise = Observation:
-    Y=torch.mv(L,Z)+math.sqrt(obs_noise)*torch.randn(n*D)
+    Output:
+    Y: torch.tensor
+       Shape (n_samples,n,D) D...dimension of label space 
+       Independent samples of GP
+    '''
+    #Get the Cholesky factor if not given:
+    if L is None:
+        L=gp_cholesky_factor(X,l_scale=l_scale,sigma_var=sigma_var, kernel_type=kernel_type,B=B,Ker_project=Ker_project,chol_noise=chol_noise)
+    
+    #Save dimensions:
+    n=X.size(0)
+    nD=L.size(0)
+    
+    #Get multi-dimensional std normal samples --> shape (n_samples,n*D):
+    Z=torch.randn((n_samples,nD),device=L.device)
+    
+    #Function values + noise = Observation (row-wise L*z):
+    Y=torch.matmul(Z,L.t())+math.sqrt(obs_noise)*torch.randn((n_samples,nD),device=L.device)
     
     #Return reshaped version:
-    return(Y.view(n,D))
+    return(Y.view(n_samples,n,nD//n))
+    
+
+#This function computes the square root of the eigenvalues of the circulant embedding of a stationary kernel on a regular 2d grid
+#(as given by my_utils.give_2d_grid): the grid is embedded into a periodic grid (torus) of size (m_y,m_x) on which the covariance 
+#matrix is block-circulant and therefore diagonalized by the 2d FFT. 
+def circulant_embedding_2d(min_x,max_x,n_x_axis,min_y=None,max_y=None,n_y_axis=None,l_scale=1,sigma_var=1, 
+                            kernel_type="rbf",B=None,n_pad=0,tol=1e-6):
+    '''
+    Input:
+    min_x,max_x,n_x_axis,min_y,max_y,n_y_axis: grid parameters (see my_utils.give_2d_grid)
+    l_scale,sigma_var,kernel_type,B: Kernel parameters (see gram_matrix) - the kernel must be stationary
+    n_pad: int - number of additional grid points per axis for the periodic embedding 
+                 (increase if the embedding is reported not to be positive semi-definite)
+    tol: float - negative eigenvalues of the embedding above -tol*(largest eigenvalue) are set to zero,
+                 for smaller ones the program exits
+    Output:
+    Sqrt_Lambda: np.array - shape (m_y,m_x,D,D) - square roots of the (DxD-block) eigenvalues of the embedding
+    '''
+    if min_y is None:
+        min_y=min_x
+    if max_y is None:
+        max_y=max_x
+    if n_y_axis is None:
+        n_y_axis=n_x_axis
+    #Grid spacing:
+    dx=(max_x-min_x)/(n_x_axis-1)
+    dy=(max_y-min_y)/(n_y_axis-1)
+    #Size of the periodic embedding:
+    m_x=2*(n_x_axis-1+n_pad)
+    m_y=2*(n_y_axis-1+n_pad)
+
+    #Get the lags on the torus (wrapped to [-m/2,m/2]) --> shape (m_y*m_x,2):
+    lag_x=torch.arange(m_x,dtype=torch.get_default_dtype())
+    lag_x=dx*torch.where(lag_x<=m_x//2,lag_x,lag_x-m_x)
+    lag_y=torch.arange(m_y,dtype=torch.get_default_dtype())
+    lag_y=dy*torch.where(lag_y<=m_y//2,lag_y,lag_y-m_y)
+    Lag_Y,Lag_X=torch.meshgrid(lag_y,lag_x)
+    Lags=torch.stack((Lag_X,Lag_Y),2).view(m_y*m_x,2)
+    
+    #Evaluate the kernel at all lags --> shape (m_y,m_x,D,D):
+    K=gram_matrix(Lags,torch.zeros((1,2)),l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,flatten=False)
+    D=K.size(-1)
+    K=K.reshape(m_y,m_x,D,D).detach().double().numpy()
+
+    #Eigenvalues of the block-circulant matrix are given by the FFT of the first block row 
+    #(real symmetric since the kernel is even) --> shape (m_y,m_x,D,D):
+    Lambda=np.fft.fft2(K,axes=(0,1)).real
+    Lambda=(Lambda+Lambda.transpose(0,1,3,2))/2
+    #Get a square root of every DxD-block:
+    Eig_val,Eig_vec=np.linalg.eigh(Lambda)
+    if Eig_val.min()<-tol*Eig_val.max():
+        sys.exit("Circulant embedding is not positive semi-definite - increase n_pad.")
+    Sqrt_Lambda=np.matmul(Eig_vec*np.sqrt(np.clip(Eig_val,0,None))[:,:,None,:],Eig_vec.transpose(0,1,3,2))
+    return(Sqrt_Lambda)
+
+#This function samples a stationary multi-dimensional GP on a regular 2d grid via circulant embedding
+#(see circulant_embedding_2d). This gives exact samples in O(N log N):
+def circulant_gp_sampler_2d(n_samples,min_x,max_x,n_x_axis,min_y=None,max_y=None,n_y_axis=None,l_scale=1,sigma_var=1, 
+                            kernel_type="rbf",B=None,obs_noise=1e-4,n_pad=0,Sqrt_Lambda=None):
+    '''
+    Input:
+    n_samples: int - number of samples
+    min_x,max_x,n_x_axis,min_y,max_y,n_y_axis: grid parameters (see my_utils.give_2d_grid)
+    l_scale,sigma_var,kernel_type,B,n_pad: see circulant_embedding_2d
+    obs_noise: variance of observation noise
+    Sqrt_Lambda: np.array or None - output of circulant_embedding_2d, if None it is computed here
+    Output:
+    Y: torch.tensor
+       Shape (n_samples,n_y_axis*n_x_axis,D) - independent samples of GP where the points are ordered as in
+       my_utils.give_2d_grid(min_x,max_x,n_x_axis,min_y,max_y,n_y_axis,flatten=True)
+    '''
+    if n_y_axis is None:
+        n_y_axis=n_x_axis
+    if Sqrt_Lambda is None:
+        Sqrt_Lambda=circulant_embedding_2d(min_x,max_x,n_x_axis,min_y,max_y,n_y_axis,l_scale=l_scale,sigma_var=sigma_var,
+                                           kernel_type=kernel_type,B=B,n_pad=n_pad)
+    m_y,m_x,D,_=Sqrt_Lambda.shape
+
+    #Real and imaginary part of one complex sample give two independent samples:
+    n_complex=(n_samples+1)//2
+    W=np.random.randn(n_complex,m_y,m_x,D,1)+1j*np.random.randn(n_complex,m_y,m_x,D,1)
+    Samples=np.fft.fft2(np.matmul(Sqrt_Lambda[None],W)[...,0],axes=(1,2))/math.sqrt(m_y*m_x)
+    Samples=np.concatenate([Samples.real,Samples.imag],axis=0)[:n_samples,:n_y_axis,:n_x_axis]
     
+    #Reshape and add observation noise:
+    Y=torch.tensor(Samples,dtype=torch.get_default_dtype()).reshape(n_samples,n_y_axis*n_x_axis,D)
+    return(Y+math.sqrt(obs_noise)*torch.randn(Y.size()))
+
+#This function samples div-free and curl-free GPs on a regular 2d grid via a scalar potential: the curl-free kernel (see gram_matrix) 
+#is the covariance of the gradient of a scalar GP with kernel k(x,y)=exp(-0.5*|x-y|^2/l_scale) and the div-free kernel is the 
+#covariance of its rotated gradient (the curl). The potential is sampled with the circulant embedding of the scalar kernel 
+#(see circulant_embedding_2d, only scalar eigenvalues, no DxD-blocks) and differentiated spectrally, i.e. the Fourier coefficients 
+#are multiplied with -i*omega. The samples are exact samples of the derivatives of the periodic potential on the torus:
+def potential_circulant_sampler_2d(n_samples,min_x,max_x,n_x_axis,min_y=None,max_y=None,n_y_axis=None,l_scale=1,kernel_type="div_free",
+                                   obs_noise=1e-4,n_pad=0,Sqrt_Lambda=None):
+    '''
+    Input:
+    n_samples: int - number of samples
+    min_x,max_x,n_x_axis,min_y,max_y,n_y_axis: grid parameters (see my_utils.give_2d_grid)
+    l_scale: float - length scale of the kernel
+    kernel_type: string - "div_free" or "curl_free"
+    obs_noise: variance of observation noise
+    n_pad: see circulant_embedding_2d
+    Sqrt_Lambda: np.array or None - output of circulant_embedding_2d for the scalar rbf kernel (sigma_var=1), if None it is computed here
+    Output:
+    Y: torch.tensor
+       Shape (n_samples,n_y_axis*n_x_axis,2) - independent samples of GP where the points are ordered as in
+       my_utils.give_2d_grid(min_x,max_x,n_x_axis,min_y,max_y,n_y_axis,flatten=True)
+    '''
+    if min_y is None:
+        min_y=min_x
+    if max_y is None:
+        max_y=max_x
+    if n_y_axis is None:
+        n_y_axis=n_x_axis
+    if kernel_type not in ["div_free","curl_free"]:
+        sys.exit("Potential sampling is only possible for div_free and curl_free kernels.")
+    if Sqrt_Lambda is None:
+        Sqrt_Lambda=circulant_embedding_2d(min_x,max_x,n_x_axis,min_y,max_y,n_y_axis,l_scale=l_scale,sigma_var=1,
+                                           kernel_type="rbf",n_pad=n_pad)
+    m_y,m_x=Sqrt_Lambda.shape[:2]
+    Sqrt_Lambda=Sqrt_Lambda[:,:,0,0]
+    #Grid spacing:
+    dx=(max_x-min_x)/(n_x_axis-1)
+    dy=(max_y-min_y)/(n_y_axis-1)
+    #Angular frequencies of the Fourier modes (the Nyquist mode is set to zero to keep the derivatives real) --> shape (1,m_x),(m_y,1):
+    k_x=np.fft.fftfreq(m_x)*m_x
+    k_x[m_x//2]=0
+    k_y=np.fft.fftfreq(m_y)*m_y
+    k_y[m_y//2]=0
+    Omega_X=(2*math.pi*k_x/(m_x*dx))[None,:]
+    Omega_Y=(2*math.pi*k_y/(m_y*dy))[:,None]
+
+    #Fourier coefficients of the potential (real and imaginary part of one complex sample give two independent samples)
+    #--> shape (n_complex,m_y,m_x):
+    n_complex=(n_samples+1)//2
+    A=Sqrt_Lambda[None]*(np.random.randn(n_complex,m_y,m_x)+1j*np.random.randn(n_complex,m_y,m_x))
+    #Spectral derivatives of the potential --> shape (n_complex,m_y,m_x):
+    Grad_X=np.fft.fft2(-1j*Omega_X[None]*A,axes=(1,2))/math.sqrt(m_y*m_x)
+    Grad_Y=np.fft.fft2(-1j*Omega_Y[None]*A,axes=(1,2))/math.sqrt(m_y*m_x)
+    #Gradient (curl-free) or gradient rotated by -90 degrees (div-free) --> shape (n_complex,m_y,m_x,2):
+    if kernel_type=="curl_free":
+        Field=np.stack([Grad_X,Grad_Y],axis=3)
+    else:
+        Field=np.stack([Grad_Y,-Grad_X],axis=3)
+    Samples=np.concatenate([Field.real,Field.imag],axis=0)[:n_samples,:n_y_axis,:n_x_axis]
+
+    #Reshape and add observation noise:
+    Y=torch.tensor(Samples,dtype=torch.get_default_dtype()).reshape(n_samples,n_y_axis*n_x_axis,2)
+    return(Y+math.sqrt(obs_noise)*torch.randn(Y.size()))
+
+#This function gives the Gram matrix function used for GP inference.
+#For separable kernels with B=c*Id, the Gram matrices are Kronecker products with Id, so the 
+#GP inference can be done with the scalar Gram matrices for all D components at once:
+def gp_gram_function(D,l_scale=1,sigma_var=1,kernel_type="rbf",B=None,Ker_project=False):
+    '''
+    Input:  D - int - dimension of the output space
+            l_scale,sigma_var,kernel_type,B,Ker_project - kernel parameters (see batch_gram_matrix)
+    Output: gram - function - gram(X,Y) gives the Gram matrix of shape (batch_size,n*P,m*P) for X,Y of shape (batch_size,n/m,d)
+            separable - Boolean - True if the scalar Gram matrices are used
+            P - int - number of rows per point in the Gram matrices (1 if separable, D otherwise)
+    '''
+    kernel=get_kernel(kernel_type)
+    separable=kernel.separable and (B is None or my_utils.is_scalar_matrix(B))
+    if separable:
+        c=1 if B is None else B[0,0]
+        def gram(X,Y):
+            return(c*kernel.scalar_gram(X,Y,l_scale=l_scale,sigma_var=sigma_var))
+        return(gram,True,1)
+    else:
+        def gram(X,Y):
+            return(batch_gram_matrix(X=X,Y=Y,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,Ker_project=Ker_project))
+        return(gram,False,D)
 
 #This functions perform GP-inference on the function values at X_Target (so no noise for the target value)
 #based on context points X_Context and labels Y_Context:
-def gp_inference(X_Context,Y_Context,X_Target,l_scale=1,sigma_var=1, kernel_type="rbf",obs_noise=0.1,B=None,Ker_project=False,chol_noise=1e-4):
+def gp_inference(X_Context,Y_Context,X_Target,l_scale=1,sigma_var=1, kernel_type="rbf",obs_noise=0.1,B=None,Ker_project=False,chol_noise=1e-4,dtype=None,
+                 full_cov=True):
     '''
     Input:
         X_Context - torch.tensor - Shape (n_context_points,d)
         Y_Context - torch.tensor- Shape (n_context_points,D)
         X_Target - torch.tensor - Shape (n_target_points,d)
+        dtype,full_cov - see batch_gp_inference
     Output:
         Means - torch.tensor - Shape (n_target_points, D) - Means of conditional dist.
         Cov_Mat- torch.tensor - Shape (n_target_points*D,n_target_points*D) - Covariance Matrix of conditional dist.
+                                (if full_cov is False: shape (n_target_points,D,D) - marginal covariance matrices)
         Vars - torch.tensor - Shape (n_target_points,D) - Variance of individual components 
     '''
+    Means,Cov_Mat,Vars=batch_gp_inference(X_Context.unsqueeze(0),Y_Context.unsqueeze(0),X_Target.unsqueeze(0),l_scale=l_scale,sigma_var=sigma_var,
+                                          kernel_type=kernel_type,obs_noise=obs_noise,B=B,Ker_project=Ker_project,chol_noise=chol_noise,dtype=dtype,
+                                          full_cov=full_cov)
+    return(Means[0],Cov_Mat[0],Vars[0])
+
+#A batch version of the above function - the Gram matrix of the context set is factorized by a Cholesky decomposition
+#(no explicit inverse). Context sets of different sizes can be padded to the same size and masked:
+def batch_gp_inference(X_Context,Y_Context,X_Target,l_scale=1,sigma_var=1, kernel_type="rbf",obs_noise=0.1,B=None,Ker_project=False,chol_noise=1e-4,
+                       context_mask=None,dtype=None,full_cov=True):
+    '''
+    Input:
+        X_Context - torch.tensor - Shape (batch_size,n_context_points,d)
+        Y_Context - torch.tensor- Shape (batch_size,n_context_points,D)
+        X_Target - torch.tensor - Shape (batch_size,n_target_points,d)
+        context_mask - torch.tensor or None - Shape (batch_size,n_context_points) - 1 for context points, 0 for padding 
+                                              (padded points have no influence on the posterior)
+        dtype - torch.dtype or None - if given, dtype in which the computations are performed (e.g. torch.double 
+                                      for badly conditioned Gram matrices), the outputs have the dtype of the inputs
+        full_cov - Boolean - if False, only the DxD marginal covariance matrices of the individual target points are computed
+                             (memory O(n_target_points*n_context_points*D^2) instead of O((n_target_points*D)^2))
+    Output:
+        Means - torch.tensor - Shape (batch_size,n_target_points, D) - Means of conditional dist.
+        Cov_Mat- torch.tensor - Shape (batch_size,n_target_points*D,n_target_points*D) - Covariance Matrix of conditional dist.
+                                (if full_cov is False: shape (batch_size,n_target_points,D,D) - marginal covariance matrices)
+        Vars - torch.tensor - Shape (batch_size,n_target_points,D) - Variance of individual components 
+    For separable kernels with B a multiple of the identity, only the scalar Gram matrices are factorized.
+    '''
+    #Cast to the dtype for computations:
+    out_dtype=X_Context.dtype
+    if dtype is not None:
+        X_Context=X_Context.to(dtype)
+        Y_Context=Y_Context.to(dtype)
+        X_Target=X_Target.to(dtype)
+        B=B.to(dtype) if B is not None else None
     #Dimensions of data matrices:
-    n_context_points=X_Context.size(0)
-    n_target_points=X_Target.size(0)
-    d=X_Context.size(1)
-    D=Y_Context.size(1)
-    #Get matrix K(X_Context,X_Context) and add on the diagonal the observation noise:
-    Gram_context=gram_matrix(X_Context,l_scale=l_scale,sigma_var=sigma_var, kernel_type=kernel_type,B=B,Ker_project=Ker_project)
-
-    Noise_matrix_context=(obs_noise+chol_noise)*torch.eye(n_context_points*D).to(X_Context.device)
+    batch_size,n_context_points,d=X_Context.size()
+    n_target_points=X_Target.size(1)
+    D=Y_Context.size(2)
+    Id_D=cached_eye(D,X_Context.device,X_Context.dtype)
+    gram,separable,P=gp_gram_function(D,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,Ker_project=Ker_project)
+    #Get matrix K(X_Context,X_Context) and K(X_Target,X_Context):
+    Gram_context=gram(X_Context,X_Context)
+    Gram_target_context=gram(X_Target,X_Context)
+    
+    #Decouple padded context points from all other points:
+    if context_mask is not None:
+        Mask=context_mask.to(X_Context.dtype).repeat_interleave(P,dim=1)
+        Gram_context=Gram_context*Mask.unsqueeze(2)*Mask.unsqueeze(1)+(1-Mask).diag_embed()
+        Gram_target_context=Gram_target_context*Mask.unsqueeze(1)
+        Y_Context=Y_Context*context_mask.to(X_Context.dtype).unsqueeze(2)
+    
+    #Add on the diagonal the observation noise:
+    Noise_matrix_context=(obs_noise+chol_noise)*torch.eye(n_context_points*P,dtype=X_Context.dtype,device=X_Context.device)
     Gram_context=Gram_context+Noise_matrix_context
 
-    #Get Gram-matrix K(X_Target,X_Target):
-    Gram_target=gram_matrix(X_Target,l_scale=l_scale,sigma_var=sigma_var, kernel_type=kernel_type,B=B,Ker_project=Ker_project)
+    #Cholesky decomposition of Gram-Context matrix:
+    L=torch.cholesky(Gram_context)
+    #Solve L*V=K(X_Context,X_Target) and L*z=Y_Context --> shape (batch_size,n_context_points*P,n_target_points*P) and (batch_size,n_context_points*P,D/P):
+    V=torch.triangular_solve(Gram_target_context.transpose(1,2),L,upper=False)[0]
+    z=torch.triangular_solve(Y_Context.reshape(batch_size,n_context_points*P,D//P),L,upper=False)[0]
     
-    Noise_matrix_target=(obs_noise+chol_noise)*torch.eye(n_target_points*D).to(X_Context.device)
+    #Get prediction means and reshape it:
+    Means=torch.matmul(V.transpose(1,2),z).view(batch_size,n_target_points,D)
+
+    if full_cov:
+        #Get Gram-matrix K(X_Target,X_Target):
+        Gram_target=gram(X_Target,X_Target)
+        Noise_matrix_target=(obs_noise+chol_noise)*torch.eye(n_target_points*P,dtype=X_Context.dtype,device=X_Context.device)
+        Gram_target=Gram_target+Noise_matrix_target
+
+        #Get prediction covariance matrix:
+        Cov_Mat=Gram_target-torch.matmul(V.transpose(1,2),V)
+        if separable:
+            Cov_Mat=(Cov_Mat.view(batch_size,n_target_points,1,n_target_points,1)*Id_D.view(1,1,D,1,D)).reshape(batch_size,n_target_points*D,n_target_points*D)
     
-    Gram_target=Gram_target+Noise_matrix_target
+        #Get the variances of the components and reshape it:
+        Vars=torch.diagonal(Cov_Mat,dim1=1,dim2=2).reshape(batch_size,n_target_points,D)
+    else:
+        #Get only the PxP diagonal blocks of K(X_Target,X_Target) (every target point is its own "batch") --> shape (batch_size,n_target_points,P,P):
+        X_Target_Points=X_Target.reshape(batch_size*n_target_points,1,d)
+        Gram_target=gram(X_Target_Points,X_Target_Points).view(batch_size,n_target_points,P,P)
+        Noise_matrix_target=(obs_noise+chol_noise)*torch.eye(P,dtype=X_Context.dtype,device=X_Context.device)
+        Gram_target=Gram_target+Noise_matrix_target
 
-    #Get matrix K(X_Target,X_Context):
-    Gram_target_context=gram_matrix(X=X_Target,Y=X_Context,l_scale=l_scale,sigma_var=sigma_var, kernel_type=kernel_type,B=B,Ker_project=Ker_project)
+        #Get the diagonal blocks of V^TV --> shape (batch_size,n_target_points,P,P):
+        V=V.view(batch_size,n_context_points*P,n_target_points,P)
+        Cov_Mat=Gram_target-torch.einsum('bktd,bkte->btde',V,V)
+        if separable:
+            Cov_Mat=Cov_Mat*Id_D
+
+        #Get the variances of the components:
+        Vars=torch.diagonal(Cov_Mat,dim1=2,dim2=3)
     
-    #Invert Gram-Context matrix:
-    inv_Gram_context=Gram_context.inverse()
+    return(Means.to(out_dtype),Cov_Mat.to(out_dtype),Vars.to(out_dtype))
+
+
+#This function gives the log marginal likelihood log p(Y|X) of a GP with the given kernel and observation noise:
+def batch_gp_log_marginal_likelihood(X,Y,l_scale=1,sigma_var=1,kernel_type="rbf",obs_noise=0.1,B=None,Ker_project=False,chol_noise=1e-4,mask=None):
+    '''
+    Input:
+        X - torch.tensor - Shape (batch_size,n,d)
+        Y - torch.tensor - Shape (batch_size,n,D)
+        l_scale,sigma_var,obs_noise - float or torch.tensor of shape (batch_size,1,1) - hyperparameters (can be different for 
+                                      every batch element, e.g. for multiple initializations of an optimization)
+        kernel_type,B,Ker_project,chol_noise - see batch_gp_inference
+        mask - torch.tensor or None - Shape (batch_size,n) - 1 for data points, 0 for padding
+    Output:
+        torch.tensor - Shape (batch_size) - log marginal likelihood (differentiable w.r.t. the hyperparameters)
+    '''
+    batch_size,n,d=X.size()
+    D=Y.size(2)
+    gram,separable,P=gp_gram_function(D,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,Ker_project=Ker_project)
+    Gram=gram(X,X)
+    #Decouple padded points from all other points (they contribute zero to the log marginal likelihood):
+    if mask is not None:
+        Mask=mask.to(X.dtype).repeat_interleave(P,dim=1)
+        Gram=Gram*Mask.unsqueeze(2)*Mask.unsqueeze(1)+(1-Mask).diag_embed()
+        Y=Y*mask.to(X.dtype).unsqueeze(2)
+        n_obs=mask.to(X.dtype).sum(dim=1)*D
+    else:
+        Mask=1.
+        n_obs=torch.full([batch_size],n*D,dtype=X.dtype,device=X.device)
+    #Add the noise on the diagonal (only for data points):
+    Noise=torch.as_tensor(obs_noise+chol_noise,dtype=X.dtype,device=X.device).view(-1,1)*Mask
+    Gram=Gram+(Noise*torch.ones(batch_size,n*P,dtype=X.dtype,device=X.device)).diag_embed()
+    #Cholesky decomposition and z=L^(-1)Y --> shape (batch_size,n*P,D/P):
+    L=torch.cholesky(Gram)
+    z=torch.triangular_solve(Y.reshape(batch_size,n*P,D//P),L,upper=False)[0]
+    #-0.5*Y^TK^(-1)Y-0.5*log(det(K))-0.5*n*D*log(2pi) (the log-determinant is counted once per column of Y):
+    log_det=2*torch.log(torch.diagonal(L,dim1=1,dim2=2)).sum(dim=1)*(D//P)
+    return(-0.5*(z**2).sum(dim=(1,2))-0.5*log_det-0.5*n_obs*math.log(2*math.pi))
+
+#Sparse GP inference with inducing points X_Inducing (optimal variational distribution of the inducing values as in 
+#"Variational Learning of Inducing Variables in Sparse Gaussian Processes" by Titsias). Only the DxD marginal 
+#covariance matrices of the targets are computed. The cost is O(n*m^2) for n context/target points and m inducing points:
+def batch_sparse_gp_inference(X_Context,Y_Context,X_Target,X_Inducing,l_scale=1,sigma_var=1, kernel_type="rbf",obs_noise=0.1,B=None,Ker_project=False,
+                              chol_noise=1e-4,context_mask=None,dtype=None):
+    '''
+    Input:
+        X_Context - torch.tensor - Shape (batch_size,n_context_points,d)
+        Y_Context - torch.tensor- Shape (batch_size,n_context_points,D)
+        X_Target - torch.tensor - Shape (batch_size,n_target_points,d)
+        X_Inducing - torch.tensor - Shape (batch_size,n_inducing_points,d) - inducing points (e.g. the grid of the encoder)
+        context_mask,dtype - see batch_gp_inference
+    Output:
+        Means - torch.tensor - Shape (batch_size,n_target_points, D) - Means of conditional dist.
+        Cov_Mat- torch.tensor - Shape (batch_size,n_target_points,D,D) - marginal covariance matrices of conditional dist.
+        Vars - torch.tensor - Shape (batch_size,n_target_points,D) - Variance of individual components 
+    '''
+    #Cast to the dtype for computations:
+    out_dtype=X_Context.dtype
+    if dtype is not None:
+        X_Context=X_Context.to(dtype)
+        Y_Context=Y_Context.to(dtype)
+        X_Target=X_Target.to(dtype)
+        X_Inducing=X_Inducing.to(dtype)
+        B=B.to(dtype) if B is not None else None
+    #Dimensions of data matrices:
+    batch_size,n_context_points,d=X_Context.size()
+    n_target_points=X_Target.size(1)
+    n_inducing_points=X_Inducing.size(1)
+    D=Y_Context.size(2)
+    Id_D=cached_eye(D,X_Context.device,X_Context.dtype)
+    gram,separable,P=gp_gram_function(D,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,Ker_project=Ker_project)
+    noise=obs_noise+chol_noise
+
+    #Cholesky decomposition of K(X_Inducing,X_Inducing):
+    Gram_inducing=gram(X_Inducing,X_Inducing)+chol_noise*torch.eye(n_inducing_points*P,dtype=X_Context.dtype,device=X_Context.device)
+    L_inducing=torch.cholesky(Gram_inducing)
+    #A=L_inducing^(-1)K(X_Inducing,X_Context)/sqrt(noise) --> shape (batch_size,n_inducing_points*P,n_context_points*P):
+    A=torch.triangular_solve(gram(X_Inducing,X_Context),L_inducing,upper=False)[0]/math.sqrt(noise)
+    #Padded context points do not contribute:
+    if context_mask is not None:
+        A=A*context_mask.to(X_Context.dtype).repeat_interleave(P,dim=1).unsqueeze(1)
+    #Cholesky decomposition of Id+AA^T:
+    L_B=torch.cholesky(torch.matmul(A,A.transpose(1,2))+torch.eye(n_inducing_points*P,dtype=X_Context.dtype,device=X_Context.device))
+    #c=L_B^(-1)AY/sqrt(noise) --> shape (batch_size,n_inducing_points*P,D/P):
+    c=torch.triangular_solve(torch.matmul(A,Y_Context.reshape(batch_size,n_context_points*P,D//P)),L_B,upper=False)[0]/math.sqrt(noise)
     
+    #A_Target=L_inducing^(-1)K(X_Inducing,X_Target) and V=L_B^(-1)A_Target --> shape (batch_size,n_inducing_points*P,n_target_points*P):
+    A_Target=torch.triangular_solve(gram(X_Inducing,X_Target),L_inducing,upper=False)[0]
+    V=torch.triangular_solve(A_Target,L_B,upper=False)[0]
     #Get prediction means and reshape it:
-    Means=torch.mv(Gram_target_context,torch.mv(inv_Gram_context,Y_Context.flatten()))
-    Means=Means.view(n_target_points,D)
-
-    #Get prediction covariance matrix:
-    Cov_Mat=Gram_target-torch.mm(Gram_target_context,torch.mm(inv_Gram_context,Gram_target_context.t()))
+    Means=torch.matmul(V.transpose(1,2),c).view(batch_size,n_target_points,D)
     
-    #Get the variances of the components and reshape it:
-    Vars=torch.diag(Cov_Mat).view(n_target_points,D)
+    #Get only the PxP diagonal blocks of K(X_Target,X_Target) --> shape (batch_size,n_target_points,P,P):
+    X_Target_Points=X_Target.reshape(batch_size*n_target_points,1,d)
+    Gram_target=gram(X_Target_Points,X_Target_Points).view(batch_size,n_target_points,P,P)
+    Gram_target=Gram_target+noise*torch.eye(P,dtype=X_Context.dtype,device=X_Context.device)
+    #Marginal covariances K_tt-A_Target^TA_Target+V^TV (diagonal blocks) --> shape (batch_size,n_target_points,P,P):
+    A_Target=A_Target.view(batch_size,n_inducing_points*P,n_target_points,P)
+    V=V.view(batch_size,n_inducing_points*P,n_target_points,P)
+    Cov_Mat=Gram_target-torch.einsum('bktd,bkte->btde',A_Target,A_Target)+torch.einsum('bktd,bkte->btde',V,V)
+    if separable:
+        Cov_Mat=Cov_Mat*Id_D
+    #Get the variances of the components:
+    Vars=torch.diagonal(Cov_Mat,dim1=2,dim2=3)
     
-    return(Means,Cov_Mat,Vars)
+    return(Means.to(out_dtype),Cov_Mat.to(out_dtype),Vars.to(out_dtype))
+
+#A GP posterior on a fixed target set to which context points are added incrementally. The Cholesky factor of the
+#context Gram matrix is extended by a block row for every added context point (bordered Cholesky update), so
+#the predictive marginals for all context sizes 1,...,max_n_context cost the same as one GP inference with max_n_context points:
+class IncrementalGP(object):
+    def __init__(self,X_Target,max_n_context,D,l_scale=1,sigma_var=1,kernel_type="rbf",obs_noise=0.1,B=None,Ker_project=False,chol_noise=1e-4,dtype=None):
+        '''
+        Input:
+            X_Target - torch.tensor - Shape (batch_size,n_target_points,d)
+            max_n_context - int - maximum number of context points
+            D - int - dimension of the output space
+            l_scale,sigma_var,kernel_type,obs_noise,B,Ker_project,chol_noise,dtype - see batch_gp_inference
+        '''
+        self.out_dtype=X_Target.dtype
+        self.dtype=dtype if dtype is not None else X_Target.dtype
+        self.X_Target=X_Target.to(self.dtype)
+        B=B.to(self.dtype) if B is not None else None
+        self.batch_size,self.n_target_points,_=X_Target.size()
+        self.max_n_context=max_n_context
+        self.D=D
+        self.noise=obs_noise+chol_noise
+        self.gram,self.separable,self.P=gp_gram_function(D,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,Ker_project=Ker_project)
+        P=self.P
+        device=X_Target.device
+        #Preallocated Cholesky factor L, V=L^(-1)K(X_Context,X_Target) and z=L^(-1)Y_Context:
+        self.L=torch.zeros(self.batch_size,max_n_context*P,max_n_context*P,dtype=self.dtype,device=device)
+        self.V=torch.zeros(self.batch_size,max_n_context*P,self.n_target_points*P,dtype=self.dtype,device=device)
+        self.z=torch.zeros(self.batch_size,max_n_context*P,D//P,dtype=self.dtype,device=device)
+        self.X_Context=torch.zeros(self.batch_size,max_n_context,self.X_Target.size(2),dtype=self.dtype,device=device)
+        #Prior means (zero) and marginal covariances of the targets, from which the contributions of the context points 
+        #are subtracted --> shape (batch_size,n_target_points,D) and (batch_size,n_target_points,P,P):
+        self.Means=torch.zeros(self.batch_size,self.n_target_points,D,dtype=self.dtype,device=device)
+        X_Target_Points=self.X_Target.reshape(self.batch_size*self.n_target_points,1,-1)
+        self.Cov_Mat=self.gram(X_Target_Points,X_Target_Points).view(self.batch_size,self.n_target_points,P,P)
+        self.Cov_Mat=self.Cov_Mat+self.noise*torch.eye(P,dtype=self.dtype,device=device)
+        #Number of context points added so far:
+        self.n_context=0
+
+    def add_context(self,X_New,Y_New):
+        '''
+        Input:
+            X_New - torch.tensor - Shape (batch_size,k,d) - new context points
+            Y_New - torch.tensor - Shape (batch_size,k,D) - labels of the new context points
+        '''
+        X_New=X_New.to(self.dtype)
+        Y_New=Y_New.to(self.dtype)
+        k=X_New.size(1)
+        if self.n_context+k>self.max_n_context:
+            sys.exit("Maximum number of context points exceeded.")
+        P=self.P
+        n=self.n_context*P
+        m=n+k*P
+        #Gram matrix of the new points plus noise --> shape (batch_size,k*P,k*P):
+        Gram_New=self.gram(X_New,X_New)+self.noise*torch.eye(k*P,dtype=self.dtype,device=X_New.device)
+        if self.n_context>0:
+            #Solve L_old*L_21^T=K(X_Old,X_New) --> shape (batch_size,n,k*P):
+            L_21_T=torch.triangular_solve(self.gram(self.X_Context[:,:self.n_context],X_New),self.L[:,:n,:n],upper=False)[0]
+            #Schur complement:
+            Gram_New=Gram_New-torch.matmul(L_21_T.transpose(1,2),L_21_T)
+            self.L[:,n:m,:n]=L_21_T.transpose(1,2)
+        #New diagonal block of the Cholesky factor:
+        L_22=torch.cholesky(Gram_New)
+        self.L[:,n:m,n:m]=L_22
+        #New rows of V and z:
+        Rhs_V=self.gram(X_New,self.X_Target)
+        Rhs_z=Y_New.reshape(self.batch_size,k*P,self.D//P)
+        if self.n_context>0:
+            Rhs_V=Rhs_V-torch.matmul(L_21_T.transpose(1,2),self.V[:,:n])
+            Rhs_z=Rhs_z-torch.matmul(L_21_T.transpose(1,2),self.z[:,:n])
+        V_New=torch.triangular_solve(Rhs_V,L_22,upper=False)[0]
+        z_New=torch.triangular_solve(Rhs_z,L_22,upper=False)[0]
+        self.V[:,n:m]=V_New
+        self.z[:,n:m]=z_New
+        self.X_Context[:,self.n_context:self.n_context+k]=X_New
+        self.n_context+=k
+        #Update the means and the marginal covariances with the contribution of the new rows:
+        self.Means=self.Means+torch.matmul(V_New.transpose(1,2),z_New).view(self.batch_size,self.n_target_points,self.D)
+        V_New=V_New.view(self.batch_size,k*P,self.n_target_points,P)
+        self.Cov_Mat=self.Cov_Mat-torch.einsum('bktd,bkte->btde',V_New,V_New)
+
+    def predict(self):
+        '''
+        Output: Means,Cov_Mat,Vars - predictive marginals given the current context points 
+                                     (see batch_gp_inference with full_cov=False)
+        '''
+        Cov_Mat=self.Cov_Mat*cached_eye(self.D,self.Cov_Mat.device,self.dtype) if self.separable else self.Cov_Mat
+        Vars=torch.diagonal(Cov_Mat,dim1=2,dim2=3)
+        return(self.Means.to(self.out_dtype),Cov_Mat.to(self.out_dtype),Vars.to(self.out_dtype))
+
+#A sampler of joint GP posterior samples via pathwise updates ("Efficiently Sampling Functions from Gaussian Process Posteriors"
+#by Wilson et al): f_post(x)=f(x)+K(x,X_Context)(K(X_Context,X_Context)+noise*Id)^(-1)(Y_Context-f(X_Context)-eps) where f is a prior
+#function sample (drawn with random Fourier features). The Cholesky factor of the context Gram matrix is computed once and reused
+#for every call of sample, which costs O(n_samples*n_target_points*n_context_points):
+class PathwiseGPSampler(object):
+    def __init__(self,X_Context,Y_Context,l_scale=1,sigma_var=1,kernel_type="rbf",obs_noise=0.1,B=None,Ker_project=False,chol_noise=1e-4,
+                 n_features=1000,dtype=None):
+        '''
+        Input:
+            X_Context - torch.tensor - Shape (batch_size,n_context_points,d)
+            Y_Context - torch.tensor- Shape (batch_size,n_context_points,D)
+            l_scale,sigma_var,kernel_type,obs_noise,B,Ker_project,chol_noise,dtype - see batch_gp_inference
+                (l_scale and sigma_var can be floats or tensors with one value per observation, e.g. shape (batch_size,1,1))
+            n_features - int - number of Fourier frequencies for the prior samples of the rbf, div_free and curl_free kernels
+        '''
+        self.out_dtype=X_Context.dtype
+        self.dtype=dtype if dtype is not None else X_Context.dtype
+        self.X_Context=X_Context.to(self.dtype)
+        self.Y_Context=Y_Context.to(self.dtype)
+        self.batch_size,self.n_context_points,self.d=X_Context.size()
+        self.D=Y_Context.size(2)
+        self.l_scale=l_scale
+        self.sigma_var=sigma_var
+        self.kernel_type=kernel_type
+        self.obs_noise=obs_noise
+        self.n_features=n_features
+        B=B.to(self.dtype) if B is not None else cached_eye(self.D,X_Context.device,self.dtype)
+        #Square root of B for the prior samples of separable kernels:
+        self.L_B=torch.cholesky(B) if get_kernel(kernel_type).separable else None
+        self.gram,self.separable,self.P=gp_gram_function(self.D,l_scale=l_scale,sigma_var=sigma_var,kernel_type=kernel_type,B=B,Ker_project=Ker_project)
+        #Cholesky decomposition of the context Gram matrix:
+        Gram_context=self.gram(self.X_Context,self.X_Context)
+        Gram_context=Gram_context+(obs_noise+chol_noise)*torch.eye(self.n_context_points*self.P,dtype=self.dtype,device=X_Context.device)
+        self.L=torch.cholesky(Gram_context)
+
+    #Kernel parameter as a tensor which broadcasts against tensors of shape (batch_size,n,*):
+    def batch_parameter(self,parameter,X):
+        '''
+        Input: parameter - float or torch.tensor - with one element or batch_size elements (e.g. shape (batch_size,1,1))
+               X - torch.tensor - gives device and dtype
+        Output: torch.tensor - shape () or (batch_size,1,1)
+        '''
+        parameter=torch.as_tensor(parameter,device=X.device,dtype=self.dtype)
+        if parameter.numel()==1:
+            return(parameter.view(()))
+        elif parameter.numel()==self.batch_size:
+            return(parameter.view(self.batch_size,1,1))
+        else:
+            sys.exit("Kernel parameters of PathwiseGPSampler must be scalars or have one value per observation.")
+
+    #Prior function samples at the points X_1,X_2 (the same functions at both sets of points):
+    def prior_samples(self,X_1,X_2,n_samples):
+        '''
+        Input: X_1,X_2 - torch.tensor - Shape (batch_size,n_1/n_2,d)
+               n_samples - int
+        Output: torch.tensor - Shape (batch_size,n_1/n_2,n_samples,D) - values of n_samples prior functions
+        '''
+        n_1=X_1.size(1)
+        X=torch.cat([X_1,X_2],dim=1)
+        if self.kernel_type=="dot_product":
+            #The dot product kernel has the exact features x:
+            Phi=X.unsqueeze(2)
+        else:
+            #Frequencies scaled by 1/sqrt(l_scale) (per observation if l_scale is a tensor) --> shape (n_features,d) or (batch_size,1,n_features,d):
+            Frequencies=rbf_fourier_frequencies(self.n_features,d=self.d,qmc=True).to(device=X.device,dtype=self.dtype)
+            Frequencies=Frequencies*torch.rsqrt(self.batch_parameter(self.l_scale,X).unsqueeze(-1))
+            Proj=torch.matmul(X.unsqueeze(-2),Frequencies.transpose(-2,-1)).squeeze(-2)
+            if self.kernel_type=="rbf":
+                #Fourier features --> shape (batch_size,n,1,2*n_features):
+                Phi=torch.sqrt(self.batch_parameter(self.sigma_var,X).unsqueeze(-1))*torch.cat([torch.cos(Proj),torch.sin(Proj)],dim=2).unsqueeze(2)
+            elif self.kernel_type in ["div_free","curl_free"]:
+                #The curl-free kernel is the covariance of the gradient of a GP with kernel exp(-0.5*|x-y|^2/l_scale), 
+                #the div-free kernel of its rotated gradient --> shape (batch_size,n,2,2*n_features):
+                Freq_T=Frequencies.transpose(-2,-1)
+                Phi=torch.cat([-torch.sin(Proj).unsqueeze(2)*Freq_T,torch.cos(Proj).unsqueeze(2)*Freq_T],dim=3)
+                if self.kernel_type=="div_free":
+                    Phi=torch.stack([Phi[:,:,1],-Phi[:,:,0]],dim=2)
+            else:
+                sys.exit("Unknown kernel type")
+            Phi=Phi/math.sqrt(self.n_features)
+        #Random weights and prior samples --> shape (batch_size,n,n_samples,D):
+        if self.L_B is not None:
+            W=torch.randn(self.batch_size,Phi.size(3),n_samples*self.D,dtype=self.dtype,device=X.device)
+            F_Prior=torch.matmul(Phi[:,:,0],W).view(self.batch_size,X.size(1),n_samples,self.D)
+            F_Prior=torch.matmul(F_Prior,self.L_B.t())
+        else:
+            W=torch.randn(self.batch_size,1,Phi.size(3),n_samples,dtype=self.dtype,device=X.device)
+            F_Prior=torch.matmul(Phi,W).transpose(2,3)
+        return(F_Prior[:,:n_1],F_Prior[:,n_1:])
+
+    def sample(self,X_Target,n_samples):
+        '''
+        Input: X_Target - torch.tensor - Shape (batch_size,n_target_points,d)
+               n_samples - int - number of samples
+        Output: torch.tensor - Shape (batch_size,n_samples,n_target_points,D) - joint posterior function samples at X_Target
+        '''
+        X_Target=X_Target.to(self.dtype)
+        n_target_points=X_Target.size(1)
+        F_Context,F_Target=self.prior_samples(self.X_Context,X_Target,n_samples)
+        #Residuals of the prior samples at the context points (with sampled observation noise) --> shape (batch_size,n_context_points,n_samples,D):
+        Residuals=self.Y_Context.unsqueeze(2)-F_Context-math.sqrt(self.obs_noise)*torch.randn_like(F_Context)
+        #Bring it in the shape of the Gram matrix --> shape (batch_size,n_context_points*P,n_samples*D/P):
+        if self.separable:
+            Residuals=Residuals.reshape(self.batch_size,self.n_context_points,n_samples*self.D)
+        else:
+            Residuals=Residuals.permute(0,1,3,2).reshape(self.batch_size,self.n_context_points*self.D,n_samples)
+        #Solve with the cached Cholesky factor and multiply with K(X_Target,X_Context):
+        Correction=torch.matmul(self.gram(X_Target,self.X_Context),torch.cholesky_solve(Residuals,self.L,upper=False))
+        if self.separable:
+            Correction=Correction.view(self.batch_size,n_target_points,n_samples,self.D)
+        else:
+            Correction=Correction.view(self.batch_size,n_target_points,self.D,n_samples).permute(0,1,3,2)
+        return((F_Target+Correction).permute(0,2,1,3).to(self.out_dtype))
+
+'''
+Structured kernel interpolation (KISS-GP, "Kernel Interpolation for Scalable Structured Gaussian Processes" by Wilson and Nickisch)
+for the rbf kernel: the kernel between points is approximated by K(X,Y)~W_X*K_Grid*W_Y^T where W_X are bilinear interpolation weights 
+onto a regular 2d grid and K_Grid=K_y (x) K_x is a Kronecker product (the rbf kernel factorizes along the axes). Linear systems with 
+the context Gram matrix are solved with preconditioned conjugate gradients, so the cost is near-linear in the number of points.
+'''
+#Bilinear interpolation weights of points onto a regular grid (points outside of the grid are projected onto it):
+def grid_interpolation_weights(X,x_axis,y_axis,outside="error"):
+    '''
+    Input: X - torch.tensor - shape (batch_size,n,2)
+           x_axis,y_axis - torch.tensor - shape (n_x_axis),(n_y_axis) - increasing, evenly spaced axes of the grid
+           outside - string - treatment of points outside of the grid: "error" - exit (e.g. for SKI, where they would get wrong 
+                              kernel values), "drop" - all weights are zero, "clamp" - moved to the border of the grid
+    Output: Ind - torch.tensor - shape (batch_size,n,4) - indices of the 4 neighbouring grid points (index i*n_x_axis+j for (x_axis[j],y_axis[i]))
+            Weights - torch.tensor - shape (batch_size,n,4) - interpolation weights
+    '''
+    n_x_axis=x_axis.size(0)
+    n_y_axis=y_axis.size(0)
+    #Position in units of the grid spacing:
+    F_x=(X[:,:,0]-x_axis[0])/(x_axis[-1]-x_axis[0])*(n_x_axis-1)
+    F_y=(X[:,:,1]-y_axis[0])/(y_axis[-1]-y_axis[0])*(n_y_axis-1)
+    #Points outside of the grid would get the kernel values of the border cell (only rounding errors are tolerated):
+    tol=1e-6
+    Inside=(F_x>=-tol)&(F_x<=n_x_axis-1+tol)&(F_y>=-tol)&(F_y<=n_y_axis-1+tol)
+    if outside=="error" and not Inside.all():
+        sys.exit("Interpolation error: points outside of the interpolation grid.")
+    elif outside not in ["error","drop","clamp"]:
+        sys.exit("Unknown treatment of points outside of the grid.")
+    F_x=F_x.clamp(min=0,max=n_x_axis-1)
+    F_y=F_y.clamp(min=0,max=n_y_axis-1)
+    #Lower left grid point and relative position in the cell:
+    Ind_x=F_x.floor().clamp(max=n_x_axis-2).long()
+    Ind_y=F_y.floor().clamp(max=n_y_axis-2).long()
+    T_x=F_x-Ind_x.to(X.dtype)
+    T_y=F_y-Ind_y.to(X.dtype)
+    Ind=torch.stack([Ind_y*n_x_axis+Ind_x,Ind_y*n_x_axis+Ind_x+1,(Ind_y+1)*n_x_axis+Ind_x,(Ind_y+1)*n_x_axis+Ind_x+1],dim=2)
+    Weights=torch.stack([(1-T_y)*(1-T_x),(1-T_y)*T_x,T_y*(1-T_x),T_y*T_x],dim=2)
+    if outside=="drop":
+        Weights=Weights*Inside.to(X.dtype).unsqueeze(2)
+    return(Ind,Weights)
+
+#Interpolation of values on the grid to the points (multiplication with W):
+def ski_interpolate(Values_Grid,Ind,Weights):
+    '''
+    Input: Values_Grid - torch.tensor - shape (batch_size,n_grid_points,R)
+           Ind,Weights - see grid_interpolation_weights
+    Output: torch.tensor - shape (batch_size,n,R)
+    '''
+    batch_size,n,_=Ind.size()
+    R=Values_Grid.size(2)
+    Values=torch.gather(Values_Grid,1,Ind.view(batch_size,n*4,1).expand(batch_size,n*4,R)).view(batch_size,n,4,R)
+    return(torch.sum(Weights.unsqueeze(3)*Values,dim=2))
+
+#Spreading of values at the points onto the grid (multiplication with W^T):
+def ski_scatter(Values,Ind,Weights,n_grid_points):
+    '''
+    Input: Values - torch.tensor - shape (batch_size,n,R)
+           Ind,Weights - see grid_interpolation_weights
+           n_grid_points - int
+    Output: torch.tensor - shape (batch_size,n_grid_points,R)
+    '''
+    batch_size,n,R=Values.size()
+    Values_Grid=torch.zeros(batch_size,n_grid_points,R,dtype=Values.dtype,device=Values.device)
+    Spread=(Weights.unsqueeze(3)*Values.unsqueeze(2)).view(batch_size,n*4,R)
+    return(Values_Grid.scatter_add_(1,Ind.view(batch_size,n*4,1).expand(batch_size,n*4,R),Spread))
+
+#Multiplication with the Kronecker product K_y (x) K_x:
+def kronecker_matmul(K_y,K_x,Values_Grid):
+    '''
+    Input: K_y,K_x - torch.tensor - shape (n_y_axis,n_y_axis),(n_x_axis,n_x_axis)
+           Values_Grid - torch.tensor - shape (batch_size,n_y_axis*n_x_axis,R)
+    Output: torch.tensor - shape (batch_size,n_y_axis*n_x_axis,R)
+    '''
+    batch_size,n_grid_points,R=Values_Grid.size()
+    Values_Grid=Values_Grid.view(batch_size,K_y.size(1),K_x.size(1),R)
+    return(torch.einsum('ij,bjkr,lk->bilr',K_y,Values_Grid,K_x).reshape(batch_size,n_grid_points,R))
+
+#The operators of a GP with rbf kernel with SKI: Kronecker factors of the kernel on the grid, interpolation weights and
+#the matrix-vector product with W_Context*K_Grid*W_Context^T+noise*Id (with its diagonal as Jacobi preconditioner):
+def ski_gp_operators(X_Context,X_Target,x_axis,y_axis,l_scale=1,sigma_var=1,obs_noise=0.1,B=None,chol_noise=1e-4,context_mask=None):
+    '''
+    Input: see batch_ski_gp_sampler
+    Output: K_y,K_x - torch.tensor - shape (n_y_axis,n_y_axis),(n_x_axis,n_x_axis) - Kronecker factors of the kernel on the grid
+            Context_Weights,Target_Weights - tuples (Ind,Weights) - see grid_interpolation_weights (padded context points have weight 0)
+            matmul - function - V --> (W_Context*K_Grid*W_Context^T+noise*Id)V for V of shape (batch_size,n_context_points,R)
+            Diag - torch.tensor - shape (batch_size,n_context_points,1) - diagonal of this matrix
+    '''
+    if B is not None and not my_utils.is_scalar_matrix(B):
+        sys.exit("SKI inference only for rbf kernels with B a multiple of the identity.")
+    c=1 if B is None else B[0,0].item()
+    n_grid_points=x_axis.size(0)*y_axis.size(0)
+    noise=obs_noise+chol_noise
+    #Kernel matrices along the axes (the variance is put into K_y):
+    K_x=torch.exp(-0.5*(x_axis.unsqueeze(1)-x_axis.unsqueeze(0))**2/l_scale)
+    K_y=c*sigma_var*torch.exp(-0.5*(y_axis.unsqueeze(1)-y_axis.unsqueeze(0))**2/l_scale)
+    #Interpolation weights of context and target points:
+    Ind_Context,Weights_Context=grid_interpolation_weights(X_Context,x_axis,y_axis)
+    Target_Weights=grid_interpolation_weights(X_Target,x_axis,y_axis)
+    #Padded context points are decoupled from the grid:
+    if context_mask is not None:
+        Weights_Context=Weights_Context*context_mask.to(X_Context.dtype).unsqueeze(2)
+    #Matrix-vector product with W*K_Grid*W^T+noise*Id:
+    def matmul(V):
+        V_Grid=kronecker_matmul(K_y,K_x,ski_scatter(V,Ind_Context,Weights_Context,n_grid_points))
+        return(ski_interpolate(V_Grid,Ind_Context,Weights_Context)+noise*V)
+    Diag=ski_diagonal(K_y,K_x,Ind_Context,Weights_Context).unsqueeze(2)+noise
+    return(K_y,K_x,(Ind_Context,Weights_Context),Target_Weights,matmul,Diag)
+
+#Diagonal of W*K_Grid*W^T (the SKI approximation of the prior variances at the points):
+def ski_diagonal(K_y,K_x,Ind,Weights):
+    '''
+    Input: K_y,K_x - see kronecker_matmul
+           Ind,Weights - see grid_interpolation_weights
+    Output: torch.tensor - shape (batch_size,n)
+    '''
+    n_x_axis=K_x.size(0)
+    K_Corners=K_y[Ind.unsqueeze(3)//n_x_axis,Ind.unsqueeze(2)//n_x_axis]*K_x[Ind.unsqueeze(3)%n_x_axis,Ind.unsqueeze(2)%n_x_axis]
+    return(torch.einsum('bna,bnak,bnk->bn',Weights,K_Corners,Weights))
+
+#Joint posterior samples (pathwise updates, see PathwiseGPSampler) and posterior means of a GP with rbf kernel with SKI:
+def batch_ski_gp_sampler(X_Context,Y_Context,X_Target,x_axis,y_axis,n_samples,l_scale=1,sigma_var=1,obs_noise=0.1,B=None,chol_noise=1e-4,
+                         context_mask=None,tol=1e-4,max_iter=200):
+    '''
+    Input:
+        X_Context - torch.tensor - Shape (batch_size,n_context_points,2)
+        Y_Context - torch.tensor- Shape (batch_size,n_context_points,D)
+        X_Target - torch.tensor - Shape (batch_size,n_target_points,2)
+        x_axis,y_axis - torch.tensor - shape (n_x_axis),(n_y_axis) - increasing, evenly spaced axes of the interpolation grid 
+                                       (all context and target points have to lie in the grid)
+        n_samples - int - number of posterior samples
+        l_scale,sigma_var,obs_noise,chol_noise,context_mask - see batch_gp_inference
+        B - torch.tensor or None - shape (D,D) - has to be a multiple of the identity
+        tol,max_iter - parameters of the conjugate gradient method (see my_utils.batch_conjugate_gradients)
+    Output:
+        Means - torch.tensor - Shape (batch_size,n_target_points,D) - posterior means
+        Samples - torch.tensor - Shape (batch_size,n_samples,n_target_points,D) - joint posterior samples of the function values at X_Target
+    '''
+    batch_size,n_context_points,_=X_Context.size()
+    n_target_points=X_Target.size(1)
+    D=Y_Context.size(2)
+    n_grid_points=x_axis.size(0)*y_axis.size(0)
+    K_y,K_x,(Ind_Context,Weights_Context),(Ind_Target,Weights_Target),matmul,Diag=ski_gp_operators(X_Context,X_Target,x_axis,y_axis,
+                                    l_scale=l_scale,sigma_var=sigma_var,obs_noise=obs_noise,B=B,chol_noise=chol_noise,context_mask=context_mask)
+    if context_mask is not None:
+        Y_Context=Y_Context*context_mask.to(X_Context.dtype).unsqueeze(2)
+
+    #Prior samples on the grid via the Cholesky factors of the Kronecker factors, interpolated to the points 
+    #--> shape (batch_size,n_context_points/n_target_points,n_samples*D):
+    L_x=torch.cholesky(K_x+chol_noise*torch.eye(K_x.size(0),dtype=K_x.dtype,device=K_x.device))
+    L_y=torch.cholesky(K_y+chol_noise*torch.eye(K_y.size(0),dtype=K_y.dtype,device=K_y.device))
+    F_Grid=kronecker_matmul(L_y,L_x,torch.randn(batch_size,n_grid_points,n_samples*D,dtype=X_Context.dtype,device=X_Context.device))
+    F_Context=ski_interpolate(F_Grid,Ind_Context,Weights_Context)
+    F_Target=ski_interpolate(F_Grid,Ind_Target,Weights_Target)
+
+    #Right-hand sides: the data (for the means) and the residuals of the prior samples (for the samples) --> shape (batch_size,n_context_points,(n_samples+1)*D):
+    Residuals=Y_Context.repeat(1,1,n_samples)-F_Context-math.sqrt(obs_noise)*torch.randn_like(F_Context)
+    Rhs=torch.cat([Y_Context,Residuals],dim=2)
+    Alpha=my_utils.batch_conjugate_gradients(matmul,Rhs,Diag=Diag,tol=tol,max_iter=max_iter)
+
+    #Multiply with K(X_Target,X_Context)~W_Target*K_Grid*W_Context^T:
+    Correction=ski_interpolate(kronecker_matmul(K_y,K_x,ski_scatter(Alpha,Ind_Context,Weights_Context,n_grid_points)),Ind_Target,Weights_Target)
+    Means=Correction[:,:,:D]
+    Samples=(F_Target+Correction[:,:,D:]).view(batch_size,n_target_points,n_samples,D).permute(0,2,1,3)
+    return(Means,Samples)
+
+#GP inference with SKI: means of the SKI approximation (exact up to the conjugate gradient tolerance) and marginal variances
+#with a low-rank Lanczos cache (LOVE, Pleiss et al. 2018): (K_CC+noise*Id)^(-1)~Q*T^(-1)*Q^T on the Krylov space of the 
+#summed cross-covariances K_Ct (deterministic). Then Var_t=K_tt-|L^(-1)Q^T K_Ct|^2 with T=LL^T costs O(n_lanczos) per target,
+#Q^T K_Ct=W_Target*(K_Grid*W_Context^T*Q) needs n_lanczos grid vectors only:
+def batch_ski_gp_inference(X_Context,Y_Context,X_Target,x_axis,y_axis,l_scale=1,sigma_var=1,obs_noise=0.1,B=None,chol_noise=1e-4,
+                           context_mask=None,tol=1e-4,max_iter=200,n_lanczos=50):
+    '''
+    Input: see batch_ski_gp_sampler
+           n_lanczos - int - rank of the Lanczos cache for the variances (the variances are exact for n_lanczos>=n_context_points
+                             up to rounding errors)
+    Output:
+        Means - torch.tensor - Shape (batch_size,n_target_points, D) - Means of conditional dist.
+        Cov_Mat- torch.tensor - Shape (batch_size,n_target_points,D,D) - marginal covariance matrices of conditional dist. (including noise)
+        Vars - torch.tensor - Shape (batch_size,n_target_points,D) - Variance of individual components 
+    '''
+    batch_size,n_target_points,_=X_Target.size()
+    D=Y_Context.size(2)
+    n_grid_points=x_axis.size(0)*y_axis.size(0)
+    K_y,K_x,(Ind_Context,Weights_Context),(Ind_Target,Weights_Target),matmul,Diag=ski_gp_operators(X_Context,X_Target,x_axis,y_axis,
+                                    l_scale=l_scale,sigma_var=sigma_var,obs_noise=obs_noise,B=B,chol_noise=chol_noise,context_mask=context_mask)
+    if context_mask is not None:
+        Y_Context=Y_Context*context_mask.to(X_Context.dtype).unsqueeze(2)
+    #Means --> shape (batch_size,n_target_points,D):
+    Alpha=my_utils.batch_conjugate_gradients(matmul,Y_Context,Diag=Diag,tol=tol,max_iter=max_iter)
+    Means=ski_interpolate(kronecker_matmul(K_y,K_x,ski_scatter(Alpha,Ind_Context,Weights_Context,n_grid_points)),Ind_Target,Weights_Target)
 
+    #Start vector of the Lanczos iteration: sum of the cross-covariances K_Ct over all targets --> shape (batch_size,n_context_points,1):
+    Ones_Target=torch.ones(batch_size,n_target_points,1,dtype=X_Target.dtype,device=X_Target.device)
+    Init=ski_interpolate(kronecker_matmul(K_y,K_x,ski_scatter(Ones_Target,Ind_Target,Weights_Target,n_grid_points)),Ind_Context,Weights_Context)
+    Q,T=my_utils.batch_lanczos(matmul,Init,n_lanczos)
+    #Q^T K_Ct for all targets --> shape (batch_size,n_lanczos,n_target_points):
+    Q_K=ski_interpolate(kronecker_matmul(K_y,K_x,ski_scatter(Q,Ind_Context,Weights_Context,n_grid_points)),Ind_Target,Weights_Target).transpose(1,2)
+    L_T=torch.cholesky(T+chol_noise*torch.eye(T.size(1),dtype=T.dtype,device=T.device))
+    Reduction=torch.sum(torch.triangular_solve(Q_K,L_T,upper=False)[0]**2,dim=1)
+    #The D components are independent with the same variance --> shape (batch_size,n_target_points,1):
+    Vars=(ski_diagonal(K_y,K_x,Ind_Target,Weights_Target)-Reduction).clamp(min=0).unsqueeze(2)+obs_noise+chol_noise
+    Vars=Vars.repeat(1,1,D)
+    return(Means,Vars.diag_embed(),Vars)
 
 '''
 ____________________________________________________________________________________________________________________
@@ -164,6 +164,19 @@ def give_2d_grid(min_x,max_x,n_x_axis,min_y=None,max_y=None,n_y_axis=None,flatte
         Z=Z.view(n_y_axis*n_x_axis,2)
     return(Z)
 
+#Evenly spaced axis with n_axis points which covers [min,max] and n_pad additional grid spacings on both sides:
+def padded_axis(min,max,n_axis,n_pad=1):
+    '''
+    Input: min,max - float - range which has to be covered
+           n_axis - int - number of points of the axis (has to be larger than 2*n_pad+1)
+           n_pad - int - number of grid spacings added on both sides
+    Output: torch.tensor - shape (n_axis) - increasing axis
+    '''
+    if n_axis<=2*n_pad+1:
+        sys.exit("Number of points of the padded axis has to be larger than 2*n_pad+1.")
+    pad=n_pad*(max-min)/(n_axis-1-2*n_pad)
+    return(torch.linspace(min-pad,max+pad,n_axis))
+
 def radial_grid(min,max,n_axis):
     X=give_2d_grid(min,max,n_axis,flatten=False)
     Ind=bool_inner_circle_indices(n_axis)
@@ -252,13 +265,22 @@ def get_block_diagonal(X,size=1):
     '''
     Input: X - torch.tensor - shape (n,n)
            size - int - size divides n
-    Output: torch.tensor - shape (n/size,size*size) - block diagonals of X
+    Output: torch.tensor - shape (n/size,size,size) - block diagonals of X
     '''
-    m=X.size(0)//size
-    Sigma=torch.empty((m,size,size)).to(X.device)
-    for i in range(m):
-        Sigma[i]=X[(i*size):(i+1)*size,(i*size):(i+1)*size]
-    return Sigma
+    return(batch_get_block_diagonal(X.unsqueeze(0),size=size)[0])
+
+#A function to get the block diagonals of a batch of matrices (batchwise version of the above function):
+def batch_get_block_diagonal(X,size=1):
+    '''
+    Input: X - torch.tensor - shape (batch_size,n,n)
+           size - int - size divides n
+    Output: torch.tensor - shape (batch_size,n/size,size,size) - block diagonals of X
+    '''
+    batch_size=X.size(0)
+    m=X.size(1)//size
+    #Diagonal over the block indices --> shape (batch_size,size,size,m):
+    Sigma=torch.diagonal(X.reshape(batch_size,m,size,m,size),dim1=1,dim2=3)
+    return(Sigma.permute(0,3,1,2))
 
 #A function to create a matrix from block matrices (merges the block matrices):
 def create_matrix_from_blocks(X):
@@ -268,13 +290,10 @@ def create_matrix_from_blocks(X):
     Output:
         torch-tensor - shape (n*D_1,m*D_2) - block (i,j) of size D_1*D_2 is matrix X[i,j] for i=1,...,n,j=1,...,m
     '''
-    n=X.size(0)
-    m=X.size(1)
-    D_1=X.size(2)
-    D_2=X.size(3)
-    M=torch.cat([X[:,:,i,:].reshape(n,m*D_2) for i in range(D_1)])
-    ind=torch.cat([torch.arange(i,D_1*n,n,dtype=torch.long) for i in range(n)])
-    return(M[ind])
+    n,m,D_1,D_2=X.size()
+    #Bring the blocks into the interleaved layout (n,D_1,m,D_2) (this is only a view if X is itself a permuted view
+    #of an interleaved tensor as returned by the Gram matrix functions):
+    return(X.permute(0,2,1,3).reshape(n*D_1,m*D_2))
 
 #A function to create a matrix from block matrices (merges the block matrices) (batchwise version of the above function):
 def batch_create_matrix_from_blocks(X):
@@ -284,14 +303,93 @@ def batch_create_matrix_from_blocks(X):
     Output:
         torch-tensor - shape (batch_size,n*D_1,m*D_2) - block (i,j) of size D_1*D_2 is matrix X[i,j] for i=1,...,n,j=1,...,m
     '''
-    batch_size=X.size(0)
-    n=X.size(1)
-    m=X.size(2)
-    D_1=X.size(3)
-    D_2=X.size(4)
-    M=torch.cat([X[:,:,:,i,:].reshape(batch_size,n,m*D_2) for i in range(D_1)],dim=1)
-    ind=torch.cat([torch.arange(i,D_1*n,n,dtype=torch.long) for i in range(n)])
-    return(M[:,ind])
+    batch_size,n,m,D_1,D_2=X.size()
+    return(X.permute(0,1,3,2,4).reshape(batch_size,n*D_1,m*D_2))
+
+#A function to check whether a square matrix is a multiple of the identity (e.g. to use separable kernels):
+def is_scalar_matrix(B):
+    '''
+    Input: B - torch.tensor - shape (D,D)
+    Output: Boolean - True if B=c*Id for a scalar c
+    '''
+    return(torch.equal(B,B[0,0]*torch.eye(B.size(0),dtype=B.dtype,device=B.device)))
+
+#A function to solve a batch of linear systems with 2x2 matrices via the explicit formula for the inverse:
+def batch_solve_2d(A,y):
+    '''
+    Input: A - torch.tensor - shape (*,2,2) - invertible matrices
+           y - torch.tensor - shape (*,2) 
+    Output: torch.tensor - shape (*,2) - A^(-1)y
+    '''
+    det=A[...,0,0]*A[...,1,1]-A[...,0,1]*A[...,1,0]
+    x_0=(A[...,1,1]*y[...,0]-A[...,0,1]*y[...,1])/det
+    x_1=(A[...,0,0]*y[...,1]-A[...,1,0]*y[...,0])/det
+    return(torch.stack([x_0,x_1],dim=-1))
+
+#A function to solve a batch of symmetric positive definite linear systems A*x=b with the preconditioned conjugate gradient method
+#(A is only given by its matrix-vector product, the preconditioner is the inverse of a given diagonal):
+def batch_conjugate_gradients(matmul,Rhs,Diag=None,tol=1e-4,max_iter=200):
+    '''
+    Input: matmul - function - matmul(X) gives A*X for X of shape (batch_size,n,R)
+           Rhs - torch.tensor - shape (batch_size,n,R) - R right-hand sides
+           Diag - torch.tensor or None - shape (batch_size,n,1) - diagonal of A (Jacobi preconditioner)
+           tol - float - relative tolerance of the residual norm of every right-hand side
+           max_iter - int - maximum number of iterations
+    Output: torch.tensor - shape (batch_size,n,R) - approximate solutions A^(-1)*Rhs
+    '''
+    Inv_Diag=1/Diag if Diag is not None else torch.ones_like(Rhs[:,:,:1])
+    X=torch.zeros_like(Rhs)
+    Res=Rhs.clone()
+    Z=Inv_Diag*Res
+    Dir=Z
+    Res_Z=(Res*Z).sum(dim=1,keepdim=True)
+    Rhs_Norm=Rhs.norm(dim=1,keepdim=True).clamp(min=1e-30)
+    for it in range(max_iter):
+        A_Dir=matmul(Dir)
+        alpha=Res_Z/(Dir*A_Dir).sum(dim=1,keepdim=True).clamp(min=1e-30)
+        X=X+alpha*Dir
+        Res=Res-alpha*A_Dir
+        if (Res.norm(dim=1,keepdim=True)/Rhs_Norm).max()<tol:
+            break
+        Z=Inv_Diag*Res
+        Res_Z_New=(Res*Z).sum(dim=1,keepdim=True)
+        Dir=Z+(Res_Z_New/Res_Z.clamp(min=1e-30))*Dir
+        Res_Z=Res_Z_New
+    return(X)
+
+#Lanczos tridiagonalization of a batch of symmetric positive definite matrices given by their matrix-vector products
+#(with full reorthogonalization): A~Q*T*Q^T on the Krylov space of Init:
+def batch_lanczos(matmul,Init,n_iter,tol=1e-10):
+    '''
+    Input: matmul - function - matmul(X) gives A*X for X of shape (batch_size,n,R)
+           Init - torch.tensor - shape (batch_size,n,1) - start vectors
+           n_iter - int - number of iterations (rank of the approximation, at most n)
+           tol - float - if the norm of a new Lanczos vector is below tol, the Krylov space is exhausted 
+                         (the vector is set to zero for this batch element)
+    Output: Q - torch.tensor - shape (batch_size,n,n_iter) - orthonormal Lanczos vectors
+            T - torch.tensor - shape (batch_size,n_iter,n_iter) - tridiagonal matrix Q^T*A*Q
+    '''
+    batch_size,n,_=Init.size()
+    n_iter=min(n_iter,n)
+    Q=torch.zeros(batch_size,n,n_iter,dtype=Init.dtype,device=Init.device)
+    Alpha=torch.zeros(batch_size,n_iter,dtype=Init.dtype,device=Init.device)
+    Beta=torch.zeros(batch_size,n_iter-1,dtype=Init.dtype,device=Init.device)
+    Init_Norm=Init.norm(dim=1,keepdim=True)
+    q=torch.where(Init_Norm>tol,Init/Init_Norm.clamp(min=tol),torch.zeros_like(Init))
+    for j in range(n_iter):
+        Q[:,:,j:j+1]=q
+        V=matmul(q)
+        Alpha[:,j]=(q*V).sum(dim=(1,2))
+        if j==n_iter-1:
+            break
+        #Full reorthogonalization against all previous Lanczos vectors (includes the three-term recurrence):
+        V=V-torch.matmul(Q[:,:,:j+1],torch.matmul(Q[:,:,:j+1].transpose(1,2),V))
+        V=V-torch.matmul(Q[:,:,:j+1],torch.matmul(Q[:,:,:j+1].transpose(1,2),V))
+        V_Norm=V.norm(dim=1,keepdim=True)
+        Beta[:,j]=torch.where(V_Norm>tol,V_Norm,torch.zeros_like(V_Norm)).view(batch_size)
+        q=torch.where(V_Norm>tol,V/V_Norm.clamp(min=tol),torch.zeros_like(V))
+    T=Alpha.diag_embed()+Beta.diag_embed(offset=1)+Beta.diag_embed(offset=-1)
+    return(Q,T)
 
 #The following function compute the eigenvalue decomposition of a batch 
 # of symmetric 2d matrices - represented as vector in R3:
@@ -461,6 +559,59 @@ def batch_multivar_log_ll(Means,Covs,data):
     log_ll=log_normalizer-0.5*Quad_Term
     return(log_ll)
 
+def masked_mean(X,mask=None,dim=None):
+    '''
+    Input:
+        X - torch.tensor - shape (batch_size,n,*) - e.g. log-likelihoods of observations or encoder outputs
+        mask - None or torch.tensor - shape (batch_size,n) - 1 for valid entries, 0 for padding
+        dim - None or int - if None, the mean is taken over all entries, otherwise only along dim
+    Output:
+        torch.tensor - shape () if dim is None, else shape of X without dim - mean over the valid entries of X
+                       (rows without any valid entry give 0 instead of a division by zero)
+    '''
+    if mask is None:
+        return(X.mean() if dim is None else X.mean(dim=dim))
+    #Append singleton dimensions to the mask and broadcast it to the shape of X:
+    mask=mask.to(X.dtype)
+    mask=mask.view(mask.shape+(1,)*(X.dim()-mask.dim())).expand_as(X)
+    X=torch.where(mask>0,X,torch.zeros_like(X))
+    if dim is None:
+        return(X.sum()/mask.sum().clamp(min=1.))
+    return(X.sum(dim=dim)/mask.sum(dim=dim).clamp(min=1.))
+
+#This function splits a batch of point sets into padded context and target sets with a different number of context points per set:
+def ragged_context_target_split(X,Y,n_context_points,cont_in_target=False,Y_target=None):
+    '''
+    Input:
+        X - torch.tensor - shape (batch_size,n_points,dim_X) - inputs, shuffled such that the first points are the context points
+        Y - torch.tensor - shape (batch_size,n_points,dim_Y) - outputs at X
+        n_context_points - torch.tensor of ints - shape (batch_size) - number of context points per set
+        cont_in_target - Boolean - if True, the target set is the whole set (and includes the context set)
+        Y_target - None or torch.tensor - shape (batch_size,n_points,dim_Y_target) - outputs used for the target set
+                   (if None, Y is used)
+    Output:
+        X_context,Y_context - torch.tensor - shape (batch_size,max_n_context,dim_X/dim_Y) - padded context sets
+        X_target,Y_target - torch.tensor - shape (batch_size,max_n_target,dim_X/dim_Y_target) - padded target sets
+        context_mask - torch.tensor - shape (batch_size,max_n_context) - True for context points, False for padding
+        target_mask - torch.tensor - shape (batch_size,max_n_target) - True for target points, False for padding
+                      (None if cont_in_target, then there is no padding)
+    The padded entries are filled with other (valid) points of the same set.
+    '''
+    if Y_target is None:
+        Y_target=Y
+    max_n_context=n_context_points.max().item()
+    context_mask=torch.arange(max_n_context,device=X.device).unsqueeze(0)<n_context_points.to(X.device).unsqueeze(1)
+    if cont_in_target:
+        return(X[:,:max_n_context],Y[:,:max_n_context],X,Y_target,context_mask,None)
+    #The target set of set i are the points n_context_points[i],n_context_points[i]+1,...:
+    n_points=X.size(1)
+    Target_Ind=n_context_points.to(X.device).unsqueeze(1)+torch.arange(n_points-n_context_points.min().item(),device=X.device).unsqueeze(0)
+    target_mask=Target_Ind<n_points
+    Target_Ind=Target_Ind.clamp(max=n_points-1).unsqueeze(2)
+    X_target=torch.gather(X,1,Target_Ind.expand(-1,-1,X.size(2)))
+    Y_target=torch.gather(Y_target,1,Target_Ind.expand(-1,-1,Y_target.size(2)))
+    return(X[:,:max_n_context],Y[:,:max_n_context],X_target,Y_target,context_mask,target_mask)
+
 
 
 
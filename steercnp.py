@@ -23,6 +23,8 @@ import matplotlib.cm as cm
 #Tools:
 import datetime
 import sys
+import hashlib
+from collections import OrderedDict
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
@@ -45,7 +47,8 @@ torch.set_default_dtype(torch.float)
 '''     
 class SteerCNP(nn.Module):
     def __init__(self, encoder, decoder,dim_cov_est=3, dim_context_feat=2,
-                         l_scale=1.,normalize_output=True,kernel_dict_out={'kernel_type':"rbf"}):
+                         l_scale=1.,normalize_output=True,kernel_dict_out={'kernel_type':"rbf"},memory_budget=None,
+                         smoother="dense",smoother_tol=1e-4,recompute_kernel=False,n_features=256,cache_size=0):
         '''
         Inputs:
             encoder - instance of EquivEncoder.EquivEncoder class above
@@ -54,6 +57,19 @@ class SteerCNP(nn.Module):
             l_scale - float - gives initialisation for learnable length parameter
             normalize_output  - Boolean - indicates whether kernel smoothing is performed with normalizing
             kernel_dict_out - gives parameters for kernel smoother of output
+            memory_budget - int or None - maximum number of kernel elements computed at once in the target smoother 
+                                          (see GP.batch_kernel_smoother_2d)
+            smoother - string - type of target smoother: "dense" - smoothing from all grid points
+                                                         "window" - smoothing only from a window of grid points around every target
+                                                                    (only rbf kernels, see GP.batch_grid_window_smoother_2d)
+                                                         "rff" - approximation with random Fourier features
+                                                                 (only rbf kernels, see GP.batch_rff_smoother_2d)
+            smoother_tol - float - largest kernel weight which is neglected by the "window" smoother
+            recompute_kernel - Boolean - if True, the kernel weights of the "dense" smoother are recomputed in the backward pass
+                                         instead of being saved (see GP.RBFSmoothing)
+            n_features - int - number of Fourier frequencies for the "rff" smoother
+            cache_size - int - maximum number of final feature maps kept (keyed by the context set) for repeated queries 
+                               in evaluation mode without gradients (0 - no cache), see forward
         '''
         #-----------------------SAVING OF PARAMETERS ----------------------------------
         super(SteerCNP, self).__init__()
@@ -71,6 +87,21 @@ class SteerCNP(nn.Module):
         #Save the dimension of the covariance estimator of the last layer:
         self.dim_cov_est=dim_cov_est
         self.dim_context_feat=dim_context_feat
+        #Save the memory budget for the target smoother:
+        self.memory_budget=memory_budget
+        #Save the type of target smoother:
+        self.smoother=smoother
+        self.smoother_tol=smoother_tol
+        self.recompute_kernel=recompute_kernel
+        self.n_features=n_features
+        #Fourier frequencies for the "rff" smoother (fixed seed, so that they are the same when the model is reloaded):
+        if self.smoother=="rff":
+            self.frequencies=nn.Parameter(GP.rbf_fourier_frequencies(self.n_features,d=2,qmc=True,seed=0),requires_grad=False)
+        #Least recently used cache of final feature maps (keys are hashes of the context sets):
+        self.cache_size=cache_size
+        self.feature_map_cache=OrderedDict()
+        #Kernel table for target points on a fixed lattice (see set_lattice):
+        self.lattice_table=None
         #-----------------------SAVING of PARAMETERS FINISHED---------------------------------
 
 
@@ -83,6 +114,9 @@ class SteerCNP(nn.Module):
         if not isinstance(l_scale,float): sys.exit("l_scale initialization has to be a float.")
         if not isinstance(encoder,equiv_encoder.EquivEncoder): sys.exit("Enoder is not correct.")
         if not isinstance(decoder, nn.Module): sys.exit("Decoder has to be nn.Module")
+        if smoother not in ["dense","window","rff"]: sys.exit("Unknown smoother type.")
+        if not isinstance(cache_size,int) or cache_size<0: sys.exit("Cache size has to be a non-negative integer.")
+        if getattr(decoder,'n_scales',1)!=encoder.n_scales: sys.exit("Number of length scales of encoder and decoder do not match.")
         #--------------------END CONTROL OF PARAMETERS----------------------
         '''
         #-------------------CONTROL WHETHER DECODER ACCEPTS AND RETURNS CORRECT SHAPES----
@@ -93,6 +127,40 @@ class SteerCNP(nn.Module):
         if (self.dim_cov_est+2)!=test_output.size(1):sys.exit("Number of output channels!=2+dim of cov estimation.")
         #-------------------END CONTROL WHETHER DECODER ACCEPTS AND RETURNS CORRECT SHAPES----
         '''
+    #Kernel smoothing of values on the grid of the encoder to the target set:
+    def grid_smoother(self,X_target,Values_grid,l_scale,kernel_dict):
+        '''
+        Input: X_target - torch.tensor- shape (batch_size,n_target,2)
+               Values_grid - torch.tensor - shape (batch_size,self.encoder.n_y_axis*self.encoder.n_x_axis,D)
+               l_scale - torch.tensor - length scale of the kernel
+               kernel_dict - dict - other kernel parameters (see GP.batch_kernel_smoother_2d)
+        Output: torch.tensor - shape (batch_size,n_target,D) - smoothed values on the target set
+        '''
+        batch_size=X_target.size(0)
+        #Target points given as indices of lattice points (see set_lattice):
+        if not torch.is_floating_point(X_target):
+            if self.lattice_table is None:
+                sys.exit("Inputs are indices but no lattice is set.")
+            if kernel_dict.get('kernel_type',"rbf")=="rbf" and kernel_dict.get('B') is None and self.lattice_table.usable(l_scale):
+                return(GP.batch_lattice_smoother(X_target,Values_grid,self.lattice_table,normalize=self.normalize_output,
+                                                 l_scale=l_scale,sigma_var=kernel_dict.get('sigma_var',1)))
+            X_target=self.lattice_table.Lattice.to(Values_grid.device)[X_target]
+        #Smoothing from a local window of the grid (only for the rbf kernel):
+        if self.smoother=="window" and kernel_dict.get('kernel_type',"rbf")=="rbf" and kernel_dict.get('B') is None:
+            n_x_axis=self.encoder.n_x_axis
+            return(GP.batch_grid_window_smoother_2d(Values_grid.reshape(batch_size,self.encoder.n_y_axis,n_x_axis,-1),X_target,
+                                                    x_axis=self.encoder.grid[:n_x_axis,0],y_axis=self.encoder.grid[::n_x_axis,1],
+                                                    normalize=self.normalize_output,l_scale=l_scale,
+                                                    sigma_var=kernel_dict.get('sigma_var',1),tol=self.smoother_tol))
+        #Create a batch-version of the grid (need shape (batch_size,n,2)):
+        expand_grid=self.encoder.grid.unsqueeze(0).expand(batch_size,self.encoder.grid.size(0),2)
+        #Smoothing with Fourier features (only for the rbf kernel):
+        if self.smoother=="rff" and kernel_dict.get('kernel_type',"rbf")=="rbf" and kernel_dict.get('B') is None:
+            return(GP.batch_rff_smoother_2d(X_Context=expand_grid,Y_Context=Values_grid,X_Target=X_target,Frequencies=self.frequencies,
+                                            normalize=self.normalize_output,l_scale=l_scale,sigma_var=kernel_dict.get('sigma_var',1)))
+        return(GP.batch_kernel_smoother_2d(X_Context=expand_grid,Y_Context=Values_grid,X_Target=X_target,normalize=self.normalize_output,
+                                           l_scale=l_scale,memory_budget=self.memory_budget,recompute=self.recompute_kernel,**kernel_dict))
+
     #Define the function which maps the output of the decoder to
     #predictions on the target set based on kernel smoothing, i.e. the predictions on 
     #the target set are obtained by kernel smoothing of these points on the grid of encoder
@@ -120,43 +188,156 @@ class SteerCNP(nn.Module):
         #-----------APPLY KERNEL SMOOTHING --------------------------------------
         #Set the lenght scale (clamp for numerical stability):
         l_scale=torch.exp(torch.clamp(self.log_l_scale_out,max=5.,min=-5.))
-        #Create a batch-version of the grid (need shape (batch_size,n,2)):
-        expand_grid=self.encoder.grid.unsqueeze(0).expand(batch_size,self.encoder.grid.size(0),2)
         #Means on Target Set (via Kernel smoothing) --> shape (batch_size,n_target,2):
-        Means_target=GP.batch_kernel_smoother_2d(X_Context=expand_grid,
-                                          Y_Context=Means_grid,
-                                           X_Target=X_target,normalize=self.normalize_output,
-                                           l_scale=l_scale,**self.kernel_dict_out)
+        Means_target=self.grid_smoother(X_target,Means_grid,l_scale,self.kernel_dict_out)
         
         #Create flattened version (needed for target smoother):
         Covs_grid_flat=Covs_grid.view(batch_size,self.encoder.n_y_axis*self.encoder.n_x_axis,-1)
         #3.Get covariances on target set--> shape (batch_size,n_target,4):
-        Covs_target_flat=GP.batch_kernel_smoother_2d(X_Context=expand_grid,
-                                            Y_Context=Covs_grid_flat,
-                                          X_Target=X_target,normalize=self.normalize_output,
-                                          l_scale=l_scale,kernel_type="rbf")                                 
+        Covs_target_flat=self.grid_smoother(X_target,Covs_grid_flat,l_scale,{'kernel_type':"rbf"})
         #Reshape covariance matrices to proper matrices --> shape (batch_size,n_target,2,2):
         Covs_target=Covs_target_flat.view(batch_size,X_target.size(1),2,2)
         #-----------END APPLY KERNEL SMOOTHING --------------------------------------
         return(Means_target, Covs_target)
 
+    #If all context and target points lie on a fixed lattice (e.g. the ERA5 grid), the kernels of the encoder and of the 
+    #target smoother are precomputed (rebuilt only when the length scales change) and the inputs can be given as indices:
+    def set_lattice(self,Lattice):
+        '''
+        Input: Lattice - torch.tensor or None - shape (n_lattice,2) - coordinates of the lattice points (None - no lattice)
+        '''
+        #Cached feature maps are keyed by the indices of the context points, which refer to the old lattice:
+        self.clear_cache()
+        self.encoder.set_lattice(Lattice)
+        self.lattice_table=GP.LatticeKernelTable(Lattice,self.encoder.grid) if Lattice is not None else None
+
+    def give_lattice(self):
+        '''
+        Output: torch.tensor or None - coordinates of the lattice points (see set_lattice)
+        '''
+        return(self.lattice_table.Lattice if self.lattice_table is not None else None)
+
+    #Functions for streaming context points (only the decoder and the target smoother are run for a prediction,
+    #the embedding is updated incrementally, see EquivEncoder.add_context):
+    def reset_context(self):
+        self.encoder.reset_context()
+
+    def add_context(self,X_context,Y_context):
+        '''
+        Inputs: X_context: torch.tensor - shape (batch_size,n_new,2)
+                Y_context: torch.tensor - shape (batch_size,n_new,2)
+        '''
+        self.encoder.add_context(X_context,Y_context)
+
+    def remove_context(self,X_context,Y_context):
+        '''
+        Inputs: X_context: torch.tensor - shape (batch_size,n_removed,2)
+                Y_context: torch.tensor - shape (batch_size,n_removed,2)
+        '''
+        self.encoder.remove_context(X_context,Y_context)
+
+    def predict(self,X_target):
+        '''
+        Input: X_target: torch.tensor - shape (batch_size,n_target,2)
+        Output: see forward (with all context points added so far)
+        '''
+        Final_Feature_Map=self.decode_feature_map(self.encoder.give_context_embedding())
+        return(self.smooth_to_targets(X_target,Final_Feature_Map))
+
+    #The forward pass split in its three steps (so that the final feature map can be reused for several target sets):
+    def encode(self,X_context,Y_context,context_mask=None):
+        '''
+        Inputs: X_context,Y_context,context_mask - see forward
+        Output: torch.tensor - shape (batch_size,self.encoder.n_scales*(dim_context_feat+1),self.encoder.n_y_axis,self.encoder.n_x_axis)
+        '''
+        return(self.encoder(X_context,Y_context,context_mask))
+
+    def decode_feature_map(self,Embedding):
+        '''
+        Input: Embedding - torch.tensor - output of self.encode
+        Output: torch.tensor - shape (batch_size,2+self.dim_cov_est,self.encoder.n_y_axis,self.encoder.n_x_axis)
+        '''
+        return(self.decoder(Embedding))
+
+    def smooth_to_targets(self,X_target,Final_Feature_Map):
+        '''
+        Input: X_target - torch.tensor- shape (batch_size,n_target,2)
+               Final_Feature_Map - torch.tensor - output of self.decode_feature_map
+        Output: see forward
+        '''
+        return(self.target_smoother(X_target,Final_Feature_Map))
+
+    #Functions for the cache of final feature maps:
+    def context_key(self,X_context,Y_context,context_mask=None):
+        '''
+        Output: string - hash of the context set (shapes, data types and values), of the device and of the versions of the 
+                parameters (which change with every in-place update, e.g. an optimizer step)
+        '''
+        hasher=hashlib.sha1()
+        hasher.update(str((X_context.device,tuple(param._version for param in self.parameters()))).encode())
+        for Tensor in [X_context,Y_context,context_mask]:
+            if Tensor is not None:
+                hasher.update(str((tuple(Tensor.shape),Tensor.dtype)).encode())
+                hasher.update(Tensor.detach().cpu().numpy().tobytes())
+        return(hasher.hexdigest())
+
+    def clear_cache(self):
+        self.feature_map_cache.clear()
+
+    def train(self,mode=True):
+        #The parameters can change during training, so cached feature maps are not valid anymore:
+        self.clear_cache()
+        return(super(SteerCNP,self).train(mode))
+
+    def load_state_dict(self,state_dict,strict=True):
+        #New parameters --> cached feature maps are not valid anymore:
+        self.clear_cache()
+        return(super(SteerCNP,self).load_state_dict(state_dict,strict=strict))
+
+    def _apply(self,fn):
+        #Called by .to(), .cuda(), .double() etc. - the cached feature maps would be on the old device/of the old type:
+        self.clear_cache()
+        return(super(SteerCNP,self)._apply(fn))
+
+    def give_final_feature_map(self,X_context,Y_context,context_mask=None):
+        '''
+        Inputs: X_context,Y_context,context_mask - see forward
+        Output: torch.tensor - output of self.decode_feature_map - taken from the cache if the same context set was seen
+                before (only used in evaluation mode without gradients and if self.cache_size>0)
+        '''
+        if self.cache_size==0 or self.training or torch.is_grad_enabled():
+            return(self.decode_feature_map(self.encode(X_context,Y_context,context_mask)))
+        key=self.context_key(X_context,Y_context,context_mask)
+        if key in self.feature_map_cache:
+            self.feature_map_cache.move_to_end(key)
+            return(self.feature_map_cache[key])
+        Final_Feature_Map=self.decode_feature_map(self.encode(X_context,Y_context,context_mask))
+        self.feature_map_cache[key]=Final_Feature_Map
+        if len(self.feature_map_cache)>self.cache_size:
+            self.feature_map_cache.popitem(last=False)
+        return(Final_Feature_Map)
+
     #Define the forward pass of ConvCNP: 
-    def forward(self,X_context,Y_context,X_target):
+    def forward(self,X_context,Y_context,X_target,context_mask=None):
         '''
         Inputs:
             X_context: torch.tensor - shape (batch_size,n_context,2)
             Y_context: torch.tensor - shape (batch_size,n_context,2)
             X_target: torch.tensor - shape (batch_size,n_target,2)
+            (X_context and X_target can also be given as indices of lattice points, shape (batch_size,n_context/n_target), see set_lattice)
+            context_mask: None or torch.tensor - shape (batch_size,n_context) - 1 for context points, 0 for padding
+                          (padded target points need no mask here since the target smoother acts on every target point
+                          separately - they are masked in the loss)
         Outputs:
             Means_target: torch.tensor - shape (batch_size,n_target,2) - mean of predictions
             Sigmas_target: torch.tensor -shape (batch_size,n_target,2) - scale of predictions
         '''
         #1.Context Set -> Embedding (via Encoder) --> shape (batch_size,3,self.encoder.n_y_axis,self.encoder.n_x_axis):
-        Embedding=self.encoder(X_context,Y_context)
         #2.Embedding ->Feature Map (via CNN) --> shape (batch_size,2+self.dim_cov_est,self.encoder.n_y_axis,self.encoder.n_x_axis):
-        Final_Feature_Map=self.decoder(Embedding)
+        #(both steps are skipped if the feature map for this context set is cached)
+        Final_Feature_Map=self.give_final_feature_map(X_context,Y_context,context_mask)
         #Smooth the output:
-        Means_target,Sigmas_target=self.target_smoother(X_target,Final_Feature_Map)
+        Means_target,Sigmas_target=self.smooth_to_targets(X_target,Final_Feature_Map)
         #Sigmas_target=Sigmas_target.clamp(min=1e-1,max=10.)
         return(Means_target,Sigmas_target)
         
@@ -173,18 +354,19 @@ class SteerCNP(nn.Module):
         for i in range(X_Context.size(0)):
             my_utils.plot_inference_2d(X_Context[i],Y_Context[i],X_Target[i],Y_Target[i],Predict=Means[i].detach(),Cov_Mat=Covs[i].detach(),title=title)
     
-    def loss(self,Y_Target,Predict,Covs,shape_reg=None):
+    def loss(self,Y_Target,Predict,Covs,shape_reg=None,target_mask=None):
         '''
             Inputs: Y_Target: torch.tensor - shape (batch_size,n,2) - Target set locations and vectors
                     Predict: torch.tensor - shape (batch_size,n,2) - Predictions of Y_Target at X_Target
                     Covs: torch.tensor - shape (batch_size,n,2,2) - covariance matrices of Y_Target at X_Target
                     shape_reg: float/None - if float gives the weight of the shape_regularizer term (see my_utils.shape_regularizer)
+                    target_mask: None or torch.tensor - shape (batch_size,n) - 1 for target points, 0 for padding
             Output: -log_ll+shape_reg*shape_diff: log_ll is the log-likelihood at Y_Target given the parameters Predict and Covs
                                                   shape_diff is the "shape difference" (interpreted here as the variance
                                                   of the difference Prdict-Y_Target computed by my_utils.shape_regularizer)
         '''
         log_ll_vec=my_utils.batch_multivar_log_ll(Means=Predict,Covs=Covs,data=Y_Target)
-        log_ll=log_ll_vec.mean()
+        log_ll=my_utils.masked_mean(log_ll_vec,target_mask)
         if shape_reg is not None: 
             loss=-log_ll+shape_reg*utils.shape_regularizer(Y_1=Y_Target,Y_2=Predict)
         else: 
@@ -202,7 +384,13 @@ class SteerCNP(nn.Module):
             'normalize_output': self.normalize_output,
             'dim_context_feat': self.dim_context_feat,
             'dim_cov_est': self.dim_cov_est,
-            'kernel_dict_out': self.kernel_dict_out
+            'kernel_dict_out': self.kernel_dict_out,
+            'memory_budget': self.memory_budget,
+            'smoother': self.smoother,
+            'smoother_tol': self.smoother_tol,
+            'recompute_kernel': self.recompute_kernel,
+            'n_features': self.n_features,
+            'cache_size': self.cache_size
         }
         return(dictionary)
     #2.Save the dictionary in a file:
@@ -217,7 +405,7 @@ class SteerCNP(nn.Module):
         Output: instance of SteerCNP with parameters as specified in dictionary
         '''
         #Load Encoder:
-        Encoder=EquivEncoder.EquivEncoder(**dictionary['encoder_dict'])
+        Encoder=equiv_encoder.EquivEncoder(**dictionary['encoder_dict'])
         #Load Decoder (depending on type of decoder use different functions):
         if dictionary['decoder_class']=="SteerDecoder":
             Decoder=architectures.SteerDecoder.create_model_from_dict(dictionary['decoder_dict'])
@@ -233,7 +421,13 @@ class SteerCNP(nn.Module):
                         kernel_dict_out=dictionary['kernel_dict_out'],
                         dim_context_feat=dictionary['dim_context_feat'],
                         l_scale=math.exp(dictionary['log_l_scale_out']), 
-                        normalize_output=dictionary['normalize_output'])
+                        normalize_output=dictionary['normalize_output'],
+                        memory_budget=dictionary.get('memory_budget'),
+                        smoother=dictionary.get('smoother',"dense"),
+                        smoother_tol=dictionary.get('smoother_tol',1e-4),
+                        recompute_kernel=dictionary.get('recompute_kernel',False),
+                        n_features=dictionary.get('n_features',256),
+                        cache_size=dictionary.get('cache_size',0))
         return(Model)
 
     #2. Load dictionary and from dictionary load model:
@@ -187,6 +187,66 @@ class ERA5Dataset(utils.Dataset):
         else:
             return(X[:,:n_context_points],Y[:,:n_context_points],X[:,n_context_points:],Y[:,n_context_points:,[2,3]])
     
+    #Coordinates of all points of the lattice (normalized if self.normalize), the indices returned by get_lattice_batch
+    #refer to the rows of this tensor (see SteerCNP.set_lattice):
+    def give_lattice(self):
+        '''
+        Output: torch.Tensor - shape (self.n_points_per_obs,2)
+        '''
+        if self.normalize:
+            return(self.translater.norm_X(self.X_tensor))
+        return(self.X_tensor)
+
+    #Same as get_batch but the locations are returned as indices of the lattice (no random transformation since 
+    #rotations do not preserve the lattice):
+    def get_lattice_batch(self,inds,n_context_points=None,cont_in_target=False):
+        '''
+        Input: `inds - torch.Tensor of ints - indices to choose batch from
+        Output: Ind_c,Y_c - torch.Tensor - shape (batch_size,n_context_points)/(batch_size,n_context_points,self.n_variables)
+                Ind_t,Y_t - torch.Tensor - shape (batch_size,n_target_points)/(batch_size,n_target_points,2) if cont_in_target is False
+                                               (batch_size,n_target_points+n_context_points)/(...,2) if cont_in_target is True
+                Ind_c,Ind_t are indices of the rows of self.give_lattice()
+        '''
+        Ind_list=[]
+        Y_list=[]
+        for ind in inds:
+            Y=torch.tensor(self.Y_data[ind].values,dtype=torch.get_default_dtype()).view(-1,self.n_variables)
+            Ind=self.circular_indices if self.circular else torch.arange(self.n_points_per_obs)
+            Ind=Ind[torch.randperm(n=Ind.size(0))]
+            Ind_list.append(Ind)
+            Y_list.append(Y[Ind])
+        Ind=torch.stack(Ind_list,dim=0)
+        Y=torch.stack(Y_list,dim=0)
+        if self.normalize:
+            Y=self.translater.norm_Y(Y)
+        if n_context_points is None:
+            n_context_points=np.random.randint(low=self.Min_n_cont,high=self.Max_n_cont)    
+        if cont_in_target:
+            return(Ind[:,:n_context_points],Y[:,:n_context_points],Ind,Y[:,:,[2,3]])
+        else:
+            return(Ind[:,:n_context_points],Y[:,:n_context_points],Ind[:,n_context_points:],Y[:,n_context_points:,[2,3]])
+
+    #Same as get_batch but the number of context points is sampled for every map separately:
+    def get_ragged_batch(self,inds,transform=False,cont_in_target=False):
+        '''
+        Input: `inds - torch.Tensor of ints - indices to choose batch from
+                transform - Boolean - indicates whether a random transformation is performed
+        Output: X_c,Y_c - torch.Tensor - shape (batch_size,max_n_context_points,2/self.n_variables) - padded context sets
+                X_t,Y_t - torch.Tensor - shape (batch_size,max_n_target_points,2/2) - padded target sets
+                context_mask - torch.Tensor - shape (batch_size,max_n_context_points) - True for context points, False for padding
+                target_mask - torch.Tensor - shape (batch_size,max_n_target_points) - True for target points, False for padding
+                              (None if cont_in_target, then there is no padding)
+        The padded entries are filled with other (valid) points of the same map.
+        '''
+        X_list,Y_list=zip(*[self.get_map(ind=ind,transform=transform) for ind in inds])
+        X=torch.stack(X_list,dim=0)
+        Y=torch.stack(Y_list,dim=0)
+        if self.normalize:
+            X,Y=self.translater.translate_to_normalized_scale(X,Y)
+        n_context_points=torch.randint(low=self.Min_n_cont,high=self.Max_n_cont,size=[len(inds)])
+        #The targets are the wind components Y[:,:,[2,3]]:
+        return(my_utils.ragged_context_target_split(X,Y,n_context_points,cont_in_target=cont_in_target,Y_target=Y[:,:,[2,3]]))
+    
     def get_rand_batch(self,batch_size,transform=False,n_context_points=None,cont_in_target=False):
         '''
         Returns self.get_batch with random number of indices with length=batch_size and random number of context points
@@ -16,10 +16,10 @@ from tasks.gp.gp_sampler import cyclic_gp_sampler
 
 #This functions create samples and saves it in a filename:
 def create_gp_file_2d(filename,n_samples,min_x,max_x,n_grid_points,l_scale=1,sigma_var=1, 
-                        kernel_type="curl_free",obs_noise=1e-2):
+                        kernel_type="curl_free",obs_noise=1e-2,sampler="cholesky"):
     #Sample data:
     X_data,Y_data=cyclic_gp_sampler(n_samples=n_samples,min_x=min_x,max_x=max_x,n_grid_points=n_grid_points,l_scale=l_scale,sigma_var=sigma_var, 
-                        kernel_type=kernel_type,obs_noise=obs_noise)
+                        kernel_type=kernel_type,obs_noise=obs_noise,sampler=sampler)
     #Save the numpy array:
     np.save('tasks/gp/gp_curl_free/data/'+filename+'_X', X_data.numpy())
     np.save('tasks/gp/gp_curl_free/data/'+filename+'_Y', Y_data.numpy())
@@ -31,6 +31,7 @@ L_SCALE=5
 SIGMA_VAR=10. 
 KERNEL_TYPE="curl_free"
 OBS_NOISE=0.02
+SAMPLER="cholesky"
 N_TRAIN_SAMPLES=80000
 N_VAL_SAMPLES=20000
 N_TEST_SAMPLES=20000
@@ -40,10 +41,10 @@ TEST_FILENAME='gp_curl_free_Test'
 
 #Create train data:
 create_gp_file_2d(filename=TRAIN_FILENAME,n_samples=N_TRAIN_SAMPLES,min_x=MIN_X,max_x=MAX_X,n_grid_points=N_GRID_POINTS,l_scale=L_SCALE,sigma_var=SIGMA_VAR,kernel_type=KERNEL_TYPE,
-                       obs_noise=OBS_NOISE)
+                       obs_noise=OBS_NOISE,sampler=SAMPLER)
 #Create validation data:
 create_gp_file_2d(filename=VAL_FILENAME,n_samples=N_VAL_SAMPLES,min_x=MIN_X,max_x=MAX_X,n_grid_points=N_GRID_POINTS,l_scale=L_SCALE,sigma_var=SIGMA_VAR,kernel_type=KERNEL_TYPE,
-                       obs_noise=OBS_NOISE)
+                       obs_noise=OBS_NOISE,sampler=SAMPLER)
 #Create test data:
 create_gp_file_2d(filename=TEST_FILENAME,n_samples=N_TEST_SAMPLES,min_x=MIN_X,max_x=MAX_X,n_grid_points=N_GRID_POINTS,l_scale=L_SCALE,sigma_var=SIGMA_VAR,kernel_type=KERNEL_TYPE,
-                       obs_noise=OBS_NOISE)
+                       obs_noise=OBS_NOISE,sampler=SAMPLER)
@@ -5,9 +5,14 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.data as utils
+import sys
 from datetime import datetime
 from datetime import timedelta
 
+sys.path.append("../../")
+
+import my_utils
+
 '''
 A data set class to deal with the GP data.
 '''
@@ -100,6 +105,26 @@ class GPdataset(utils.IterableDataset):
         else:
             return(X[:,:n_context_points],Y[:,:n_context_points],X[:,n_context_points:],Y[:,n_context_points:])
     
+    def get_ragged_batch(self,inds,cont_in_target=False):
+        '''
+        Same as get_batch but the number of context points is sampled for every observation separately.
+        Input: inds - list of ints - gives indices of which observations to choose for minibatch
+               cont_in_target -Boolean - if True, the target set includes the context set
+        Ouput: X_context,Y_context - torch.Tensor - shape (len(inds),max_n_context,self.dim_2_X/self.dim_2_Y) - padded context sets
+               X_target, Y_target - torch.Tensor - shape (len(inds),max_n_target,self.dim_2_X/self.dim_2_Y) - padded target sets
+               context_mask - torch.Tensor - shape (len(inds),max_n_context) - True for context points, False for padding
+               target_mask - torch.Tensor - shape (len(inds),max_n_target) - True for target points, False for padding 
+                             (None if cont_in_target, then there is no padding)
+        The padded entries are filled with other (valid) points of the same observation.
+        '''
+        n_context_points=torch.randint(low=self.Min_n_cont,high=self.Max_n_cont,size=[len(inds)])
+        shuffle=torch.randperm(self.dim_1)
+        X=self.X_data[inds][:,shuffle[:self.n_total]]
+        Y=self.Y_data[inds][:,shuffle[:self.n_total]]
+        if self.transform:
+            X,Y=self.rand_transform(X,Y)
+        return(my_utils.ragged_context_target_split(X,Y,n_context_points,cont_in_target=cont_in_target))
+    
     def get_rand_batch(self,batch_size,n_context_points=None,cont_in_target=False):
         '''
         Returns self.get_batch with random number of indices with length=batch_size and random number of context points
@@ -15,7 +15,7 @@ import my_utils
 
 #This functions create n_samples of a GP on a radial grid:
 def cyclic_gp_sampler(n_samples,min_x,max_x,n_grid_points,l_scale=1.,sigma_var=1., 
-                        kernel_type="div_free",obs_noise=1e-2,cyclic=True):
+                        kernel_type="div_free",obs_noise=1e-2,cyclic=True,chunk_size=1000,sampler="cholesky"):
     '''
     Input:
     n_samples - int - number of samples to compute 
@@ -25,6 +25,13 @@ def cyclic_gp_sampler(n_samples,min_x,max_x,n_grid_points,l_scale=1.,sigma_var=1
     sigma_var - sigma parameter for kernel
     kernel_type - type of kernel considered (see kernel_and_gp_tools.py)
     obs_noise - observation noise to be added 
+    chunk_size - int - number of samples drawn at once (only limits memory, the kernel is factorized once for all samples)
+    sampler - string - "cholesky": dense Cholesky factor of the Gram matrix on the (radial) grid
+                       "circulant": circulant embedding on the full regular grid via FFT (see GP.circulant_gp_sampler_2d),
+                                    the radial grid is obtained by masking - scales to large grids
+                       "potential": only for div_free and curl_free kernels - curl/gradient of a scalar potential sampled via 
+                                    circulant embedding on the full regular grid (see GP.potential_circulant_sampler_2d),
+                                    the radial grid is obtained by masking - only scalar eigenvalues and FFTs
     Output:
     X_data - torch.Tensor - shape (n_samples,number of points per sample,2) - n_samples samples of a GP 
                                                                               sampled on a circle with kernel 
@@ -33,20 +40,44 @@ def cyclic_gp_sampler(n_samples,min_x,max_x,n_grid_points,l_scale=1.,sigma_var=1
     '''
     #Get a radial grid:
     if cyclic:
-        X_Grid=utils.radial_grid(min=min_x,max=max_x,n_axis=n_grid_points)
+        X_Grid=my_utils.radial_grid(min=min_x,max=max_x,n_axis=n_grid_points)
     else:
         X_Grid=my_utils.give_2d_grid(min_x=min_x,max_x=max_x,n_x_axis=n_grid_points,flatten=True)
     n=X_Grid.size(0)
+    if sampler=="cholesky":
+        #The grid is the same for all samples, so the kernel is factorized only once:
+        L=GP.gp_cholesky_factor(X_Grid,kernel_type=kernel_type,B=None,l_scale=l_scale,sigma_var=sigma_var)
+    elif sampler=="circulant" or sampler=="potential":
+        #The embedding is the same for all samples, so it is diagonalized only once (for the potential the scalar rbf kernel):
+        if sampler=="circulant":
+            Sqrt_Lambda=GP.circulant_embedding_2d(min_x=min_x,max_x=max_x,n_x_axis=n_grid_points,l_scale=l_scale,
+                                                  sigma_var=sigma_var,kernel_type=kernel_type)
+        else:
+            Sqrt_Lambda=GP.circulant_embedding_2d(min_x=min_x,max_x=max_x,n_x_axis=n_grid_points,l_scale=l_scale,
+                                                  sigma_var=1,kernel_type="rbf")
+        #Mask to get the radial grid from the full grid:
+        Ind=my_utils.bool_inner_circle_indices(n_grid_points) if cyclic else torch.ones((n_grid_points,n_grid_points),dtype=torch.bool)
+    else:
+        sys.exit("Unknown sampler.")
     #Create empty data arrays:
     X_data=torch.empty((n_samples,n,2))
     Y_data=torch.empty((n_samples,n,2))
-    for i in range(n_samples):
-        #Sample a GP:
-        Y=GP.multidim_gp_sampler(X_Grid,kernel_type=kernel_type,B=None,l_scale=l_scale,sigma_var=sigma_var,obs_noise=obs_noise)
-        #Shuffle it and add it to the data arrays:
-        ind=torch.randperm(n)
-        X_data[i,:,:]=X_Grid[ind]
-        Y_data[i,:,:]=Y[ind]
-        if i%100==0:
-            print('Iteration: ', i)
-    return(X_data,Y_data)
\ No newline at end of file
+    for start in range(0,n_samples,chunk_size):
+        end=min(start+chunk_size,n_samples)
+        #Sample a chunk of GPs --> shape (end-start,n,2):
+        if sampler=="cholesky":
+            Y=GP.batch_multidim_gp_sampler(X_Grid,n_samples=end-start,obs_noise=obs_noise,L=L)
+        elif sampler=="potential":
+            Y=GP.potential_circulant_sampler_2d(end-start,min_x=min_x,max_x=max_x,n_x_axis=n_grid_points,kernel_type=kernel_type,
+                                                obs_noise=obs_noise,Sqrt_Lambda=Sqrt_Lambda)
+            Y=Y.view(end-start,n_grid_points,n_grid_points,2)[:,Ind]
+        else:
+            Y=GP.circulant_gp_sampler_2d(end-start,min_x=min_x,max_x=max_x,n_x_axis=n_grid_points,obs_noise=obs_noise,
+                                        Sqrt_Lambda=Sqrt_Lambda)
+            Y=Y.view(end-start,n_grid_points,n_grid_points,2)[:,Ind]
+        #Shuffle every sample independently and add it to the data arrays:
+        ind=torch.argsort(torch.rand((end-start,n)),dim=1)
+        X_data[start:end]=X_Grid[ind]
+        Y_data[start:end]=torch.gather(Y,1,ind.unsqueeze(2).expand(end-start,n,2))
+        print('Iteration: ', end)
+    return(X_data,Y_data)
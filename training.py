@@ -184,9 +184,16 @@ def train_cnp(CNP, train_dataset,val_dataset, data_identifier,device,minibatch_s
         #Return the model and the loss memory:
         return(CNP,train_loss_tracker,complete_filename)
 
-def test_cnp(CNP,val_dataset,device,n_samples=400,batch_size=1,n_data_passes=1,send_to_device=False):
+def test_cnp(CNP,val_dataset,device,n_samples=400,batch_size=1,n_data_passes=1,send_to_device=False,ragged=False,lattice=False):
         if send_to_device:
             CNP=CNP.to(device)
+        #If lattice, the locations are passed as indices of the lattice of the data set (only ERA5, see SteerCNP.set_lattice),
+        #the previous lattice of the model is restored at the end:
+        if lattice:
+            if not hasattr(CNP,'set_lattice') or not hasattr(val_dataset,'get_lattice_batch'):
+                sys.exit("Lattice inputs are only possible for the SteerCNP on the ERA5 data set.")
+            previous_lattice=CNP.give_lattice()
+            CNP.set_lattice(val_dataset.give_lattice().to(device))
         with torch.no_grad():
             n_obs=val_dataset.n_obs
             n_samples_max=min(n_samples,n_obs)
@@ -198,8 +205,17 @@ def test_cnp(CNP,val_dataset,device,n_samples=400,batch_size=1,n_data_passes=1,s
                 batch_ind_list=[ind_list[j*batch_size:(j+1)*batch_size] for j in range(n_iterat)]
 
                 for it in range(n_iterat):
-                    #Get random minibatch:
-                    x_context,y_context,x_target,y_target=val_dataset.get_batch(inds=batch_ind_list[it],cont_in_target=False)
+                    #Get random minibatch (if ragged, the number of context points differs between the tasks in the batch):
+                    if ragged:
+                        x_context,y_context,x_target,y_target,context_mask,target_mask=val_dataset.get_ragged_batch(inds=batch_ind_list[it],cont_in_target=False)
+                        context_mask=context_mask.to(device)
+                        target_mask=target_mask.to(device)
+                    elif lattice:
+                        x_context,y_context,x_target,y_target=val_dataset.get_lattice_batch(inds=batch_ind_list[it],cont_in_target=False)
+                        context_mask,target_mask=None,None
+                    else:
+                        x_context,y_context,x_target,y_target=val_dataset.get_batch(inds=batch_ind_list[it],cont_in_target=False)
+                        context_mask,target_mask=None,None
                     
                     #Load data to device:
                     x_context=x_context.to(device)
@@ -208,8 +224,10 @@ def test_cnp(CNP,val_dataset,device,n_samples=400,batch_size=1,n_data_passes=1,s
                     y_target=y_target.to(device)
 
                     #The target set includes the context set here:
-                    Means,Sigmas=CNP(x_context,y_context,x_target) 
-                    _, log_ll_it=CNP.loss(y_target,Means,Sigmas)
+                    Means,Sigmas=CNP(x_context,y_context,x_target,context_mask=context_mask) 
+                    _, log_ll_it=CNP.loss(y_target,Means,Sigmas,target_mask=target_mask)
                     log_ll+=log_ll_it/n_iterat
                     
+        if lattice:
+            CNP.set_lattice(previous_lattice)
         return(log_ll.item()/n_data_passes)